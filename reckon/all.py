@@ -1,28 +1,232 @@
-import build
-import flatten
-import txns
-import price
-import pf
-import tax_hifo
+import argparse
+import importlib
+import json
+import os
+import time
+
+from config import (
+    ALL_STATE_OUTPUT,
+    COINGECKO_CACHE_OUTPUT,
+    COINGECKO_COINS_LIST_FILE,
+    COINGECKO_MISSING_OUTPUT,
+    COINGECKO_TOML,
+    DEBANK_FILE,
+    DEFILLAMA_CACHE_OUTPUT,
+    DEFILLAMA_MISSING_OUTPUT,
+    FLATTEN_OUTPUT,
+    PF_OUTPUT,
+    PRICE_CONFIG,
+    PRICE_MANUAL_FILE,
+    PRICE_OUTPUT,
+    STABLECOINS_TOML,
+    TAGS_FILE,
+    TAGS_LOCAL_FILE,
+    TAX_HIFO_OUTPUT,
+    TXNS_CONFIG,
+    TXNS_MANUAL_FILE,
+    TXNS_OUTPUT,
+    TXNS_PRICE_REQ_OUTPUT,
+    TXNS_TOML,
+    WALLETS,
+    WALLETS_DIR,
+    WALLETS_TOML,
+)
+from utils import fingerprint
+
+
+class Stage:
+    """
+    A pipeline stage: the module whose main() runs it and the files it reads
+    and writes. inputs and outputs are functions returning paths, so they
+    are evaluated each time the stage is checked.
+
+    writes returns the inputs the stage also writes itself (i.e. the price
+    caches). They are fingerprinted again after it runs; all other inputs are
+    recorded as they were before it ran. retry returns why the stage has to
+    run again even if its inputs do not change, or None, and is checked right
+    after it runs.
+    """
+
+    def __init__(self, name, inputs, outputs, writes=lambda: [],
+                 retry=lambda: None):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.writes = writes
+        self.retry = retry
+
+    def run(self):
+        importlib.import_module(self.name).main()
+
+
+def wallet_files():
+    return [f'{WALLETS_DIR}/{wallet[0]}-{wallet[1]}.json' for wallet in WALLETS]
+
+
+def report_files():
+    return [report['file'] for report in TXNS_CONFIG['reports'].values()]
+
+
+def price_caches():
+    return [DEFILLAMA_CACHE_OUTPUT, DEFILLAMA_MISSING_OUTPUT,
+            COINGECKO_CACHE_OUTPUT, COINGECKO_MISSING_OUTPUT]
+
+
+def price_retry():
+    # Requests without an answer are not cached, so the caches and the other
+    # inputs can be unchanged while price.csv still lacks their prices
+    failures = importlib.import_module('price').transient_failures()
+    if failures:
+        return f'{failures} price requests failed last run'
+    return None
 
-if __name__ == '__main__':
 
-    print("Running all scripts")
+# build's other input is the DeBank API, which cannot be fingerprinted. It
+# runs when the wallets change or a wallet file is missing, and new history
+# is only fetched for the others with --build (or --force).
+STAGES = [
+    Stage('build',
+          inputs=lambda: [WALLETS_TOML],
+          outputs=wallet_files),
+    Stage('flatten',
+          inputs=lambda: [WALLETS_TOML, DEBANK_FILE, TAGS_FILE,
+                          TAGS_LOCAL_FILE] + wallet_files(),
+          outputs=lambda: [FLATTEN_OUTPUT]),
+    Stage('txns',
+          inputs=lambda: [FLATTEN_OUTPUT, TXNS_TOML, TXNS_MANUAL_FILE,
+                          STABLECOINS_TOML, TAGS_FILE,
+                          TAGS_LOCAL_FILE] + report_files(),
+          outputs=lambda: [TXNS_OUTPUT, TXNS_PRICE_REQ_OUTPUT]),
+    Stage('price',
+          inputs=lambda: [TXNS_OUTPUT, TXNS_PRICE_REQ_OUTPUT, PRICE_CONFIG,
+                          PRICE_MANUAL_FILE, STABLECOINS_TOML, COINGECKO_TOML,
+                          COINGECKO_COINS_LIST_FILE] + price_caches(),
+          outputs=lambda: [PRICE_OUTPUT],
+          writes=price_caches,
+          retry=price_retry),
+    Stage('pf',
+          inputs=lambda: [PRICE_OUTPUT],
+          outputs=lambda: [PF_OUTPUT]),
+    Stage('tax_hifo',
+          inputs=lambda: [PRICE_OUTPUT],
+          outputs=lambda: [TAX_HIFO_OUTPUT]),
+]
 
-    print("Running build.py")
-    build.main()
 
-    print("Running flatten.py")
-    flatten.main()
+def load_state():
+    """
+    Returns the state of the last runs: for every stage the fingerprints of
+    its inputs and why it has to run again, if it does.
+    """
+    state = {}
+    if os.path.isfile(ALL_STATE_OUTPUT):
+        with open(ALL_STATE_OUTPUT, 'r') as f:
+            state = json.load(f)
+    # Stages recorded in the older format without 'inputs' run again once
+    return {name: entry for name, entry in state.items() if 'inputs' in entry}
 
-    print("Running txns.py")
-    txns.main()
 
-    print("Running price.py")
-    price.main()
+def save_state(state):
+    tmp_path = ALL_STATE_OUTPUT + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, ALL_STATE_OUTPUT)
 
-    print("Running pf.py")
-    pf.main()
 
-    print("Running tax_hifo.py")
-    tax_hifo.main()
+def stage_fingerprints(paths, recorded):
+    return {path: fingerprint(path, recorded.get(path)) for path in paths}
+
+
+def why_run(stage, state):
+    """
+    Returns why stage has to run, or None if it is up to date: its last run
+    left nothing to retry, its inputs hash the same as when it last ran and
+    all of its outputs exist.
+    """
+    if stage.name not in state:
+        return 'no previous run'
+    if state[stage.name].get('retry'):
+        return state[stage.name]['retry']
+    for path in stage.outputs():
+        if not os.path.exists(path):
+            return f'{path} is missing'
+    recorded = state[stage.name]['inputs']
+    for path, fp in stage_fingerprints(stage.inputs(), recorded).items():
+        if path not in recorded:
+            return f'{path} is a new input'
+        previous = recorded[path]
+        if (fp is None) != (previous is None) or \
+                (fp is not None and fp[2] != previous[2]):
+            return f'{path} changed'
+    return None
+
+
+def main(stages=STAGES, dry_run=False, force=False, refresh=()):
+    """Run the pipeline stages whose inputs changed since they last ran"""
+
+    # refresh names the stages to run even if they are up to date, i.e.
+    # build to fetch new history from DeBank
+
+    state = load_state()
+    started = time.time()
+
+    # Outputs of the stages that will or may run. In a dry run a stage
+    # downstream of one of them is planned too, as its inputs may change.
+    pending_outputs = set()
+    for stage in stages:
+        if force:
+            reason = 'forced'
+        elif stage.name in refresh:
+            reason = 'refresh requested'
+        else:
+            reason = why_run(stage, state)
+        if dry_run and reason is None:
+            upstream = pending_outputs.intersection(stage.inputs())
+            if upstream:
+                reason = f'after {", ".join(sorted(upstream))}'
+
+        if reason is None:
+            print(f'Skipping {stage.name}.py (up to date)')
+            continue
+
+        if dry_run:
+            print(f'Would run {stage.name}.py ({reason})')
+            pending_outputs.update(stage.outputs())
+            continue
+
+        print(f'Running {stage.name}.py ({reason})')
+        # Inputs are recorded as they were before the run, so an input edited
+        # while the stage runs is seen as changed next time. Only the inputs
+        # the stage writes itself are recorded as they are after it.
+        recorded = state.get(stage.name, {}).get('inputs', {})
+        inputs = stage_fingerprints(stage.inputs(), recorded)
+        stage_started = time.time()
+        stage.run()
+        print(f'Finished {stage.name}.py in {time.time() - stage_started:.1f}s')
+
+        inputs.update(stage_fingerprints(stage.writes(), recorded))
+        retry = stage.retry()
+        if retry:
+            print(f'{stage.name}.py will run again next time ({retry})')
+        state[stage.name] = {'inputs': inputs, 'retry': retry}
+        save_state(state)
+
+    if not dry_run:
+        print(f'Pipeline finished in {time.time() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print which stages would run and why')
+    parser.add_argument('--force', action='store_true',
+                        help='run every stage, i.e. after changing code')
+    parser.add_argument('--build', action='store_true',
+                        help='fetch new history of every wallet from DeBank')
+    parser.add_argument('--no-build', action='store_true',
+                        help='do not fetch wallets from DeBank')
+    args = parser.parse_args()
+    stages = [stage for stage in STAGES
+              if not (args.no_build and stage.name == 'build')]
+    main(stages, dry_run=args.dry_run, force=args.force,
+         refresh=['build'] if args.build else [])
@@ -1,14 +1,20 @@
-from debank import fetch_all_history
+import argparse
+from debank import fetch_all_histories
 from config import WALLETS
 
-def main():
+def main(incremental=True):
     """Build and/or refresh wallets listed in config file"""
 
-    for wallet in WALLETS:
-        id = wallet[0]
-        chain_id = wallet[1]
-        hl = fetch_all_history(id, chain_id)
+    requests_saved = 0
+    for hl in fetch_all_histories(WALLETS, incremental=incremental):
         hl.write()
+        requests_saved += hl.requests_saved
+
+    print(f"Saved {requests_saved} DeBank history requests")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--full', action='store_true',
+                        help='page through the full history of every wallet')
+    args = parser.parse_args()
+    main(incremental=not args.full)
\ No newline at end of file
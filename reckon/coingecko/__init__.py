@@ -1 +1 @@
-from .coingecko import get_historical_price, save_historical_price, clean_caches
\ No newline at end of file
+from .coingecko import get_historical_price, get_cache_stats, prefetch_historical_prices, save_historical_price, clean_caches
\ No newline at end of file
@@ -2,20 +2,98 @@ import csv
 from datetime import datetime, timezone
 import json
 import os
+import pickle
 import requests
-import time
+import threading
 # import utils
+from utils import RateLimiter, compact_csv, get_with_retry
 from config import (
+    COINGECKO_BACKOFF_SECONDS,
+    COINGECKO_BURST,
     COINGECKO_CACHE_OUTPUT,
     COINGECKO_COINS_LIST_FILE,
     COINGECKO_ID_EXPLICIT,
+    COINGECKO_ID_INDEX_OUTPUT,
+    COINGECKO_MAX_WORKERS,
     COINGECKO_MISSING_OUTPUT,
+    COINGECKO_RANGE_MAX_DAYS,
+    COINGECKO_RANGE_MIN_DATES,
+    COINGECKO_REQUESTS_PER_SECOND,
+    COINGECKO_RETRIES,
     COINGECKO_TOML,
     PRICE_MANUAL_FILE,
 )
 
-COINGECKO_ID_LIST = json.load(open(COINGECKO_COINS_LIST_FILE))
-COINGECKO_IDS = [elem['symbol'] for elem in COINGECKO_ID_LIST]
+
+def load_coin_id_index():
+    """
+    Loads the symbol to coin ids index of COINGECKO_COINS_LIST_FILE.
+
+    The index is pickled to COINGECKO_ID_INDEX_OUTPUT together with the size
+    and mtime of the coins list. It is only rebuilt from the JSON when those
+    change (or the pickle is unreadable). It is loaded once, on the first
+    get_coin_id() call that is not answered by COINGECKO_ID_EXPLICIT.
+
+    Returns:
+        dict: List of coin ids by lowercase symbol
+    """
+    global COINGECKO_ID_INDEX
+    if COINGECKO_ID_INDEX is not None:
+        return COINGECKO_ID_INDEX
+
+    with CACHE_LOCK:
+        if COINGECKO_ID_INDEX is None:
+            COINGECKO_ID_INDEX = read_coin_id_index()
+    return COINGECKO_ID_INDEX
+
+
+def read_coin_id_index():
+    stat = os.stat(COINGECKO_COINS_LIST_FILE)
+    source = (stat.st_size, stat.st_mtime_ns)
+
+    if os.path.isfile(COINGECKO_ID_INDEX_OUTPUT):
+        try:
+            with open(COINGECKO_ID_INDEX_OUTPUT, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['source'] == source:
+                return cached['index']
+        except (pickle.UnpicklingError, EOFError, KeyError, TypeError):
+            pass
+
+    print(f'Building {COINGECKO_ID_INDEX_OUTPUT} from {COINGECKO_COINS_LIST_FILE}')
+    index = {}
+    with open(COINGECKO_COINS_LIST_FILE) as f:
+        for elem in json.load(f):
+            index.setdefault(elem['symbol'], []).append(elem['id'])
+    with open(COINGECKO_ID_INDEX_OUTPUT, 'wb') as f:
+        pickle.dump({'source': source, 'index': index}, f)
+    return index
+
+
+# Symbol to coin ids index, see load_coin_id_index()
+COINGECKO_ID_INDEX = None
+
+# Base URL of the CoinGecko API; can be overridden to point at a stub
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com")
+
+# Shared connection pool, rate limit and cache lock for the CoinGecko workers
+SESSION = requests.Session()
+SESSION.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_maxsize=COINGECKO_MAX_WORKERS)
+)
+SESSION.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_maxsize=COINGECKO_MAX_WORKERS)
+)
+RATE_LIMITER = RateLimiter(COINGECKO_REQUESTS_PER_SECOND, COINGECKO_BURST)
+CACHE_LOCK = threading.RLock()
+
+# Process-level copies of the cache files keyed by (date, lowercase symbol).
+# They are loaded on first use by load_caches() and written through on save.
+PRICE_CACHE = None
+MISSING_CACHE = None
+
+# Counters of how get_historical_price() requests were served
+CACHE_STATS = {'hits': 0, 'known_missing': 0, 'misses': 0, 'gave_up': 0}
 
 
 def get_coin_id(symbol):
@@ -23,9 +101,9 @@ def get_coin_id(symbol):
     Gets the CoinGecko coin ID that used for API queries. Refer to the docs at
     https://www.coingecko.com/en/api/documentation for /coins/list.
 
-    Note that this function references the file in COINGECKO_ID_LIST. It can be
-    manually generated via the documentation. There is not currently support to
-    do it automatically.
+    Note that this function references the file in COINGECKO_COINS_LIST_FILE
+    through load_coin_id_index(). It can be manually generated via the
+    documentation. There is not currently support to do it automatically.
 
     Parameters:
         symbol (str): ERC 20 token symbol
@@ -37,9 +115,8 @@ def get_coin_id(symbol):
     if symbol.lower() in COINGECKO_ID_EXPLICIT:
         # print(f'PRELIST {date} | {purchase_token} => {COINGECKO_ID_DICT[purchase_token]}')
         return COINGECKO_ID_EXPLICIT[symbol.lower()]
-    elif symbol.lower() in COINGECKO_IDS:
-        matches = [x['id']
-                   for x in COINGECKO_ID_LIST if x['symbol'] == symbol.lower()]
+    elif symbol.lower() in load_coin_id_index():
+        matches = COINGECKO_ID_INDEX[symbol.lower()]
         if len(matches) == 1:
             # print(f'LIST {date} | {purchase_token} => {matches[0]}')
             COINGECKO_ID_EXPLICIT[symbol.lower()] = matches[0]
@@ -55,9 +132,57 @@ def get_coin_id(symbol):
     return None
 
 
+def cache_key(symbol: str, date: datetime):
+    """Key of a symbol and date in PRICE_CACHE and MISSING_CACHE."""
+    return (date.strftime("%Y-%m-%d"), symbol.lower())
+
+
+def load_caches():
+    """
+    Loads COINGECKO_CACHE_OUTPUT and COINGECKO_MISSING_OUTPUT into
+    PRICE_CACHE and MISSING_CACHE if they have not been loaded yet.
+    """
+    global PRICE_CACHE, MISSING_CACHE
+    if PRICE_CACHE is not None:
+        return
+
+    with CACHE_LOCK:
+        if PRICE_CACHE is not None:
+            return
+
+        price_cache = {}
+        if os.path.isfile(COINGECKO_CACHE_OUTPUT):
+            with open(COINGECKO_CACHE_OUTPUT, 'r') as f:
+                for line in f:
+                    ldate, lsymbol, lprice, ldate_added, lsource = line.rstrip().split(',')
+                    if lprice != '':
+                        price_cache.setdefault((ldate, lsymbol.lower()), float(lprice))
+
+        MISSING_CACHE = set()
+        if os.path.isfile(COINGECKO_MISSING_OUTPUT):
+            with open(COINGECKO_MISSING_OUTPUT, 'r') as f:
+                for line in f:
+                    ldate, lsymbol, lprice, ldate_added, lsource = line.rstrip().split(',')
+                    MISSING_CACHE.add((ldate, lsymbol.lower()))
+
+        # Set last so other threads never see a partly loaded cache
+        PRICE_CACHE = price_cache
+
+
+def get_cache_stats():
+    """Returns the hit/miss counters of get_historical_price()."""
+    with CACHE_LOCK:
+        return dict(CACHE_STATS)
+
+
+def count_cache_stat(name):
+    with CACHE_LOCK:
+        CACHE_STATS[name] += 1
+
+
 def get_cached_historical_price(symbol: str, date: datetime):
     """
-    Tries to get the historical price from the cache file.
+    Tries to get the historical price from the cache.
 
     This function raises an Exception if the datetime object is not valid.
 
@@ -75,26 +200,23 @@ def get_cached_historical_price(symbol: str, date: datetime):
         raise Exception("Date is not a valid datetime object")
     date = date.replace(tzinfo=timezone.utc)
 
-    # if os.path.isfile(PRICE_MANUAL_FILE):
-    #     with open(PRICE_MANUAL_FILE, 'r') as f:
-    #         for line in f:
-    #             ldate, lsymbol, lprice, ldate_added, lsource = line.rstrip().split(',')
-    #             if ldate == date.strftime("%Y-%m-%d") and \
-    #                     lsymbol.lower() == symbol.lower() and \
-    #                     lprice != '':
-    #                 return float(lprice)
-
-    if os.path.isfile(COINGECKO_CACHE_OUTPUT):
-        with open(COINGECKO_CACHE_OUTPUT, 'r') as f:
-            for line in f:
-                ldate, lsymbol, lprice, ldate_added, lsource = line.rstrip().split(',')
-                if ldate == date.strftime("%Y-%m-%d") and \
-                        lsymbol.lower() == symbol.lower() and \
-                        lprice != '':
-                    # print(f'Cache hit for {date.strftime("%Y-%m-%d")}:{symbol}:{price}')
-                    return float(lprice)
+    load_caches()
+    return PRICE_CACHE.get(cache_key(symbol, date))
 
-    return None
+
+def is_known_missing(symbol: str, date: datetime):
+    """
+    Checks if the price of the symbol at the date was previously missing.
+
+    Parameters:
+        symbol (str): ERC0-20 token symbol (i.e. ETH, CRV, CVX)
+        date (datetime): Python datetime object
+
+    Returns:
+        bool: True if the price is known to be missing
+    """
+    load_caches()
+    return cache_key(symbol, date) in MISSING_CACHE
 
 
 def save_historical_price(symbol: str,
@@ -111,16 +233,18 @@ def save_historical_price(symbol: str,
         source (str): Optional; default is Coingecko; source of the price quote
     """
     date = date.replace(tzinfo=timezone.utc)
-    cached_price = get_cached_historical_price(symbol, date)
-
-    if cached_price == None:
-        with open(COINGECKO_CACHE_OUTPUT, 'a') as f:
-            date_added = datetime.utcnow().strftime('%Y-%m-%d')
-            f.write(
-                f"{date.strftime('%Y-%m-%d')},{symbol},{price},{date_added},{source}\n")
-    else:
-        # print(f'WARN: Entry for {date}|{symbol}|{price} already exists')
-        pass
+    with CACHE_LOCK:
+        cached_price = get_cached_historical_price(symbol, date)
+
+        if cached_price == None:
+            PRICE_CACHE[cache_key(symbol, date)] = float(price)
+            with open(COINGECKO_CACHE_OUTPUT, 'a') as f:
+                date_added = datetime.utcnow().strftime('%Y-%m-%d')
+                f.write(
+                    f"{date.strftime('%Y-%m-%d')},{symbol},{price},{date_added},{source}\n")
+        else:
+            # print(f'WARN: Entry for {date}|{symbol}|{price} already exists')
+            pass
 
 
 def save_missing_price(symbol: str, date: datetime):
@@ -132,10 +256,14 @@ def save_missing_price(symbol: str, date: datetime):
         date (datetime): Date of the price
     """
     date = date.replace(tzinfo=timezone.utc)
-    # print(f"Saving {symbol} price for {date} to {PRICE_MISSING_OUTPUT}")
-    with open(COINGECKO_MISSING_OUTPUT, 'a') as f:
-        date_added = datetime.utcnow().strftime('%Y-%m-%d')
-        f.write(f"{date.strftime('%Y-%m-%d')},{symbol},?,{date_added},Missing\n")
+    with CACHE_LOCK:
+        if is_known_missing(symbol, date):
+            return
+        MISSING_CACHE.add(cache_key(symbol, date))
+        # print(f"Saving {symbol} price for {date} to {PRICE_MISSING_OUTPUT}")
+        with open(COINGECKO_MISSING_OUTPUT, 'a') as f:
+            date_added = datetime.utcnow().strftime('%Y-%m-%d')
+            f.write(f"{date.strftime('%Y-%m-%d')},{symbol},?,{date_added},Missing\n")
 
 
 def get_historical_price(symbol: str, date: datetime):
@@ -164,8 +292,16 @@ def get_historical_price(symbol: str, date: datetime):
     # Check for cached price and if present return it
     price = get_cached_historical_price(symbol, date)
     if price != None:
+        count_cache_stat('hits')
         return float(price)
 
+    # Skip dates that CoinGecko previously had no price for
+    if is_known_missing(symbol, date):
+        count_cache_stat('known_missing')
+        return None
+
+    count_cache_stat('misses')
+
     # Check if CoinGecko has the symbol listed; if not return None
     coin_id = get_coin_id(symbol)
     if coin_id == None:
@@ -173,73 +309,182 @@ def get_historical_price(symbol: str, date: datetime):
         return None
 
     # Make throttled request to CoinGecko API
-    url = f"https://api.coingecko.com/api/v3/coins/{coin_id}/history?date={date.strftime('%d-%m-%Y')}&localization=false"
-
-    fetched = False
-    while not fetched:
-        print(
-            f"GET https://api.coingecko.com/api/v3/coins/{coin_id}/history?date={date.strftime('%d-%m-%Y')}", end=" => ")
-        response = requests.get(url)
-        if response.status_code == 200:
-            fetched = True
-            try:
-                # price = float(utils.get_nested_dict(
-                #     response.json(), 'market_data.current_price.usd'))
-                price = response.json()['market_data']['current_price']['usd']
-                save_historical_price(symbol, date, price)
-                print(f"200 OK")
-                time.sleep(3)
-                return price
-            except:
-                print(f"200 OK / ERROR: No price for {date} | {symbol}")
-                # print(response.json['market_data']['current_price'])
-                save_missing_price(symbol, date)
-                time.sleep(3)
-                return None
-        elif response.status_code == 429:
-            print(f"429 Too Many Requests / Sleeping for 60 seconds")
-            time.sleep(60)
-        elif response.status_code == 404:
-            print(f"404 Not Found")
+    url = f"{COINGECKO_API_URL}/api/v3/coins/{coin_id}/history?date={date.strftime('%d-%m-%Y')}&localization=false"
+
+    # Throttled by RATE_LIMITER; 429s and server errors are retried
+    print(
+        f"GET {COINGECKO_API_URL}/api/v3/coins/{coin_id}/history?date={date.strftime('%d-%m-%Y')}", end=" => ")
+    response = get_with_retry(SESSION, url, RATE_LIMITER, COINGECKO_RETRIES,
+                              COINGECKO_BACKOFF_SECONDS)
+    if response is None or response.status_code not in (200, 404):
+        # Not saved as missing so it is tried again next run; only a 404 or a
+        # 200 without a price means CoinGecko has no price
+        print(f"ERROR: Giving up on {date} | {symbol}")
+        count_cache_stat('gave_up')
+        return None
+    if response.status_code == 200:
+        try:
+            # price = float(utils.get_nested_dict(
+            #     response.json(), 'market_data.current_price.usd'))
+            price = response.json()['market_data']['current_price']['usd']
+            save_historical_price(symbol, date, price)
+            print(f"200 OK")
+            return price
+        except:
+            print(f"200 OK / ERROR: No price for {date} | {symbol}")
+            # print(response.json['market_data']['current_price'])
             save_missing_price(symbol, date)
-            time.sleep(3)
             return None
+    else:
+        print(f"404 Not Found")
+        save_missing_price(symbol, date)
+        return None
+
+
+def get_historical_price_range(symbol: str, dates: list):
+    """
+    Gets the prices of a symbol for a list of dates with a single
+    market_chart/range request and saves them to the cache.
+
+    CoinGecko returns hourly points for short ranges and daily points for
+    ranges over 90 days. For every date the point closest to 00:00 UTC is
+    used, which matches the price returned by /history. Dates without a
+    point are saved as missing.
+
+    Parameters:
+        symbol (str): ERC0-20 token symbol (i.e. ETH, CRV, CVX)
+        dates (list): Python datetime objects at 00:00 UTC
+
+    Returns:
+        dict: Price by date string (%Y-%m-%d)
+    """
+    start = min(dates)
+    end = max(dates)
+
+    coin_id = get_coin_id(symbol)
+    if coin_id == None:
+        print(f'No historical price for {start} - {end} | {symbol}')
+        return {}
+
+    # Pad by an hour so the midnight points at both ends are included
+    from_ts = int(start.timestamp()) - 3600
+    to_ts = int(end.timestamp()) + 3600
+    url = f"{COINGECKO_API_URL}/api/v3/coins/{coin_id}/market_chart/range?vs_currency=usd&from={from_ts}&to={to_ts}"
+
+    print(f"GET {url}", end=" => ")
+    response = get_with_retry(SESSION, url, RATE_LIMITER, COINGECKO_RETRIES,
+                              COINGECKO_BACKOFF_SECONDS)
+    if response is None:
+        print(f"ERROR: No response for {start} - {end} | {symbol}")
+        return {}
+    if response.status_code != 200:
+        print(f"ERROR: {response.status_code}")
+        print(response.text)
+        return {}
+    print(f"200 OK")
+
+    # Keep the point closest to midnight for every date
+    closest = {}
+    for (ms, price) in response.json().get('prices', []):
+        ts = ms / 1000
+        midnight = round(ts / 86400) * 86400
+        if midnight not in closest or \
+                abs(ts - midnight) < abs(closest[midnight][0] - midnight):
+            closest[midnight] = (ts, price)
+
+    prices = {}
+    for date in sorted(dates):
+        if int(date.timestamp()) in closest:
+            price = closest[int(date.timestamp())][1]
+            save_historical_price(symbol, date, price)
+            prices[date.strftime('%Y-%m-%d')] = price
         else:
-            print(f"ERROR: {response.status_code}")
-            print(response.text)
             save_missing_price(symbol, date)
-            time.sleep(3)
-            return None
 
+    return prices
 
-def clean_cache(file_path):
+
+def plan_historical_prices(dates):
     """
-    Maintenance function to clean up the PRICE_CACHE_FILE.
+    Plans how to fetch a list of dates for a single symbol.
 
-    Cleans cache by: 1) Removing duplicates, 2) Sorting
+    Dates are sorted and grouped into windows of at most
+    COINGECKO_RANGE_MAX_DAYS days. Dense windows with at least
+    COINGECKO_RANGE_MIN_DATES dates become one range call; the dates of
+    sparse windows are left for individual /history calls.
+
+    Returns:
+        tuple: List of date lists for range calls and list of point dates
     """
-    cache = []
-    if os.path.isfile(file_path):
-        with open(file_path, 'r') as f:
-            for line in f:
-                date, symbol, price, date_added, source = line.rstrip().split(',')
-                if [date, symbol] not in cache:
-                    cache.append([date, symbol, price, date_added, source])
-                else:
-                    print(
-                        f'ERROR: {file_path}: Discarding duplicate cache result for {date}|{symbol}|{price}|{source}')
-    cache.sort()
-    with open(file_path, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerows(cache)
+    ranges = []
+    points = []
+    window = []
+    for date in sorted(set(dates)):
+        if window and (date - window[0]).days >= COINGECKO_RANGE_MAX_DAYS:
+            if len(window) >= COINGECKO_RANGE_MIN_DATES:
+                ranges.append(window)
+            else:
+                points.extend(window)
+            window = []
+        window.append(date)
+    if len(window) >= COINGECKO_RANGE_MIN_DATES:
+        ranges.append(window)
+    else:
+        points.extend(window)
+    return ranges, points
 
 
-def clean_caches():
-    clean_cache(COINGECKO_CACHE_OUTPUT)
-    clean_cache(COINGECKO_MISSING_OUTPUT)
+def prefetch_historical_prices(price_requests, executor=None):
+    """
+    Fills the cache for many (symbol, date) requests using range calls
+    where the needed dates are dense enough.
 
+    Dates that are already cached are skipped. Dates left as point calls by
+    plan_historical_prices() are fetched later by get_historical_price().
+    The range calls are made by the executor, if one is given.
+    """
+    dates_by_symbol = {}
+    for (symbol, date) in price_requests:
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
+        if get_cached_historical_price(symbol, date) is None and \
+                not is_known_missing(symbol, date):
+            dates_by_symbol.setdefault(symbol, set()).add(date)
+
+    jobs = []
+    count_points = 0
+    count_dates = 0
+    for symbol, dates in dates_by_symbol.items():
+        ranges, points = plan_historical_prices(dates)
+        for range_dates in ranges:
+            jobs.append((symbol, range_dates))
+        count_points += len(points)
+        count_dates += len(dates)
+    count_ranges = len(jobs)
+
+    fetch = executor.map if executor is not None else map
+    list(fetch(lambda job: get_historical_price_range(*job), jobs))
+
+    print(f"- Planned {count_dates} CoinGecko dates as {count_ranges} range calls and {count_points} point calls")
+
+
+def clean_cache(file_path):
+    """
+    Maintenance function to clean up a cache file.
 
-clean_caches()
+    Cleans cache by: 1) Removing duplicates, keeping the first row of each
+    date and symbol like load_caches(), 2) Sorting. The file is only
+    rewritten if it changes.
+    """
+    dropped = compact_csv(file_path, key=lambda row: (row[0], row[1].lower()))
+    if dropped is not None:
+        print(f'{file_path}: Compacted, discarded {dropped} duplicate rows')
+
+
+def clean_caches():
+    """Compacts both cache files. Run with price.py --compact-caches."""
+    with CACHE_LOCK:
+        clean_cache(COINGECKO_CACHE_OUTPUT)
+        clean_cache(COINGECKO_MISSING_OUTPUT)
 
 
 if __name__ == '__main__':
@@ -14,10 +14,16 @@
 # X_FILE - Path to a file that will be used (and created, if needed)
 # X_CONFIG - A dict that will be used as a config
 # X - A variable that will be used directly (i.e. WALLETS)
+#
+# Values parsed from files are loaded lazily: each is registered with @lazy
+# and only loaded (once) the first time it is imported or accessed, so a stage
+# only pays for the files it uses and a missing file only stops the stages
+# that need it.
 
 import tomllib
 import os
 import sys
+import threading
 
 # CHECK AND MAKE OUTPUT DIRS
 #############################
@@ -33,6 +39,32 @@ if not os.path.isdir('output/work'):
 if not os.path.isdir('output/tax_hifo'):
     os.makedirs('output/tax_hifo')
 
+# LAZY LOADING
+#############################
+
+_LOADERS = {}
+_LOAD_LOCK = threading.RLock()
+
+
+def lazy(*names):
+    """Registers a loader returning a dict with a value for each of names."""
+    def register(loader):
+        for name in names:
+            _LOADERS[name] = loader
+        return loader
+    return register
+
+
+def __getattr__(name):
+    """Loads a lazy value on first access and keeps it as a module global."""
+    if name not in _LOADERS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _LOAD_LOCK:
+        if name not in globals():
+            globals().update(_LOADERS[name]())
+    return globals()[name]
+
+
 ###############################################################################
 # GENERAL CONFIGURATION OPTIONS
 ###############################################################################
@@ -40,8 +72,29 @@ if not os.path.isdir('output/tax_hifo'):
 # File that lists known stablecoins
 STABLECOINS_TOML = 'config/stablecoins.toml'
 
-with open(STABLECOINS_TOML, 'rb') as f:
-    STABLECOINS = tomllib.load(f)['STABLECOINS']
+
+# Set of lowercase stablecoin symbols
+@lazy('STABLECOINS')
+def load_stablecoins():
+    with open(STABLECOINS_TOML, 'rb') as f:
+        stablecoins = tomllib.load(f)['STABLECOINS']
+    return {'STABLECOINS': frozenset(s.lower() for s in stablecoins)}
+
+
+# Also write a typed columnar store (.npz) next to flatten.csv and price.csv.
+# Later stages load it instead of parsing the CSV while it is newer than the
+# CSV. It is encoded while flatten.csv is streamed out, but keeps 4-8 bytes
+# per cell in memory until it is written, so it is off by default and
+# flatten.py consolidates the wallets in constant memory.
+COLUMNAR_STORE = False
+
+###############################################################################
+# ALL.PY CONFIGURATION OPTIONS
+###############################################################################
+
+# Fingerprints of the inputs each stage last ran with. all.py only reruns the
+# stages whose inputs changed since, and the stages downstream of them.
+ALL_STATE_OUTPUT = 'output/cache/all_state.json'
 
 ###############################################################################
 # BUILD.PY CONFIGURATION OPTIONS
@@ -50,11 +103,15 @@ with open(STABLECOINS_TOML, 'rb') as f:
 # File that stores the wallet
 WALLETS_TOML = 'config/wallets.toml'
 
-if not os.path.isfile(WALLETS_TOML):
-    sys.exit("No wallet file was found.")
 
-with open(WALLETS_TOML, 'rb') as f:
-    WALLETS = tomllib.load(f)['WALLETS']
+@lazy('WALLETS')
+def load_wallets():
+    if not os.path.isfile(WALLETS_TOML):
+        sys.exit("No wallet file was found.")
+
+    with open(WALLETS_TOML, 'rb') as f:
+        return {'WALLETS': tomllib.load(f)['WALLETS']}
+
 
 # Directory for wallet output
 WALLETS_DIR = 'output/wallets'
@@ -63,11 +120,28 @@ if not os.path.isdir(WALLETS_DIR):
     print(f'Creating {WALLETS_DIR}')
     os.makedirs(WALLETS_DIR)
 
+# Number of wallets fetched concurrently by build.py and the global budget
+# of DeBank API requests per second shared by all of them. Failed calls (429,
+# 5xx) are retried with exponential backoff starting at
+# DEBANK_BACKOFF_SECONDS.
+DEBANK_MAX_WORKERS = 4
+DEBANK_REQUESTS_PER_SECOND = 5
+DEBANK_RETRIES = 3
+DEBANK_BACKOFF_SECONDS = 1
+
 DEBANK_FILE = 'config/debank.toml'
-with open(DEBANK_FILE, 'rb') as f:
-    debank_toml = tomllib.load(f)
-    DEBANK_ALLOW_LIST = debank_toml['DEBANK_ALLOW_LIST']
-    DEBANK_BLOCK_LIST = debank_toml['DEBANK_BLOCK_LIST']
+
+
+# Sets of chain:token_id keys, matched exactly as DeBank reports them
+@lazy('DEBANK_ALLOW_LIST', 'DEBANK_BLOCK_LIST')
+def load_debank_lists():
+    with open(DEBANK_FILE, 'rb') as f:
+        debank_toml = tomllib.load(f)
+    return {
+        'DEBANK_ALLOW_LIST': frozenset(debank_toml['DEBANK_ALLOW_LIST']),
+        'DEBANK_BLOCK_LIST': frozenset(debank_toml['DEBANK_BLOCK_LIST']),
+    }
+
 
 ###############################################################################
 # FLATTEN.PY CONFIGURATION OPTIONS
@@ -90,19 +164,43 @@ FLATTEN_SEND_TOKENS_OUTPUT = 'output/work/flatten_send_tokens.csv'
 FLATTEN_RECSEND_TOKENS_OUTPUT = 'output/work/flatten_recsend_tokens.csv'
 FLATTEN_NOWALLET_OUTPUT = 'output/work/flatten_nowallet.csv'
 
+# Hash of each wallet JSON when its CSV in FLATTEN_DIR was last written, so
+# flatten.py only flattens the wallets that changed. All wallets are
+# flattened again when the tags or DeBank lists change.
+FLATTEN_STATE_OUTPUT = 'output/cache/flatten_state.json'
+
 ###############################################################################
 # TXNS.PY CONFIGURATION OPTIONS
 ###############################################################################
 
 # File that stores many config options for txns
 TXNS_TOML = 'config/txns.toml'
-with open(TXNS_TOML, 'rb') as f:
-    TXNS_CONFIG = tomllib.load(f)
 
-# File that stores the manual txns overrides
-TXNS_MANUAL_TOML = 'config/txns_manual.toml'
-with open(TXNS_MANUAL_TOML, 'rb') as f:
-    TXNS_MANUAL_TOML = tomllib.load(f)
+
+# TXNS_CONFIG is all of TXNS_TOML. TXNS_EQUIVALENTS has the lowercased symbol
+# pairs from [consolidated_parser] equivalents as frozensets, so a swap
+# matches whichever way round its symbols are.
+@lazy('TXNS_CONFIG', 'TXNS_EQUIVALENTS')
+def load_txns_config():
+    with open(TXNS_TOML, 'rb') as f:
+        txns_config = tomllib.load(f)
+    return {
+        'TXNS_CONFIG': txns_config,
+        'TXNS_EQUIVALENTS': frozenset(
+            frozenset(s.lower() for s in pair)
+            for pair in txns_config['consolidated_parser']['equivalents']
+        ),
+    }
+
+
+# File that stores the manual txns overrides, loaded as TXNS_MANUAL_TOML
+TXNS_MANUAL_FILE = 'config/txns_manual.toml'
+
+
+@lazy('TXNS_MANUAL_TOML')
+def load_txns_manual():
+    with open(TXNS_MANUAL_FILE, 'rb') as f:
+        return {'TXNS_MANUAL_TOML': tomllib.load(f)}
 
 
 # Files to store txns.py work products
@@ -116,17 +214,26 @@ EMPTY_OUTPUT = 'output/work/txns_empty.csv'
 # Files to store key txns data
 TXNS_OUTPUT = 'output/txns.csv'
 
+# Parsed txns of the [reports] in TXNS_TOML. A report is only parsed again
+# when its size, mtime and content hash or its parser change.
+TXNS_REPORTS_CACHE_OUTPUT = 'output/cache/txns_reports.pickle'
+
 # Files for tagging
 TAGS_FILE = 'config/tags.toml'
 TAGS_LOCAL_FILE = 'config/tags_local.toml'
-with open(TAGS_FILE, 'rb') as f:
-    TAGS = tomllib.load(f)
+
+
+@lazy('TAGS')
+def load_tags():
+    with open(TAGS_FILE, 'rb') as f:
+        tags = tomllib.load(f)
 
     if os.path.exists(TAGS_LOCAL_FILE):
         with open(TAGS_LOCAL_FILE, 'rb') as g:
             local_tags = tomllib.load(g)
 
-        TAGS.update(local_tags)
+        tags.update(local_tags)
+    return {'TAGS': tags}
 
 ###############################################################################
 # PRICE.PY CONFIGURATION OPTIONS
@@ -143,6 +250,21 @@ PRICE_INFERRED_OUTPUT = 'output/work/price_inferred.csv'
 PRICE_MERGED_OUTPUT = 'output/work/price_merged.csv'
 PRICE_MISSING_OUTPUT = 'output/work/price_missing.csv'
 
+# How merge_inferred_prices() picks among several inferred prices for a
+# missing price: "first" (same date, first inferred), "median" (same date,
+# median of inferred) or "nearest" (closest in time for the same token, within
+# PRICE_INFERRED_NEAREST_SECONDS)
+PRICE_INFERRED_POLICY = 'first'
+PRICE_INFERRED_NEAREST_SECONDS = 86400
+
+# Request dates are rounded before any source is called so identical requests
+# collapse into one call. CoinGecko prices are daily. DefiLlama requests keep
+# the exact txn time unless PRICE_DEFILLAMA_BUCKET_SECONDS is set, which
+# buckets them to the start of that many seconds: fewer calls, but a price up
+# to a bucket earlier than the txn (and so a different cost basis). Requests
+# already cached at the exact time still use that price.
+PRICE_DEFILLAMA_BUCKET_SECONDS = 0
+
 # Key output for price.py main file
 PRICE_OUTPUT = 'output/price.csv'
 
@@ -152,22 +274,52 @@ PRICE_WORKSHEET_OUTPUT = 'output/price_worksheet.csv'
 # Key output for price.py to store the manual prices that were used
 PRICE_MANUAL_USED_OUTPUT = 'output/work/price_manual_used.csv'
 
+# Key output for price.py to store the manual prices that were never used
+PRICE_MANUAL_UNUSED_OUTPUT = 'output/work/price_manual_unused.csv'
+
 ###############################################################################
 # COINGECKO.PY CONFIGURATION OPTIONS
 ###############################################################################
 
 COINGECKO_COINS_LIST_FILE = 'data/coingecko_coins_list.json'
 
+# Symbol to coin ids index built from COINGECKO_COINS_LIST_FILE. It is rebuilt
+# whenever the coins list changes.
+COINGECKO_ID_INDEX_OUTPUT = 'output/cache/coingecko_id_index.pickle'
+
 # Dict to cache token symbols. Needed for tokens without symbols that can use
 # another token (i.e. WETH) and tokens with multiple matches.
 COINGECKO_TOML = 'config/coingecko.toml'
-with open(COINGECKO_TOML, 'rb') as f:
-    COINGECKO_ID_EXPLICIT = tomllib.load(f)['COINGECKO_ID_EXPLICIT']
+
+
+@lazy('COINGECKO_ID_EXPLICIT')
+def load_coingecko_ids():
+    with open(COINGECKO_TOML, 'rb') as f:
+        return {
+            'COINGECKO_ID_EXPLICIT': tomllib.load(f)['COINGECKO_ID_EXPLICIT']
+        }
+
 
 # Key output for coingecko.py cache files
 COINGECKO_CACHE_OUTPUT = 'output/cache/coingecko_cache.csv'
 COINGECKO_MISSING_OUTPUT = 'output/cache/coingecko_missing.csv'
 
+# Planner settings for fetching whole date ranges with market_chart/range.
+# Needed dates of a symbol are grouped into windows of at most
+# COINGECKO_RANGE_MAX_DAYS and a window with at least COINGECKO_RANGE_MIN_DATES
+# dates is fetched with a single range call instead of one call per date.
+COINGECKO_RANGE_MAX_DAYS = 365
+COINGECKO_RANGE_MIN_DATES = 3
+
+# Worker pool, request budget and retry policy for CoinGecko calls made by
+# price.py. The free API allows about one call every 3 seconds and a
+# rate-limited (429) call is retried after 60, 120 and 240 seconds.
+COINGECKO_MAX_WORKERS = 1
+COINGECKO_REQUESTS_PER_SECOND = 1 / 3
+COINGECKO_BURST = 1
+COINGECKO_RETRIES = 3
+COINGECKO_BACKOFF_SECONDS = 60
+
 ###############################################################################
 # DEFILLAMA.PY CONFIGURATION OPTIONS
 ###############################################################################
@@ -176,6 +328,18 @@ COINGECKO_MISSING_OUTPUT = 'output/cache/coingecko_missing.csv'
 DEFILLAMA_CACHE_OUTPUT = 'output/cache/defillama_cache.csv'
 DEFILLAMA_MISSING_OUTPUT = 'output/cache/defillama_missing.csv'
 
+# Max number of coins requested in a single historical prices call
+DEFILLAMA_BATCH_SIZE = 50
+
+# Worker pool, request budget and retry policy for DefiLlama calls made by
+# price.py. Failed calls (429, 5xx) are retried with exponential backoff
+# starting at DEFILLAMA_BACKOFF_SECONDS.
+DEFILLAMA_MAX_WORKERS = 4
+DEFILLAMA_REQUESTS_PER_SECOND = 5
+DEFILLAMA_BURST = 5
+DEFILLAMA_RETRIES = 3
+DEFILLAMA_BACKOFF_SECONDS = 1
+
 ###############################################################################
 # PF.PY CONFIGURATION OPTIONS
 ###############################################################################
@@ -1 +1 @@
-from .debank import fetch_all_history, load_history, FLAT_HEADERS
\ No newline at end of file
+from .debank import fetch_all_history, fetch_all_histories, load_history, FLAT_HEADERS
\ No newline at end of file
@@ -1,32 +1,45 @@
+import csv
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from dotenv import load_dotenv
-from utils import list_to_csv
+from utils import RateLimiter, get_with_retry
 
 from config import (
     DEBANK_ALLOW_LIST,
+    DEBANK_BACKOFF_SECONDS,
     DEBANK_BLOCK_LIST,
+    DEBANK_MAX_WORKERS,
+    DEBANK_REQUESTS_PER_SECOND,
+    DEBANK_RETRIES,
     FLATTEN_DIR,
     TAGS,
     # TAGS_FILE,
     WALLETS_DIR,
 )
 
-# Get the DEBANK_ACCESSKEY environment variable
-load_dotenv()
+# DEBANK_ACCESSKEY environment variable, read by get_accesskey() on the first
+# API request so offline stages (i.e. flatten.py) do not need it
+DEBANK_ACCESSKEY = None
 
-DEBANK_ACCESSKEY = os.getenv("DEBANK_ACCESSKEY")
-# Check if the environment variable is set
-if DEBANK_ACCESSKEY is not None:
-    print("DEBANK_ACCESSKEY:", DEBANK_ACCESSKEY)
-else:
-    sys.exit("Environment variable DEBANK_ACCESSKEY is not set")
+# Base URL of the DeBank Pro API; can be overridden to point at a stub server
+DEBANK_API_URL = os.getenv("DEBANK_API_URL", "https://pro-openapi.debank.com")
 
 # TAGS = tomllib.load(open(TAGS_FILE, 'rb'))
 
+# Shared connection pool and rate limit for all DeBank API requests
+SESSION = requests.Session()
+SESSION.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_maxsize=DEBANK_MAX_WORKERS)
+)
+SESSION.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_maxsize=DEBANK_MAX_WORKERS)
+)
+RATE_LIMITER = RateLimiter(DEBANK_REQUESTS_PER_SECOND)
+
 FLAT_HEADERS = [
     "number",
     "sub",
@@ -86,6 +99,10 @@ class HistoryList:
             self.data["history_list"] = []
         self.data["wallet_addr"] = wallet_addr
         self.data["chain_id"] = chain_id
+        # Index of entry ids for O(1) duplicate checks in add()
+        self.ids = set(x["id"] for x in self.data["history_list"])
+        # Number of history_list requests avoided by an incremental refresh
+        self.requests_saved = 0
 
     def max_time_at(self):
         """Max time of the history list"""
@@ -97,6 +114,20 @@ class HistoryList:
         min_entry = min(self.data["history_list"], key=lambda x: x["time_at"])
         return min_entry["time_at"]
 
+    def watermark(self):
+        """High-water mark of the history list
+
+        Returns a tuple of the max time_at and the set of ids at that time, or
+        (None, set()) if the history list is empty.
+        """
+        if self.len() == 0:
+            return (None, set())
+        max_time_at = self.max_time_at()
+        ids = set(
+            x["id"] for x in self.data["history_list"] if x["time_at"] == max_time_at
+        )
+        return (max_time_at, ids)
+
     def len(self):
         """Size of the history list"""
         return len(self.data["history_list"])
@@ -124,10 +155,10 @@ class HistoryList:
         self.data["token_dict"].update(hlraw["token_dict"])
 
         count = 0
-        current_ids = [x["id"] for x in self.data["history_list"]]
         for h in hlraw["history_list"]:
-            if not h["id"] in current_ids:
+            if not h["id"] in self.ids:
                 self.data["history_list"].append(h)
+                self.ids.add(h["id"])
                 count += 1
 
         self.data["history_list"].sort(key=lambda x: x["time_at"])
@@ -142,14 +173,22 @@ class HistoryList:
             json.dump(self.data, f)
 
     def write_flat_csv(self):
-        """Writes the HistoryList as a flattend CSV file"""
-        flat_hl = [FLAT_HEADERS]
+        """Writes the HistoryList as a flattend CSV file
+
+        Rows are streamed from iter_flat_rows() so the file is written once
+        and only one history entry is flattened in memory at a time.
+        """
+        with open(
+            f"{FLATTEN_DIR}/{self.get_wallet_addr()}-{self.get_chain_id()}.csv", "w"
+        ) as f:
+            writer = csv.writer(f)
+            writer.writerow(FLAT_HEADERS)
+            writer.writerows(self.iter_flat_rows())
+
+    def iter_flat_rows(self):
+        """Yields the flattened rows of every history entry in order"""
         for i in range(self.get_size()):
-            flat_hl.extend(self.get_history_entry_flat(i))
-            list_to_csv(
-                flat_hl,
-                f"{FLATTEN_DIR}/{self.get_wallet_addr()}-{self.get_chain_id()}.csv",
-            )
+            yield from self.get_history_entry_flat(i)
 
     def get_wallet_addr(self):
         return self.data["wallet_addr"]
@@ -363,11 +402,35 @@ def load_history(wallet_addr, chain_id) -> HistoryList:
     return hlr
 
 
+def get_accesskey():
+    """Returns DEBANK_ACCESSKEY, exiting if the variable is not set."""
+    global DEBANK_ACCESSKEY
+    if DEBANK_ACCESSKEY is None:
+        # Get the DEBANK_ACCESSKEY environment variable
+        load_dotenv()
+        accesskey = os.getenv("DEBANK_ACCESSKEY")
+        # Check if the environment variable is set
+        if accesskey is None:
+            sys.exit("Environment variable DEBANK_ACCESSKEY is not set")
+        print("DEBANK_ACCESSKEY:", accesskey)
+        DEBANK_ACCESSKEY = accesskey
+    return DEBANK_ACCESSKEY
+
+
 def fetch(url):
-    """Helper function for API HTTP request."""
+    """Helper function for API HTTP request.
 
-    headers = {"Accept": "application/json", "AccessKey": DEBANK_ACCESSKEY}
-    response = requests.get(url=url, headers=headers)
+    429s, server errors and connection errors are retried. Raises an
+    Exception if the request still fails.
+    """
+
+    headers = {"Accept": "application/json", "AccessKey": get_accesskey()}
+    response = get_with_retry(SESSION, url, RATE_LIMITER, DEBANK_RETRIES,
+                              DEBANK_BACKOFF_SECONDS, headers=headers)
+    if response is None:
+        raise Exception(f"No response for {url}")
+    if response.status_code != 200:
+        raise Exception(f"{response.status_code} for {url}: {response.text}")
     return response
 
 
@@ -379,7 +442,7 @@ def create_history_list_url(id, chain_id, start_time=None):
     """
 
     url = (
-        "https://pro-openapi.debank.com/v1/user/history_list?"
+        f"{DEBANK_API_URL}/v1/user/history_list?"
         f"id={id}&"
         f"chain_id={chain_id}"
     )
@@ -400,13 +463,20 @@ def fetch_history(id, chain_id, start_time=None):
     return hl
 
 
-def fetch_all_history(id, chain_id):
+def fetch_all_history(id, chain_id, incremental=True):
     """Fetches the full history from DeBank API for the wallet id.
 
     This function will keep calling the DeBank API until there are no more
-    entries left for the wallet id. If fn (a filename) is provided, the
+    entries left for the wallet id. If the wallet was previously stored, the
     function will first load the wallet, and then refresh the wallet with any
-    new entries since the minimum time_at entry.
+    new entries.
+
+    In incremental mode (the default), paging stops as soon as a page reaches
+    the high-water mark of the stored wallet (see HistoryList.watermark), so
+    known pages are not re-read. With incremental=False every page is fetched
+    until the API runs out of entries, which can backfill a partial wallet.
+    In both modes paging stops if a page would not move start_time back, i.e.
+    when more than a page of entries share one time_at.
     """
 
     try:
@@ -414,26 +484,87 @@ def fetch_all_history(id, chain_id):
     except FileNotFoundError:
         all_hl = HistoryList(id, chain_id)
 
+    (watermark_time, watermark_ids) = all_hl.watermark()
+    if not incremental:
+        watermark_time = None
+
     has_more = True
     start_time = None
     count = 0
+    saved = 0
 
     while has_more:
-        print(f"Fetch loop {count}")
+        print(f"{id}-{chain_id}: Fetch loop {count}")
         hl = fetch_history(id, chain_id, start_time)
         added = all_hl.add(hl)
         print(
-            f"All history: {all_hl.len()}. Fetched {hl.len()} history records. Added {added} records."
+            f"{id}-{chain_id}: All history: {all_hl.len()}. Fetched {hl.len()} history records. Added {added} records."
         )
-        if hl.len() < 20 or added == 0:
+        if hl.len() < 20:
+            has_more = False
+        elif watermark_time is not None and (
+            hl.min_time_at() < watermark_time
+            or (
+                hl.min_time_at() == watermark_time
+                and watermark_ids <= set(x["id"] for x in hl.history_list())
+            )
+        ):
+            print(f"{id}-{chain_id}: Reached stored history at {watermark_time}")
+            has_more = False
+            # Without the watermark, paging went on until a page added
+            # nothing, which costs one more request if this page added some
+            if added > 0:
+                saved = 1
+        elif incremental and added == 0:
+            has_more = False
+        elif start_time is not None and hl.min_time_at() >= start_time:
+            print(f"{id}-{chain_id}: WARN: Page did not go back past {start_time}, stopping")
             has_more = False
         else:
             start_time = hl.min_time_at()
         count += 1
 
+    # Each history_list call costs credits; compare to the previous stop rule
+    all_hl.requests_saved = saved
+    print(
+        f"{id}-{chain_id}: Made {count} requests. Saved {all_hl.requests_saved} requests."
+    )
+
     return all_hl
 
 
+def fetch_all_histories(wallets, max_workers=DEBANK_MAX_WORKERS, incremental=True):
+    """Fetches the full history of several wallets concurrently.
+
+    Each (id, chain_id) pair in wallets is handed to fetch_all_history() on a
+    pool of max_workers threads. All threads share SESSION and RATE_LIMITER,
+    so the overall request rate stays within DEBANK_REQUESTS_PER_SECOND.
+    Yields the HistoryList of each wallet in the order of wallets.
+
+    A wallet that fails does not stop the others: the wallets fetched
+    successfully are all yielded, and then an Exception listing the failed
+    wallets is raised.
+    """
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(fetch_all_history, wallet[0], wallet[1], incremental)
+            for wallet in wallets
+        ]
+        for (wallet, future) in zip(wallets, futures):
+            try:
+                hl = future.result()
+            except Exception as e:
+                print(f"{wallet[0]}-{wallet[1]}: ERROR: {e}")
+                failed.append(f"{wallet[0]}-{wallet[1]}")
+                continue
+            yield hl
+
+    if failed:
+        raise Exception(f"Failed to fetch {len(failed)} wallets: {', '.join(failed)}")
+
+
 def get_tag(id):
     # TODO Need to adjust to be sensitive to chain
     # TODO Need to adjust tags.toml file too
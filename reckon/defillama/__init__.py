@@ -1 +1 @@
-from .defillama import get_price, get_date_from_timestamp, get_timestamp_from_date
\ No newline at end of file
+from .defillama import get_price, prefetch_prices, check_cache, get_failed_count, get_date_from_timestamp, get_timestamp_from_date, clean_caches
\ No newline at end of file
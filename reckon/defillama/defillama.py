@@ -1,15 +1,46 @@
-from config import DEFILLAMA_CACHE_OUTPUT, DEFILLAMA_MISSING_OUTPUT
+from config import (
+    DEFILLAMA_BACKOFF_SECONDS,
+    DEFILLAMA_BATCH_SIZE,
+    DEFILLAMA_BURST,
+    DEFILLAMA_CACHE_OUTPUT,
+    DEFILLAMA_MAX_WORKERS,
+    DEFILLAMA_MISSING_OUTPUT,
+    DEFILLAMA_REQUESTS_PER_SECOND,
+    DEFILLAMA_RETRIES,
+)
 from datetime import datetime, timezone
+from utils import RateLimiter, compact_csv, get_with_retry
 import csv
 import os
 import requests
 import sys
+import threading
 
 
-PRICE_CACHE = []
-MISSING_CACHE = []
+# Cached prices keyed by cache_key() and the set of keys known to be missing.
+# Both are loaded from the CSV files on first use by load_caches() and
+# appended to on save.
+PRICE_CACHE = None
+MISSING_CACHE = None
 HEADERS = ["date", "chain", "symbol", "token_id", "price"]
 
+# Base URL of the DefiLlama coins API; can be overridden to point at a stub
+DEFILLAMA_API_URL = os.getenv("DEFILLAMA_API_URL", "https://coins.llama.fi")
+
+# Shared connection pool, rate limit and cache lock for the DefiLlama workers
+SESSION = requests.Session()
+SESSION.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_maxsize=DEFILLAMA_MAX_WORKERS)
+)
+SESSION.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_maxsize=DEFILLAMA_MAX_WORKERS)
+)
+RATE_LIMITER = RateLimiter(DEFILLAMA_REQUESTS_PER_SECOND, DEFILLAMA_BURST)
+CACHE_LOCK = threading.Lock()
+
+# Number of get_price() requests that got no answer and were not cached
+FAILED_COUNT = 0
+
 
 def get_timestamp_from_date(date_str, date_format="%Y-%m-%d %H:%M:%S"):
     """Convert a date string (it assumes UTC) to a timestamp."""
@@ -27,74 +58,78 @@ def get_date_from_timestamp(timestamp, date_format="%Y-%m-%d %H:%M:%S"):
     return date_str
 
 
+def cache_key(date, chain, symbol, token_id):
+    """Key used by the caches. The symbol is informational and not matched."""
+    return (date, chain, token_id)
+
+
+def load_caches():
+    """
+    Loads DEFILLAMA_CACHE_OUTPUT and DEFILLAMA_MISSING_OUTPUT into
+    PRICE_CACHE and MISSING_CACHE if they have not been loaded yet.
+    """
+    global PRICE_CACHE, MISSING_CACHE
+    if PRICE_CACHE is not None:
+        return
+
+    with CACHE_LOCK:
+        if PRICE_CACHE is not None:
+            return
+
+        price_cache = {}
+        for row in load_cache(DEFILLAMA_CACHE_OUTPUT):
+            price_cache.setdefault(cache_key(*row[:4]), row[4])
+
+        MISSING_CACHE = set()
+        for row in load_cache(DEFILLAMA_MISSING_OUTPUT):
+            MISSING_CACHE.add(cache_key(*row[:4]))
+
+        # Set last so other threads never see a partly loaded cache
+        PRICE_CACHE = price_cache
+
+
 def check_cache(date, chain, symbol, token_id):
     """Check the cache for a price."""
-    for price in PRICE_CACHE:
-        if price[0] == date and \
-            price[1] == chain and \
-            price[3] == token_id:
-            return price[4]
-    return None
+    load_caches()
+    return PRICE_CACHE.get(cache_key(date, chain, symbol, token_id))
 
 
 def is_known_missing(date, chain, symbol, token_id) -> bool:
     """Check the missing cache for a price."""
-    for price in MISSING_CACHE:
-        if price[0] == date and \
-            price[1] == chain and \
-            price[3] == token_id:
-            return True
-    return False
+    load_caches()
+    return cache_key(date, chain, symbol, token_id) in MISSING_CACHE
 
 
 def clean_cache(file_path):
-    with open(file_path, 'r') as f:
-        reader = csv.reader(f)
-        data = list(reader)
-    
-    # If the CSV has headers, separate them from the data
-    headers = data[0]
-    data = data[1:]
-    
-    # De-duplicate by converting to a set of tuples and then back to a list of lists
-    data = [list(item) for item in set(tuple(row) for row in data)]
-    
-    # Sort by date, chain, symbol, and token_id
-    data.sort(key=lambda x: (x[0], x[1], x[2], x[3]))
-    
-    # Write the sorted list back to the CSV file
-    with open(file_path, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(headers)  # Write the headers back
-        writer.writerows(data)
+    """
+    De-duplicate a cache file by cache_key(), keeping the first row of each
+    key like load_caches(), and sort it. The file is only rewritten if it
+    changes.
+    """
+    dropped = compact_csv(file_path, key=lambda row: cache_key(*row[:4]),
+                          header=True)
+    if dropped is not None:
+        print(f'{file_path}: Compacted, discarded {dropped} duplicate rows')
 
 
 def save_cache(date, chain, symbol, token_id, price):
     """Save a price to the cache."""
-    PRICE_CACHE.append([
-        date,
-        chain,
-        symbol,
-        token_id,
-        price
-    ])
-    with open(DEFILLAMA_CACHE_OUTPUT, "a", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(PRICE_CACHE[-1])
+    load_caches()
+    with CACHE_LOCK:
+        PRICE_CACHE[cache_key(date, chain, symbol, token_id)] = price
+        with open(DEFILLAMA_CACHE_OUTPUT, "a", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([date, chain, symbol, token_id, price])
 
 
 def save_missing(date, chain, symbol, token_id):
     """Save a missing price to the cache."""
-    MISSING_CACHE.append([
-        date,
-        chain,
-        symbol,
-        token_id,
-        ''
-    ])
-    with open(DEFILLAMA_MISSING_OUTPUT, "a", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow([date, chain, symbol, token_id, ''])
+    load_caches()
+    with CACHE_LOCK:
+        MISSING_CACHE.add(cache_key(date, chain, symbol, token_id))
+        with open(DEFILLAMA_MISSING_OUTPUT, "a", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([date, chain, symbol, token_id, ''])
 
 
 def get_price(date, chain, symbol, token_id):
@@ -110,53 +145,154 @@ def get_price(date, chain, symbol, token_id):
     if price is None and \
         not is_known_missing(date, chain, symbol, token_id):
 
-        price = _get_price(date, chain, symbol, token_id)
+        (answered, price) = _get_price(date, chain, symbol, token_id)
         if price is not None:
             save_cache(date, chain, symbol, token_id, price)
-        else:
+        elif answered:
             save_missing(date, chain, symbol, token_id)
+        else:
+            count_failed()
 
     return price
 
 
-def _get_price(date, chain, symbol, token_id):
+def count_failed():
+    global FAILED_COUNT
+    with CACHE_LOCK:
+        FAILED_COUNT += 1
+
+
+def get_failed_count():
+    """Returns the number of requests this run that will be tried again."""
+    with CACHE_LOCK:
+        return FAILED_COUNT
 
+
+def _get_price(date, chain, symbol, token_id):
+    """
+    Returns (answered, price). answered is False if the request got no
+    response or an error status, so the price is not saved as missing and is
+    tried again next run; it is True when DefiLlama answered, with the price
+    or None if it has no price for the coin.
+    """
     timestamp = get_timestamp_from_date(date)
-    url = f"https://coins.llama.fi/prices/historical/{timestamp}/{chain}:{token_id}"
+    url = f"{DEFILLAMA_API_URL}/prices/historical/{timestamp}/{chain}:{token_id}"
     print(f"GET {url} ({symbol})", end=" => ")
-    response = requests.get(url)
+    response = get_with_retry(SESSION, url, RATE_LIMITER, DEFILLAMA_RETRIES,
+                              DEFILLAMA_BACKOFF_SECONDS)
+    if response is None:
+        print(f"ERROR: No response for {date} {chain} {symbol} {token_id}")
+        return (False, None)
     if response.status_code != 200:
         print(f"ERROR: {response.status_code} for {date} {chain} {symbol} {token_id}")
         print(response.text)
-        return None
+        return (False, None)
     if "coins" in response.json():
         coins = response.json()["coins"]
         for k,v in coins.items():
             print(f"{response.status_code} / Price: {v['price']}")
-            return v["price"]
+            return (True, v["price"])
     print(f"{response.status_code} / No price found")
-    return None
+    return (True, None)
 
-if os.path.exists(DEFILLAMA_CACHE_OUTPUT):
-    clean_cache(DEFILLAMA_CACHE_OUTPUT)
-    with open(DEFILLAMA_CACHE_OUTPUT, "r") as f:
-        next(f)
-        reader = csv.reader(f)
-        for row in reader:
-            PRICE_CACHE.append(row)
-else:
-    with open(DEFILLAMA_CACHE_OUTPUT, "w") as f:
-        writer = csv.writer(f)
-        writer.writerow(HEADERS)
-
-if os.path.exists(DEFILLAMA_MISSING_OUTPUT):
-    clean_cache(DEFILLAMA_MISSING_OUTPUT)
-    with open(DEFILLAMA_MISSING_OUTPUT, "r") as f:
+
+def _get_prices(date, coins):
+    """
+    Get the prices of several "chain:token_id" coins at the same date with a
+    single request.
+
+    Returns a dict of lowercased coin to price, or None if the request failed.
+    """
+    timestamp = get_timestamp_from_date(date)
+    url = f"{DEFILLAMA_API_URL}/prices/historical/{timestamp}/{','.join(coins)}"
+    print(f"GET {DEFILLAMA_API_URL}/prices/historical/{timestamp} ({len(coins)} coins)", end=" => ")
+    response = get_with_retry(SESSION, url, RATE_LIMITER, DEFILLAMA_RETRIES,
+                              DEFILLAMA_BACKOFF_SECONDS)
+    if response is None:
+        print(f"ERROR: No response for {date}")
+        return None
+    if response.status_code != 200:
+        print(f"ERROR: {response.status_code} for {date}")
+        print(response.text)
+        return None
+    prices = {}
+    if "coins" in response.json():
+        for k, v in response.json()["coins"].items():
+            prices[k.lower()] = v["price"]
+    print(f"{response.status_code} / Found {len(prices)} prices")
+    return prices
+
+
+def prefetch_prices(price_requests, executor=None):
+    """
+    Fetch the uncached prices of many (date, chain, symbol, token_id) requests
+    in batches and save them to the caches.
+
+    Requests are grouped by date, so each DefiLlama call covers up to
+    DEFILLAMA_BATCH_SIZE coins at the same timestamp. Requests without a chain
+    or token_id are skipped, as are batches whose call fails; get_price() will
+    handle those one at a time as before. Only coins missing from a
+    successful answer are saved as missing. The batches are fetched by the
+    executor, if one is given.
+    """
+    batches = {}
+    for (date, chain, symbol, token_id) in price_requests:
+        if chain is None or token_id is None or token_id == '':
+            continue
+        if check_cache(date, chain, symbol, token_id) is not None or \
+                is_known_missing(date, chain, symbol, token_id):
+            continue
+        batches.setdefault(date, {})[f"{chain}:{token_id}"] = \
+            (chain, symbol, token_id)
+
+    count_coins = sum(len(coins) for coins in batches.values())
+    jobs = []
+    for date, coins in batches.items():
+        keys = list(coins.keys())
+        for i in range(0, len(keys), DEFILLAMA_BATCH_SIZE):
+            jobs.append((date, keys[i:i + DEFILLAMA_BATCH_SIZE]))
+
+    fetch = executor.map if executor is not None else map
+    for ((date, batch), prices) in zip(jobs, fetch(lambda job: _get_prices(*job), jobs)):
+        if prices is None:
+            continue
+        coins = batches[date]
+        for coin in batch:
+            (chain, symbol, token_id) = coins[coin]
+            price = prices.get(coin.lower())
+            if price is not None:
+                save_cache(date, chain, symbol, token_id, price)
+            else:
+                save_missing(date, chain, symbol, token_id)
+
+    print(f"- Prefetched {count_coins} DefiLlama prices in {len(jobs)} requests")
+
+
+def load_cache(file_path):
+    """
+    Load a cache CSV file as a list of rows, creating it if needed.
+
+    The file is only read; duplicates are left in place until clean_caches()
+    is run. The first row for a key wins.
+    """
+    if not os.path.exists(file_path):
+        with open(file_path, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADERS)
+        return []
+
+    with open(file_path, "r") as f:
         next(f)
         reader = csv.reader(f)
-        for row in reader:
-            MISSING_CACHE.append(row)
-else:
-    with open(DEFILLAMA_MISSING_OUTPUT, "w") as f:
-        writer = csv.writer(f)
-        writer.writerow(HEADERS)
+        return list(reader)
+
+
+def clean_caches():
+    """Compacts both cache files. Run with price.py --compact-caches."""
+    with CACHE_LOCK:
+        clean_cache(DEFILLAMA_CACHE_OUTPUT)
+        clean_cache(DEFILLAMA_MISSING_OUTPUT)
+
+
+if __name__ == '__main__':
+    clean_caches()
\ No newline at end of file
@@ -1,7 +1,15 @@
 import csv
+import hashlib
+import heapq
+import json
+import os
 from collections import defaultdict
-from debank import load_history
+import debank.debank
+from debank import FLAT_HEADERS, load_history
+from utils import ColumnWriter, file_hash, fingerprint, read_rows
 from config import (
+    COLUMNAR_STORE,
+    DEBANK_FILE,
     FLATTEN_OUTPUT,
     FLATTEN_PROJ_OUTPUT,
     FLATTEN_TXNAMES_OUTPUT,
@@ -11,41 +19,197 @@ from config import (
     FLATTEN_RECSEND_TOKENS_OUTPUT,
     FLATTEN_NOWALLET_OUTPUT,
     FLATTEN_DIR,
-    WALLETS
+    FLATTEN_STATE_OUTPUT,
+    TAGS_FILE,
+    TAGS_LOCAL_FILE,
+    WALLETS,
+    WALLETS_DIR,
 )
 
 
-def flatten_wallets():
+def flatten_dependencies():
+    """
+    Returns a hash of what a flattened wallet depends on besides its JSON:
+    the tags and DeBank allow/block lists, and debank.py, which flattens.
+    """
+    h = hashlib.sha256()
+    for path in [TAGS_FILE, TAGS_LOCAL_FILE, DEBANK_FILE, debank.debank.__file__]:
+        h.update(path.encode())
+        h.update(file_hash(path).encode() if os.path.isfile(path) else b'-')
+    return h.hexdigest()
+
+
+def load_flatten_state():
+    if os.path.isfile(FLATTEN_STATE_OUTPUT):
+        with open(FLATTEN_STATE_OUTPUT, 'r') as f:
+            return json.load(f)
+    return {}
+
 
+def save_flatten_state(state):
+    tmp_path = FLATTEN_STATE_OUTPUT + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, FLATTEN_STATE_OUTPUT)
+
+
+def flatten_wallets():
+    """
+    Writes the CSV of each wallet in FLATTEN_DIR, skipping the wallets whose
+    JSON hashes the same as when their CSV was written. Every wallet is
+    flattened again if flatten_dependencies() changed.
+    """
+    state = load_flatten_state()
+    dependencies = flatten_dependencies()
+    previous = state.get('wallets', {})
+    if state.get('dependencies') != dependencies:
+        if previous:
+            print('- Tags, DeBank lists or debank.py changed, flattening all wallets')
+        previous = {}
+
+    wallets = {}
+    skipped = 0
     for wallet in WALLETS:
         id = wallet[0]
         chain_id = wallet[1]
+        name = f'{id}-{chain_id}'
+        fp = fingerprint(f'{WALLETS_DIR}/{name}.json', previous.get(name))
+        if fp is not None and name in previous and \
+                fp[2] == previous[name][2] and \
+                os.path.isfile(f'{FLATTEN_DIR}/{name}.csv'):
+            wallets[name] = fp
+            skipped += 1
+            continue
+
         hl = load_history(id, chain_id)
         print(f'- Saving flattened {hl.get_wallet_addr()}-{hl.get_chain_id()}.csv')
         hl.write_flat_csv()
+        wallets[name] = fp
 
+    save_flatten_state({'dependencies': dependencies, 'wallets': wallets})
+    if skipped:
+        print(f'- Kept {skipped} unchanged flattened wallets')
 
-def consolidate_wallets():
-
-    headers = False
-    with open(FLATTEN_OUTPUT, 'w') as f:
-        for wallet in WALLETS:
-            with open(f'{FLATTEN_DIR}/{wallet[0]}-{wallet[1]}.csv', 'r') as wf:
-                if headers:
-                    next(wf)
-                else:
-                    headers = True
-                for line in wf:
-                    f.write(line)
 
+# Typed columns of the FLATTEN_OUTPUT columnar store. They are numbers in
+# the DeBank history, so read_rows() renders them back to the same text.
+FLATTEN_OUTPUT_TYPES = {
+    "number": "number",
+    "sub": "number",
+    "time_at": "number",
+    "receives.amount": "number",
+    "sends.amount": "number",
+    "tx.eth_gas_fee": "number",
+    "tx.usd_gas_fee": "number",
+    "tx.value": "number",
+}
 
-def write_project_txnames():
 
-    count_dict = defaultdict(int)
-    with open(FLATTEN_OUTPUT, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            count_dict[(row['project.name'], row['tx.name'])] += 1
+def consolidate_wallets():
+    """
+    Merges the per-wallet CSVs, each already sorted by time_at, into a single
+    FLATTEN_OUTPUT sorted by time_at. The files are streamed through
+    heapq.merge, which keeps wallets in config order for equal times so the
+    rows of a txn stay together. Only one row per wallet is held at a time;
+    the optional columnar store is encoded as the rows stream past and only
+    keeps their compact cells (see ColumnWriter), with the numeric columns
+    in FLATTEN_OUTPUT_TYPES stored as numbers.
+    """
+    files = [open(f'{FLATTEN_DIR}/{wallet[0]}-{wallet[1]}.csv', 'r', newline='')
+             for wallet in WALLETS]
+    try:
+        readers = [csv.reader(wf) for wf in files]
+        headers = None
+        for reader in readers:
+            headers = next(reader, headers)
+        if headers is None:
+            headers = FLAT_HEADERS
+        time_at = headers.index('time_at')
+
+        store = None
+        if COLUMNAR_STORE:
+            store = ColumnWriter(FLATTEN_OUTPUT, headers, FLATTEN_OUTPUT_TYPES)
+        with open(FLATTEN_OUTPUT, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(headers)
+            for row in heapq.merge(*readers, key=lambda row: float(row[time_at])):
+                writer.writerow(row)
+                if store is not None:
+                    store.add(row)
+    finally:
+        for wf in files:
+            wf.close()
+
+    # Written after the CSV is closed, so the store is newer
+    if store is not None:
+        store.close()
+
+
+class CountReducer:
+    """
+    Counts the rows of FLATTEN_OUTPUT by the values of key_columns, skipping
+    rows where any of required_columns is empty.
+    """
+
+    def __init__(self, key_columns, required_columns=()):
+        self.key_columns = key_columns
+        self.required_columns = required_columns
+        self.counts = defaultdict(int)
+
+    def begin(self, headers):
+        pass
+
+    def add(self, row):
+        for column in self.required_columns:
+            if row[column] == '':
+                return
+        self.counts[tuple(row[column] for column in self.key_columns)] += 1
+
+    def result(self):
+        return self.counts
+
+
+class FilterReducer:
+    """
+    Keeps the rows of FLATTEN_OUTPUT that match a predicate, along with the
+    headers to write them back out.
+    """
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+        self.headers = []
+        self.rows = []
+
+    def begin(self, headers):
+        self.headers = headers
+
+    def add(self, row):
+        if self.predicate(row):
+            self.rows.append(row)
+
+    def result(self):
+        return (self.rows, self.headers)
+
+
+def aggregate_flatten(reducers):
+    """
+    Feeds every row of FLATTEN_OUTPUT, as a dict, to each of the reducers in a
+    single scan.
+
+    A reducer has begin(headers), called before the scan, add(row) and
+    result(), which is what gets passed to the report writer. Rows are read
+    one at a time, like the DictReader passes this replaced.
+    """
+    (headers, rows) = read_rows(FLATTEN_OUTPUT)
+    for reducer in reducers:
+        reducer.begin(headers)
+    for values in rows:
+        row = dict(zip(headers, values))
+        for reducer in reducers:
+            reducer.add(row)
+
+
+def write_project_txnames(count_dict):
 
     # sorted_combinations = sorted(count_dict.items(), key=lambda x: x[1], reverse=True)
     sorted_combinations = sorted(count_dict.items(), key=lambda x: (x[0][0], x[0][1]))
@@ -57,36 +221,18 @@ def write_project_txnames():
             writer.writerow([project, tx, count])
 
 
-def write_txnames():
-
-    count_dict = defaultdict(int)
-    with open(FLATTEN_OUTPUT, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            count_dict[row['tx.name']] += 1
+def write_txnames(count_dict):
 
     sorted_combinations = sorted(count_dict.items(), key=lambda x: (x[1]), reverse=True)
 
     with open(FLATTEN_TXNAMES_OUTPUT, 'w', newline='') as file:
         writer = csv.writer(file)
         writer.writerow(['tx.name', 'count'])
-        for tx, count in sorted_combinations:
+        for (tx,), count in sorted_combinations:
             writer.writerow([tx, count])
 
 
-def write_receive_tokens():
-
-    count_dict = defaultdict(int)
-    with open(FLATTEN_OUTPUT, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['receives.token.symbol'] != '' and row['receives.token_id'] != '':
-                count_dict[(
-                    row['project.chain'],
-                    row['receives.token.symbol'],
-                    row['receives.token_id'],
-                    row['receives.token.is_verified']
-                )] += 1
+def write_receive_tokens(count_dict):
 
     sorted_combinations = sorted(count_dict.items(), key=lambda x: (x[0][0], x[0][1], x[0][2], x[0][3]))
 
@@ -114,20 +260,7 @@ def write_receive_tokens():
             ])
 
 
-def write_receive_tokens_toml():
-
-    count_dict = defaultdict(int)
-    with open(FLATTEN_OUTPUT, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['receives.token.symbol'] != '' and row['receives.token_id'] != '':
-                count_dict[(
-                    row['project.chain'],
-                    row['receives.token.symbol'],
-                    row['receives.token_id'],
-                    row['receives.token.is_verified'],
-                    row['spam']
-                )] += 1
+def write_receive_tokens_toml(count_dict):
 
     sorted_combinations = sorted(count_dict.items(), key=lambda x: (x[0][0], x[0][1], x[0][2], x[0][3], x[0][4]))
 
@@ -180,19 +313,7 @@ def write_receive_tokens_toml():
         file.write("]\n")
 
 
-def write_send_tokens():
-
-    count_dict = defaultdict(int)
-    with open(FLATTEN_OUTPUT, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['sends.token.symbol'] != '' and row['sends.token_id'] != '':
-                count_dict[(
-                    row['project.chain'],
-                    row['sends.token.symbol'],
-                    row['sends.token_id'],
-                    row['sends.token.is_verified']
-                )] += 1
+def write_send_tokens(count_dict):
 
     sorted_combinations = sorted(count_dict.items(), key=lambda x: (x[0][0], x[0][1], x[0][2], x[0][3]))
 
@@ -220,23 +341,7 @@ def write_send_tokens():
             ])
 
 
-def write_recsend_tokens():
-
-    count_dict = defaultdict(int)
-    with open(FLATTEN_OUTPUT, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['receives.token.symbol'] != '' and \
-            row['receives.token_id'] != '' and \
-            row['sends.token.symbol'] != '' and \
-            row['sends.token_id'] != '':
-                count_dict[(
-                    row['project.chain'],
-                    row['receives.token.symbol'],
-                    row['receives.token_id'],
-                    row['sends.token.symbol'],
-                    row['sends.token_id'],
-                )] += 1
+def write_recsend_tokens(count_dict):
 
     sorted_combinations = sorted(count_dict.items(), key=lambda x: (x[0][0], x[0][1], x[0][2], x[0][3], x[0][4]))
 
@@ -267,29 +372,83 @@ def write_recsend_tokens():
             ])
 
 
-def write_nowallet():
+def is_nowallet(row, wallet_addresses):
+    """True if the row matches no wallet on any of its address fields."""
+    return row['other_addr'].lower() not in wallet_addresses and \
+        row['receives.from_addr'].lower() not in wallet_addresses and \
+        row['sends.to_addr'].lower() not in wallet_addresses and \
+        row['tx.from_addr'].lower() not in wallet_addresses and \
+        row['tx.to_addr'].lower() not in wallet_addresses
 
-    # Filter the flattened file for rows with no wallet matches
-    wallet_addresses = set(wallet[0].lower() for wallet in WALLETS)
-    no_wallet_match_rows = []
-    with open(FLATTEN_OUTPUT, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['other_addr'].lower() not in wallet_addresses and \
-               row['receives.from_addr'].lower() not in wallet_addresses and \
-               row['sends.to_addr'].lower() not in wallet_addresses and \
-               row['tx.from_addr'].lower() not in wallet_addresses and \
-               row['tx.to_addr'].lower() not in wallet_addresses:
-
-                no_wallet_match_rows.append(row)
+
+def write_nowallet(no_wallet_match_rows, headers):
 
     with open(FLATTEN_NOWALLET_OUTPUT, 'w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=reader.fieldnames)
+        writer = csv.DictWriter(file, fieldnames=headers)
         writer.writeheader()
         for row in no_wallet_match_rows:
             writer.writerow(row)
 
 
+def flatten_reports():
+    """
+    Returns the (message, reducer, writer) of every work report built from
+    FLATTEN_OUTPUT. All reducers are fed by a single scan, so a new report only
+    needs an entry here. writer is called with reducer.result().
+    """
+    # Filter the flattened file for rows with no wallet matches
+    wallet_addresses = set(wallet[0].lower() for wallet in WALLETS)
+
+    return [
+        # Create a file with all project, txnames, and counts
+        (f'Writing project and txnames output to {FLATTEN_PROJ_OUTPUT}',
+         CountReducer(['project.name', 'tx.name']),
+         write_project_txnames),
+
+        # Create a file with all txnames and counts
+        (f'Writing txnames output to {FLATTEN_TXNAMES_OUTPUT}',
+         CountReducer(['tx.name']),
+         write_txnames),
+
+        # Create a file with chain, receives.token.symbol, receives.token_id, count
+        (f'Writing receive token names output to {FLATTEN_RECEIVE_TOKENS_OUTPUT}',
+         CountReducer(
+             ['project.chain', 'receives.token.symbol', 'receives.token_id',
+              'receives.token.is_verified'],
+             ['receives.token.symbol', 'receives.token_id']),
+         write_receive_tokens),
+
+        (f'Writing receive token names output to {FLATTEN_RECEIVE_TOKENS_TOML}',
+         CountReducer(
+             ['project.chain', 'receives.token.symbol', 'receives.token_id',
+              'receives.token.is_verified', 'spam'],
+             ['receives.token.symbol', 'receives.token_id']),
+         write_receive_tokens_toml),
+
+        # Create a file with chain, sends.token.symbol, sends.token_id, count
+        (f'Writing send token names output to {FLATTEN_SEND_TOKENS_OUTPUT}',
+         CountReducer(
+             ['project.chain', 'sends.token.symbol', 'sends.token_id',
+              'sends.token.is_verified'],
+             ['sends.token.symbol', 'sends.token_id']),
+         write_send_tokens),
+
+        # Create a file with chain, sends.token.symbol, sends.token_id, receives.token.symbol, receives.token_id, count
+        (f'Writing receive/send token pairs output to {FLATTEN_RECSEND_TOKENS_OUTPUT}',
+         CountReducer(
+             ['project.chain', 'receives.token.symbol', 'receives.token_id',
+              'sends.token.symbol', 'sends.token_id'],
+             ['receives.token.symbol', 'receives.token_id',
+              'sends.token.symbol', 'sends.token_id']),
+         write_recsend_tokens),
+
+        # Create a file where no wallet matches on other_addr, receives.from_addr, sends.to_addr, tx.from_addr
+        (f'Writing non-matching wallet entries to  {FLATTEN_NOWALLET_OUTPUT}',
+         FilterReducer(lambda row: is_nowallet(row, wallet_addresses)),
+         lambda result: write_nowallet(*result)),
+    ]
+
+
 def main():
 
     # Flatten the JSON from each wallet
@@ -300,36 +459,13 @@ def main():
     print(f'Consolidating flattened files to {FLATTEN_OUTPUT}')
     consolidate_wallets()
 
-    # Create a file with all project, txnames, and counts
-    print(f'Writing project and txnames output to {FLATTEN_PROJ_OUTPUT}')
-    write_project_txnames()
-
-    # Create a file with all txnames and counts
-    print(f'Writing txnames output to {FLATTEN_TXNAMES_OUTPUT}')
-    write_txnames()
-
-    # Create a file with chain, receives.token.symbol, receives.token_id, count
-    print(f'Writing receive token names output to {FLATTEN_RECEIVE_TOKENS_OUTPUT}')
-    write_receive_tokens()
-
-    print(f'Writing receive token names output to {FLATTEN_RECEIVE_TOKENS_TOML}')
-    write_receive_tokens_toml()
-
-    # Create a file with chain, sends.token.symbol, sends.token_id, count
-    print(f'Writing send token names output to {FLATTEN_SEND_TOKENS_OUTPUT}')
-    write_send_tokens()
-
-    # Create a file with chain, sends.token.symbol, sends.token_id, receives.token.symbol, receives.token_id, count
-    print(f'Writing receive/send token pairs output to {FLATTEN_RECSEND_TOKENS_OUTPUT}')
-    write_recsend_tokens()
-
-    # Create a file where no wallet matches on other_addr, receives.from_addr, sends.to_addr, tx.from_addr
-    print(f'Writing non-matching wallet entries to  {FLATTEN_NOWALLET_OUTPUT}')
-    # Print out all wallet addresses
-    # print('Wallet addresses:')
-    # for wallet in WALLETS:
-    #     print(f'- {wallet[0]}')
-    write_nowallet()
+    # Build every work report from a single scan of the consolidated file
+    print(f'Scanning {FLATTEN_OUTPUT} for work reports')
+    reports = flatten_reports()
+    aggregate_flatten([reducer for (_, reducer, _) in reports])
+    for (message, reducer, writer) in reports:
+        print(message)
+        writer(reducer.result())
 
 
 if __name__ == '__main__':
@@ -1,5 +1,5 @@
 import pandas as pd
-from utils import list_to_csv
+from utils import list_to_csv, load_columns
 from config import PRICE_OUTPUT, PF_OUTPUT
 
 def main():
@@ -7,7 +7,17 @@ def main():
     Quick implementation of a rudimentary portfolio view.
     """
 
-    df = pd.read_csv(PRICE_OUTPUT)
+    columns = load_columns(PRICE_OUTPUT)
+    if columns is not None:
+        # Typed columnar store; match read_csv with NA for empty strings
+        df = pd.DataFrame(columns).replace('', pd.NA)
+        df['date'] = pd.to_datetime(df['date'], unit='s')
+    else:
+        # Correctly rounded floats, as in the store, and only empty values as
+        # NA, so symbols like NA or None are kept and pf.csv is the same
+        # whichever one is read
+        df = pd.read_csv(PRICE_OUTPUT, float_precision='round_trip',
+                         keep_default_na=False, na_values=[''])
     df = df.astype({
         'date': 'datetime64[ns]',
         'txn_type': 'string',
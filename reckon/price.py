@@ -1,13 +1,26 @@
+import argparse
+import bisect
 import csv
 import defillama as dl
 import coingecko as cg
+import heapq
+import re
 import sys
 import tomllib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from utils import write_columns
 from config import (
+    COINGECKO_MAX_WORKERS,
+    COLUMNAR_STORE,
+    DEFILLAMA_MAX_WORKERS,
     PRICE_CONFIG,
+    PRICE_DEFILLAMA_BUCKET_SECONDS,
+    PRICE_INFERRED_NEAREST_SECONDS,
     PRICE_INFERRED_OUTPUT,
+    PRICE_INFERRED_POLICY,
     PRICE_MANUAL_FILE,
+    PRICE_MANUAL_UNUSED_OUTPUT,
     PRICE_MANUAL_USED_OUTPUT,
     PRICE_MERGED_OUTPUT,
     PRICE_MISSING_OUTPUT,
@@ -22,12 +35,19 @@ from config import (
 
 class PriceRule:
 
+    # A pattern with this prefix is compiled as a regex, anything else is
+    # compared as a case insensitive literal (i.e. USD+ or $X)
+    REGEX_PREFIX = 're:'
+
 
     def __init__(self, entry):
 
         self.chain = entry['chain'] if 'chain' in entry else '*'
         self.symbol = entry['symbol'] if 'symbol' in entry else '*'
         self.token_id = entry['token_id'] if 'token_id' in entry else '*'
+        self.chain_pattern = self._compile_pattern(self.chain)
+        self.symbol_pattern = self._compile_pattern(self.symbol)
+        self.token_id_pattern = self._compile_pattern(self.token_id)
         self.action = entry['action'] if 'action' in entry else 'defillama'
         self.params = {k: v for k, v in entry.items() if k not in [
             "symbol",
@@ -41,16 +61,31 @@ class PriceRule:
         return f"{self.__class__.__name__}({self.chain}, {self.symbol}, {self.token_id}, {self.action}, {self.params})"
 
 
-    def _matches_pattern(self, pattern, value):
+    def _compile_pattern(self, pattern):
+        """
+        Returns None for a wildcard, the lowercased pattern for a literal or
+        a compiled case insensitive regex for a pattern starting with
+        REGEX_PREFIX.
+        """
         if pattern is None or pattern == "*":
+            return None
+        if pattern.startswith(self.REGEX_PREFIX):
+            return re.compile(pattern[len(self.REGEX_PREFIX):], re.IGNORECASE)
+        return pattern.lower()
+
+
+    def _matches_pattern(self, pattern, value):
+        if pattern is None:
             return True
-        return pattern.lower() == value.lower()
+        if isinstance(pattern, str):
+            return pattern == value
+        return pattern.fullmatch(value) is not None
 
 
     def match(self, chain, symbol, token_id):
-        return (self._matches_pattern(self.chain, chain) and
-                self._matches_pattern(self.symbol, symbol) and
-                self._matches_pattern(self.token_id, token_id))
+        return (self._matches_pattern(self.chain_pattern, chain.lower()) and
+                self._matches_pattern(self.symbol_pattern, symbol.lower()) and
+                self._matches_pattern(self.token_id_pattern, token_id.lower()))
 
 
     def get_info(self, chain, symbol, token_id):
@@ -65,6 +100,14 @@ class PriceRule:
         return (chain, symbol, token_id)
 
 
+    def round_date(self, date, chain, symbol, token_id):
+        """
+        Returns the date prices are requested at, so requests that round to
+        the same date share a single lookup.
+        """
+        return date
+
+
     def get_price(self, date, chain, symbol, token_id):
         print(f"WARN: Using default price rule for {date} {chain} {symbol} {token_id}")
         return (chain, symbol, token_id, None, None)
@@ -77,6 +120,19 @@ class PriceRule:
 class CoinGeckoPriceRule(PriceRule):
 
 
+    def round_date(self, date, chain, symbol, token_id):
+        # Coingecko prices are daily
+        return date[:10] + " 00:00:00"
+
+    def get_request(self, date, chain, symbol, token_id):
+        """
+        Returns the (symbol, date) that get_price() will request from
+        coingecko.
+        """
+        date_obj = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        return (symbol, date_obj.replace(tzinfo=timezone.utc))
+
+
     def get_price(self, date, chain, symbol, token_id): # type: ignore
         source = "coingecko"
         date_obj = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
@@ -89,28 +145,42 @@ class CoinGeckoPriceRule(PriceRule):
 
 class DefiLlamaPriceRule(PriceRule):
 
+    # Map chain names to defillama API
+    CHAINS = {
+        'eth': 'ethereum',
+        'ftm': 'fantom',
+        'arb': 'arbitrum',
+        'avax': 'avax',
+    }
+
+
+    def round_date(self, date, chain, symbol, token_id):
+        if not PRICE_DEFILLAMA_BUCKET_SECONDS:
+            return date
+        # A price already cached at the exact time is kept over the bucket's
+        if dl.check_cache(*self.get_request(date, chain, symbol, token_id)) is not None:
+            return date
+        timestamp = dl.get_timestamp_from_date(date)
+        return dl.get_date_from_timestamp(
+            timestamp - timestamp % PRICE_DEFILLAMA_BUCKET_SECONDS)
+
+    def get_request(self, date, chain, symbol, token_id):
+        """
+        Returns the (date, chain, symbol, token_id) that get_price() will
+        request from defillama.
+        """
+        (chain, symbol, token_id) = self.get_info(chain, symbol, token_id)
+        return (date, self.CHAINS.get(chain.lower()), symbol, token_id)
+
+
     def get_price(self, date, chain, symbol, token_id): # type: ignore
         source = "defillama"
 
         # Look up any params and use them
-        if 'map_chain_to' in self.params:
-            chain = self.params['map_chain_to']
-        if 'map_symbol_to' in self.params:
-            symbol = self.params['map_symbol_to']
-        if 'map_token_id_to' in self.params:
-            token_id = self.params['map_token_id_to']
+        (chain, symbol, token_id) = self.get_info(chain, symbol, token_id)
 
-        # Map chain names to defillama API
-        dl_chain = None
-        if chain.lower() == 'eth':
-            dl_chain = 'ethereum'
-        elif chain.lower() == 'ftm':
-            dl_chain = 'fantom'
-        elif chain.lower() == 'arb':
-            dl_chain = 'arbitrum'
-        elif chain.lower() == 'avax':
-            dl_chain = 'avax'
-        else:
+        dl_chain = self.CHAINS.get(chain.lower())
+        if dl_chain is None:
             print(
                 f"WARN: No chain mapping for {date} {chain} {symbol} {token_id}")
             source += " / no chain mapping"
@@ -152,51 +222,181 @@ class PriceRulesConfig:
                 print(f"- {rule}")
                 self.rules.append(rule)
 
+        # Positions of the rules with a literal symbol, indexed by symbol, and
+        # of the rules whose symbol is a wildcard or regex. find_rule() only
+        # tries these two lists, merged back into config order.
+        self.symbol_index = {}
+        self.fallback = []
+        for i, rule in enumerate(self.rules):
+            if isinstance(rule.symbol_pattern, str):
+                self.symbol_index.setdefault(rule.symbol_pattern, []).append(i)
+            else:
+                self.fallback.append(i)
+
+        # find_rule() results keyed by lowercased (chain, symbol, token_id)
+        self.matches = {}
+
 
     def find_rule(self, chain, symbol, token_id):
-        for rule in self.rules:
-            if rule.match(chain, symbol, token_id):
-                return rule
-        return None
+        key = (chain.lower(), symbol.lower(), token_id.lower())
+        if key in self.matches:
+            return self.matches[key]
+
+        rule = None
+        candidates = heapq.merge(self.symbol_index.get(key[1], []), self.fallback)
+        for i in candidates:
+            if self.rules[i].match(*key):
+                rule = self.rules[i]
+                break
+        self.matches[key] = rule
+        return rule
+
+
+# Shared PriceRulesConfig so get_prices() and create_priced_txns() reuse the
+# same matches. Loaded on first use by get_price_rules_config().
+PRICE_RULES_CONFIG = None
+
+
+def get_price_rules_config():
+    global PRICE_RULES_CONFIG
+    if PRICE_RULES_CONFIG is None:
+        PRICE_RULES_CONFIG = PriceRulesConfig()
+    return PRICE_RULES_CONFIG
+
+
+PRICE_HEADERS = ["date", "chain", "symbol", "token_id", "price", "source"]
+
+PRICE_OUTPUT_HEADERS = [
+    "date",
+    "txn_type",
+    "qty",
+    "symbol",
+    "token_id",
+    "usd_value",
+    "purchase_token_cost",
+    "purchase_token",
+    "purchase_token_id",
+    "chain",
+    "project",
+    "txn_name",
+    "wallet",
+    "id",
+    "source",
+]
+
+# Typed columns of the PRICE_OUTPUT columnar store
+PRICE_OUTPUT_TYPES = {
+    "date": "date",
+    "qty": "float",
+    "usd_value": "float",
+    "purchase_token_cost": "nullable_float",
+}
+
+
+def read_price_requests():
+    """
+    Yield the requests in TXNS_PRICE_REQ_OUTPUT.
+    """
+    with open(TXNS_PRICE_REQ_OUTPUT, "r") as csvfile:
+        next(csvfile)
+        reader = csv.reader(csvfile)
+        for row in reader:
+            yield row
 
 
-def reset_prices_file():
+def resolve_price_rules(price_reqs, price_rules_config):
     """
-    Reset the prices file to just the header.
+    Yield (req, rule) for every request whose price rule is not ignore.
     """
+    for req in price_reqs:
+        (date, chain, _, symbol, token_id) = req[:5]
+        rule = price_rules_config.find_rule(chain, symbol, token_id)
+        # print(f"- Match {date} {symbol} {token_id} => {rule}")
 
-    print("Resetting prices file...")
+        if rule.action == "ignore": # type: ignore
+            print(f"- INFO: Ignoring {date} {chain} {symbol} {token_id}")
+            continue
 
-    with open(PRICE_REQ_OUTPUT, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["date", "chain", "symbol",
-                        "token_id", "price", "source"])
+        yield (req, rule)
 
-    with open(PRICE_INFERRED_OUTPUT, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["date", "chain", "symbol",
-                        "token_id", "price", "source"])
+
+def fetch_source_prices(price_keys, prefetch, executor):
+    """
+    Prefetch and then look up the price keys of a single source with its own
+    executor. Returns the get_price() result of every key.
+    """
+    prefetch([rule.get_request(*key) for (key, rule) in price_keys], executor)
+    results = executor.map(
+        lambda key_rule: key_rule[1].get_price(*key_rule[0]), price_keys)
+    return dict(zip([key for (key, _) in price_keys], results))
 
 
-def get_prices():
+def fetch_prices(resolved):
     """
-    Get prices for tokens in TXNS_PRICE_REQ_OUTPUT and save to PRICE_REQ_OUTPUT.
+    Yield (req, price_row) for every resolved request, in request order.
+
+    Requests are first collapsed to unique price keys, i.e. the rounded date
+    (see PriceRule.round_date()) with the chain, symbol and token_id, which
+    also determine the rule. Each key is looked up once and the result is
+    expanded back to every request with its own date.
+
+    The defillama and coingecko keys are fetched at the same time by separate
+    worker pools, each prefetching its batches first so the get_price() calls
+    hit the cache. Rate limits and retries are handled by the source modules.
+    This is the one stage that has to see all of the requests before yielding.
     """
+    resolved = list(resolved)
+
+    # Price key of every request and the unique keys, in order of first
+    # request
+    req_keys = []
+    price_keys = {}
+    for (req, rule) in resolved:
+        (date, chain, _, symbol, token_id) = req[:5]
+        key = (rule.round_date(date, chain, symbol, token_id),
+               chain, symbol, token_id)
+        req_keys.append(key)
+        price_keys.setdefault(key, rule)
+
+    print(f"- Deduplicated {len(resolved)} price requests to {len(price_keys)} unique keys, avoiding {len(resolved) - len(price_keys)} source calls")
+
+    dl_keys = []
+    cg_keys = []
+    other_keys = []
+    for (key, rule) in price_keys.items():
+        if isinstance(rule, DefiLlamaPriceRule):
+            dl_keys.append((key, rule))
+        elif isinstance(rule, CoinGeckoPriceRule):
+            cg_keys.append((key, rule))
+        else:
+            other_keys.append((key, rule))
 
-    print("Getting prices...")
+    with ThreadPoolExecutor(DEFILLAMA_MAX_WORKERS) as dl_pool, \
+            ThreadPoolExecutor(COINGECKO_MAX_WORKERS) as cg_pool, \
+            ThreadPoolExecutor(2) as scheduler:
+        dl_prices = scheduler.submit(
+            fetch_source_prices, dl_keys, dl.prefetch_prices, dl_pool)
+        cg_prices = scheduler.submit(
+            fetch_source_prices, cg_keys, cg.prefetch_historical_prices, cg_pool)
 
-    price_rules_config = PriceRulesConfig()
+        prices = {}
+        for (key, rule) in other_keys:
+            prices[key] = rule.get_price(*key) # type: ignore
+        prices.update(dl_prices.result())
+        prices.update(cg_prices.result())
 
-    # Read in txns from TXNS_PRICE_REQ_OUTPUT
-    price_reqs = []
-    with open(TXNS_PRICE_REQ_OUTPUT, "r") as csvfile:
-        next(csvfile)
-        reader = csv.reader(csvfile)
-        for row in reader:
-            price_reqs.append(row)
+    for ((req, rule), key) in zip(resolved, req_keys):
+        (date, chain, _, symbol, token_id) = req[:5]
+        (chain, symbol, token_id, price, source) = prices[key]
+        yield (req, [date, chain, symbol, token_id, price, source])
 
-    # Iterate through txns and get price for each
-    for req in price_reqs:
+
+def infer_prices(fetched):
+    """
+    Yield (price_row, inferred_row) for every fetched price. inferred_row is
+    None unless the purchase token price can be inferred from it.
+    """
+    for (req, price_row) in fetched:
         (
             date,
             chain,
@@ -208,35 +408,10 @@ def get_prices():
             purchase_token,
             purchase_token_id,
         ) = req
-
-        # Let's try to get the price!
-        price = None
-        source = None
-
-        # Get the action for this token request based on the price rules config
-        rule = price_rules_config.find_rule(chain, symbol, token_id)
-        # print(f"- Match {date} {symbol} {token_id} => {rule}")
-
-        if rule.action == "ignore": # type: ignore
-            print(f"- INFO: Ignoring {date} {chain} {symbol} {token_id}")
-            continue
-
-        (chain, symbol, token_id, price, source) = rule.get_price(date, chain, symbol, token_id) # type: ignore
-
-        # Save price to file
-        with open(PRICE_REQ_OUTPUT, "a", newline="") as csvfile:
-
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                date,
-                chain,
-                symbol,
-                token_id,
-                price,
-                source
-            ])
+        (_, chain, _, _, price, _) = price_row
 
         # Infer prices if data is available and qquanitities are significant
+        inferred_row = None
         if price != None and \
                 not purchase_token.lower() in STABLECOINS and \
                 purchase_token != None and \
@@ -248,49 +423,188 @@ def get_prices():
 
             inferred_price = float(qty) * float(price) / \
                 float(purchase_token_cost)
-            with open(PRICE_INFERRED_OUTPUT, "a", newline="") as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow([
-                    date,
-                    chain,
-                    purchase_token,
-                    purchase_token_id,
-                    inferred_price,
-                    "inferred"
-                ])
+            inferred_row = [
+                date,
+                chain,
+                purchase_token,
+                purchase_token_id,
+                inferred_price,
+                "inferred"
+            ]
 
+        yield (price_row, inferred_row)
 
-# TODO SHould optimize this to be a global variable rather than reading the
-# file each time.
-def get_price(date, chain, symbol, token_id):
+
+def get_prices(keep_results=False):
+    """
+    Get prices for tokens in TXNS_PRICE_REQ_OUTPUT and save to PRICE_REQ_OUTPUT,
+    along with the prices inferred from them to PRICE_INFERRED_OUTPUT.
+
+    If keep_results is set, returns (price_rows, inferred_rows) so they can be
+    handed to merge_inferred_prices() without reading the files back.
+    """
+
+    print("Getting prices...")
+
+    price_rules_config = get_price_rules_config()
+
+    results = infer_prices(fetch_prices(resolve_price_rules(
+        read_price_requests(), price_rules_config)))
+
+    price_rows = []
+    inferred_rows = []
+    with open(PRICE_REQ_OUTPUT, "w", newline="") as price_file, \
+            open(PRICE_INFERRED_OUTPUT, "w", newline="") as inferred_file:
+        price_writer = csv.writer(price_file)
+        inferred_writer = csv.writer(inferred_file)
+        price_writer.writerow(PRICE_HEADERS)
+        inferred_writer.writerow(PRICE_HEADERS)
+
+        for (price_row, inferred_row) in results:
+            price_writer.writerow(price_row)
+            if inferred_row is not None:
+                inferred_writer.writerow(inferred_row)
+
+            if keep_results:
+                price_rows.append(price_row)
+                if inferred_row is not None:
+                    inferred_rows.append(inferred_row)
+
+    if keep_results:
+        return (price_rows, inferred_rows)
+
+
+# Index of PRICE_MERGED_OUTPUT keyed by the exact (date, chain, symbol,
+# token_id) of each row. Loaded on first use by get_price() and reset whenever
+# merge_inferred_prices() rewrites the file.
+MERGED_PRICES = None
+
+
+def price_key(date, chain, symbol, token_id):
     """
-    Get price for a single token using the PRICE_REQ_OUTPUT file.
+    (date, chain, symbol, token_id) tuple used to index the manual and
+    inferred prices. As in the scans it replaced, the date is matched exactly
+    and the other parts case insensitively.
+    """
+    return (date, chain.lower(), symbol.lower(), token_id.lower())
+
 
-    Note that assumes get_prices() has been run which creates the file based
-    on DefiLlama or Coingecko data.
+def load_merged_prices():
     """
+    Load PRICE_MERGED_OUTPUT into a dict keyed by the exact (date, chain,
+    symbol, token_id) of each row.
+
+    The first row for a key wins, matching the previous linear scan. Keys are
+    not normalized, so lookups match exactly like the scan did; token ids of
+    non-EVM chains are case-sensitive.
+    """
+    merged_prices = {}
     with open(PRICE_MERGED_OUTPUT, "r") as csvfile:
         next(csvfile)
         reader = csv.reader(csvfile)
         for row in reader:
-            if row[0] == date and row[1] == chain and row[2] == symbol and row[3] == token_id:
-                return row[4]
-    return None
+            key = tuple(row[:4])
+            if key not in merged_prices:
+                merged_prices[key] = row[4]
+    return merged_prices
+
+
+def get_price(date, chain, symbol, token_id):
+    """
+    Get price for a single token using the PRICE_MERGED_OUTPUT file.
+
+    Note that assumes get_prices() and merge_inferred_prices() have been run
+    which creates the file based on DefiLlama or Coingecko data. The file is
+    only read once and then served from MERGED_PRICES.
+    """
+    global MERGED_PRICES
+    if MERGED_PRICES is None:
+        MERGED_PRICES = load_merged_prices()
+    return MERGED_PRICES.get((date, chain, symbol, token_id))
+
+
+def load_inferred_prices(policy, inferred_rows=None):
+    """
+    Load PRICE_INFERRED_OUTPUT, or the given inferred_rows, and group it for
+    merge_inferred_prices().
+
+    For the "first" and "median" policies rows are grouped by price_key().
+    For the "nearest" policy rows are grouped by (chain, symbol, token_id)
+    and sorted by timestamp so the closest one can be found by bisection.
+    """
+    if inferred_rows is None:
+        with open(PRICE_INFERRED_OUTPUT, "r") as csvfile:
+            next(csvfile)
+            inferred_rows = list(csv.reader(csvfile))
+
+    inferred_prices = {}
+    for row in inferred_rows:
+        (date, chain, symbol, token_id, price, source) = row
+        key = price_key(date, chain, symbol, token_id)
+        if policy == "nearest":
+            inferred_prices.setdefault(key[1:], []).append(
+                (dl.get_timestamp_from_date(date), price, source))
+        else:
+            inferred_prices.setdefault(key, []).append((price, source))
+
+    if policy == "nearest":
+        for rows in inferred_prices.values():
+            rows.sort(key=lambda x: x[0])
+    return inferred_prices
+
+
+def pick_inferred_price(inferred_prices, policy, date, chain, symbol, token_id):
+    """
+    Pick the inferred (price, source) for a request, or None if there is none.
+
+    - first: the first inferred price with the same key
+    - median: the (low) median of the inferred prices with the same key
+    - nearest: the inferred price of the same token closest in time, within
+      PRICE_INFERRED_NEAREST_SECONDS of the request
+    """
+    key = price_key(date, chain, symbol, token_id)
+
+    if policy == "nearest":
+        rows = inferred_prices.get(key[1:])
+        if not rows:
+            return None
+        timestamp = dl.get_timestamp_from_date(date)
+        i = bisect.bisect_left(rows, timestamp, key=lambda x: x[0])
+        nearest = min(rows[max(i - 1, 0):i + 1],
+                      key=lambda x: abs(x[0] - timestamp))
+        if abs(nearest[0] - timestamp) > PRICE_INFERRED_NEAREST_SECONDS:
+            return None
+        return nearest[1:]
+
+    rows = inferred_prices.get(key)
+    if not rows:
+        return None
+    if policy == "median":
+        rows = sorted(rows, key=lambda x: float(x[0]))
+        return rows[(len(rows) - 1) // 2]
+    return rows[0]
 
 
-def merge_inferred_prices():
+def merge_inferred_prices(policy=PRICE_INFERRED_POLICY, price_rows=None,
+                          inferred_rows=None):
     """
     Merge inferred prices into requested prices.
 
-    Favor prices that were requested over inferred prices.
+    Favor prices that were requested over inferred prices. The policy picks
+    among several inferred prices for a request; see pick_inferred_price().
+
+    price_rows and inferred_rows, as returned by get_prices(keep_results=True),
+    are used instead of PRICE_REQ_OUTPUT and PRICE_INFERRED_OUTPUT if given.
     """
 
     print("Merging requested and inferred prices...")
 
+    if policy not in ["first", "median", "nearest"]:
+        print(f"WARN: Unknown inferred price policy {policy}")
+        sys.exit(1)
+
     # The txns_price_req.csv file with pricing information (incl. missing)
-    price_reqs = []
-    # The inferred prices from every txn that was missing a price
-    inferred_prices = []
+    price_reqs = price_rows
     # The merged prices with inferred prices replacing missing prices
     merged_prices = []
     # The missing prices that were not gotten from an api, inferred, or manual
@@ -300,17 +614,13 @@ def merge_inferred_prices():
     inferred_count = 0
     missing_count = 0
 
-    with open(PRICE_REQ_OUTPUT, "r") as csvfile:
-        next(csvfile)
-        reader = csv.reader(csvfile)
-        for row in reader:
-            price_reqs.append(row)
+    if price_reqs is None:
+        with open(PRICE_REQ_OUTPUT, "r") as csvfile:
+            next(csvfile)
+            price_reqs = list(csv.reader(csvfile))
 
-    with open(PRICE_INFERRED_OUTPUT, "r") as csvfile:
-        next(csvfile)
-        reader = csv.reader(csvfile)
-        for row in reader:
-            inferred_prices.append(row)
+    # The inferred prices from every txn that was missing a price
+    inferred_prices = load_inferred_prices(policy, inferred_rows)
 
     for req in price_reqs:
         (date,
@@ -322,29 +632,19 @@ def merge_inferred_prices():
          ) = req
         total_count += 1
         if "not found" in source:
-            for row in inferred_prices:
-                (inferred_date,
-                 inferred_chain,
-                 inferred_symbol,
-                 inferred_token_id,
-                 inferred_price,
-                 inferred_source
-                 ) = row
-                if inferred_date == date and \
-                        inferred_chain.lower() == chain.lower() and \
-                        inferred_symbol.lower() == symbol.lower() and \
-                        inferred_token_id.lower() == token_id.lower():
-
-                    inferred_count += 1
-                    merged_prices.append([
-                        date,
-                        chain,
-                        symbol,
-                        token_id,
-                        inferred_price,
-                        inferred_source,
-                    ])
-                    break
+            inferred = pick_inferred_price(
+                inferred_prices, policy, date, chain, symbol, token_id)
+            if inferred is not None:
+                (inferred_price, inferred_source) = inferred
+                inferred_count += 1
+                merged_prices.append([
+                    date,
+                    chain,
+                    symbol,
+                    token_id,
+                    inferred_price,
+                    inferred_source,
+                ])
 
             missing_count += 1
             missing_prices.append([
@@ -368,32 +668,33 @@ def merge_inferred_prices():
 
     with open(PRICE_MERGED_OUTPUT, "w", newline="") as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerow(["date", "chain", "symbol",
-                        "token_id", "price", "source"])
+        writer.writerow(PRICE_HEADERS)
         writer.writerows(merged_prices)
 
     with open(PRICE_MISSING_OUTPUT, "w", newline="") as csvfile:
         writer = csv.writer(csvfile)
-        writer.writerow(["date", "chain", "symbol",
-                        "token_id", "price", "source"])
+        writer.writerow(PRICE_HEADERS)
         writer.writerows(missing_prices)
 
+    # Force get_price() to reload the index from the new file
+    global MERGED_PRICES
+    MERGED_PRICES = None
+
     print(f"- Total: {total_count}")
     print(f"- Inferred: {inferred_count}")
     print(f"- Missing: {missing_count}")
 
 
-def create_priced_txns():
+def load_manual_prices():
     """
-    Create PRICE_OUTPUT based on buy, sell, income txns with pricing data.
-    """
-
-    print("Creating priced txns file...")
-
-    price_rules_config = PriceRulesConfig()
+    Load PRICE_MANUAL_FILE into a dict keyed by price_key().
 
-    # Read in manual prices
-    manual_prices = []
+    Each value is a dict with the manual price row and a count of the txns
+    that used it. Rows repeating the key of an earlier row can never be used
+    (the first row wins) and are returned in a separate list.
+    """
+    manual_prices = {}
+    duplicates = []
     with open(PRICE_MANUAL_FILE, "r") as csvfile:
         next(csvfile)
         reader = csv.reader(csvfile)
@@ -401,8 +702,27 @@ def create_priced_txns():
             # Check if the row (line) starts with a hash (#)
             if row[0].strip().startswith("#"):
                 continue
-            manual_prices.append(row)
+            (date, symbol, chain, token_id) = row[:4]
+            key = price_key(date, chain, symbol, token_id)
+            if key in manual_prices:
+                print(f"WARN: Duplicate manual price for {date} {chain} {symbol} {token_id}")
+                duplicates.append(row)
+            else:
+                manual_prices[key] = {'row': row, 'count': 0}
+    return (manual_prices, duplicates)
+
+
+def create_priced_txns():
+    """
+    Create PRICE_OUTPUT based on buy, sell, income txns with pricing data.
+    """
+
+    print("Creating priced txns file...")
+
+    price_rules_config = get_price_rules_config()
 
+    # Read in manual prices
+    (manual_prices, manual_duplicates) = load_manual_prices()
 
     with open(TXNS_OUTPUT, "r", newline="") as csvfile:
         count_total = 0
@@ -412,9 +732,6 @@ def create_priced_txns():
         count_dlcg = 0
         count_missing = 0
 
-        # List to store all manual prices used
-        manual_used_list = []
-
         price_txns = []
         headers = next(csvfile).strip().split(",")
         reader = csv.reader(csvfile)
@@ -442,9 +759,8 @@ def create_priced_txns():
             (chain, symbol, token_id) = rule.get_info(chain, symbol, token_id) # type: ignore
 
             # Handle manual prices
-            continue_outer_loop = False
-            for manual_price_row in manual_prices:
-                # print(manual_price_row)
+            manual_price_entry = manual_prices.get(price_key(date, chain, symbol, token_id))
+            if manual_price_entry is not None:
                 (
                     manual_date,
                     manual_symbol,
@@ -454,38 +770,31 @@ def create_priced_txns():
                     manual_price,
                     manual_txn_type,
                     manual_comment,
-                ) = manual_price_row
-                if manual_date == date and \
-                        manual_symbol.lower() == symbol.lower() and \
-                        manual_chain.lower() == chain.lower() and \
-                        manual_token_id.lower() == token_id.lower():
-                    print(f"- INFO: Using manual price for {date} {chain} {symbol} {token_id}")
-                    if manual_txn_type != None and manual_txn_type != '':
-                        print(f"-- INFO: Using manual txn type {manual_txn_type} for {id}")
-                        txn_type = manual_txn_type
-                    price_txns.append([
-                        date,
-                        txn_type,
-                        qty,
-                        symbol,
-                        token_id,
-                        float(manual_price) * float(qty),
-                        purchase_token_cost,
-                        purchase_token,
-                        purchase_token_id,
-                        chain,
-                        project,
-                        txn_name,
-                        wallet,
-                        id,
-                        f'manual / {manual_comment}',
-                    ])
-
-                    manual_used_list.append(manual_price_row)
-                    count_manual += 1
-                    continue_outer_loop = True
-                    break
-            if continue_outer_loop:
+                ) = manual_price_entry['row']
+                print(f"- INFO: Using manual price for {date} {chain} {symbol} {token_id}")
+                if manual_txn_type != None and manual_txn_type != '':
+                    print(f"-- INFO: Using manual txn type {manual_txn_type} for {id}")
+                    txn_type = manual_txn_type
+                price_txns.append([
+                    date,
+                    txn_type,
+                    qty,
+                    symbol,
+                    token_id,
+                    float(manual_price) * float(qty),
+                    purchase_token_cost,
+                    purchase_token,
+                    purchase_token_id,
+                    chain,
+                    project,
+                    txn_name,
+                    wallet,
+                    id,
+                    f'manual / {manual_comment}',
+                ])
+
+                manual_price_entry['count'] += 1
+                count_manual += 1
                 continue
 
             # Skip non-buy, sell, income txns
@@ -595,43 +904,40 @@ def create_priced_txns():
 
         with open(PRICE_OUTPUT, "w", newline="") as csvfile:
             writer = csv.writer(csvfile)
-            writer.writerow([
-                "date",
-                "txn_type",
-                "qty",
-                "symbol",
-                "token_id",
-                "usd_value",
-                "purchase_token_cost",
-                "purchase_token",
-                "purchase_token_id",
-                "chain",
-                "project",
-                "txn_name",
-                "wallet",
-                "id",
-                "source",
-            ])
+            writer.writerow(PRICE_OUTPUT_HEADERS)
             writer.writerows(price_txns)
+        if COLUMNAR_STORE:
+            write_columns(PRICE_OUTPUT, PRICE_OUTPUT_HEADERS, price_txns,
+                          PRICE_OUTPUT_TYPES)
 
         # Write out a file for the manual prices that were used
         # to help in finding unused manual prices
-        manual_used_list = list(set(tuple(item) for item in manual_used_list))
+        manual_used_list = [entry['row'] for entry in manual_prices.values()
+                            if entry['count'] > 0]
         manual_used_list = sorted(manual_used_list, key=lambda x: x[0])
+        manual_unused_list = [entry['row'] for entry in manual_prices.values()
+                              if entry['count'] == 0]
+        manual_unused_list = sorted(manual_unused_list + manual_duplicates,
+                                    key=lambda x: x[0])
 
-        with open(PRICE_MANUAL_USED_OUTPUT, "w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                "date",
-                "symbol",
-                "chain",
-                "token_id",
-                "timestamp",
-                "price",
-                "txn_type",
-                "comment",
-            ])
-            writer.writerows(manual_used_list)
+        print(f"- Manual prices used: {len(manual_used_list)}")
+        print(f"- Manual prices unused: {len(manual_unused_list)}")
+
+        for (file_path, rows) in [(PRICE_MANUAL_USED_OUTPUT, manual_used_list),
+                                  (PRICE_MANUAL_UNUSED_OUTPUT, manual_unused_list)]:
+            with open(file_path, "w", newline="") as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow([
+                    "date",
+                    "symbol",
+                    "chain",
+                    "token_id",
+                    "timestamp",
+                    "price",
+                    "txn_type",
+                    "comment",
+                ])
+                writer.writerows(rows)
 
 
 def create_worksheet():
@@ -673,14 +979,11 @@ def create_worksheet():
 
 def main():
 
-    # Reset the requested output and inferred prices files
-    reset_prices_file()
-
     # Request the prices using the requested prices file and also infer prices
-    get_prices()
+    (price_rows, inferred_rows) = get_prices(keep_results=True) # type: ignore
 
     # Merge the requested and inferred prices
-    merge_inferred_prices()
+    merge_inferred_prices(price_rows=price_rows, inferred_rows=inferred_rows)
 
     # With all of the pricing out of the way, create the priced transactions output
     create_priced_txns()
@@ -688,6 +991,46 @@ def main():
     # Create the worksheet for manual price entry
     create_worksheet()
 
+    # Report how well the coingecko cache served this run
+    cg_stats = cg.get_cache_stats()
+    print("CoinGecko cache:")
+    print(f"- Hits: {cg_stats['hits']}")
+    print(f"- Known missing: {cg_stats['known_missing']}")
+    print(f"- Misses: {cg_stats['misses']}")
+    print(f"Requests to try again next run: {transient_failures()}")
+
+
+def transient_failures():
+    """
+    Number of price requests this run that got no answer from DefiLlama or
+    CoinGecko. They are not saved as missing, so the next run retries them.
+    """
+    return dl.get_failed_count() + cg.get_cache_stats()['gave_up']
+
+
+def compact_caches():
+    """
+    De-duplicate and sort the DefiLlama and CoinGecko cache files.
+
+    Rewrites DEFILLAMA_CACHE_OUTPUT, DEFILLAMA_MISSING_OUTPUT,
+    COINGECKO_CACHE_OUTPUT and COINGECKO_MISSING_OUTPUT. Rows are
+    de-duplicated by the key each cache is loaded with, (date, chain,
+    token_id) for DefiLlama and (date, lowercased symbol) for CoinGecko,
+    keeping the first row of each key, which is the one the loaders use.
+    Each file is sorted and replaced atomically, and left untouched if it is
+    already compact. Run with price.py --compact-caches while no other
+    price.py is running.
+    """
+    dl.clean_caches()
+    cg.clean_caches()
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Price the txns in txns.csv")
+    parser.add_argument('--compact-caches', action='store_true',
+                        help='de-duplicate and sort the price caches and exit')
+    args = parser.parse_args()
+    if args.compact_caches:
+        compact_caches()
+    else:
+        main()
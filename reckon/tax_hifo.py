@@ -7,10 +7,12 @@ from config import (
     TAX_HIFO_DIR,
     TAX_HIFO_WARN_THRESHOLD,
 )
-from datetime import datetime
+from datetime import datetime, timezone
 import csv
+import heapq
 import re
 from typing import List, Dict, Any, Tuple
+from utils import load_columns
 
 
 def init_files() -> None:
@@ -39,7 +41,33 @@ def get_transactions() -> List[Dict[str, Any]]:
     """
     Read and parse transactions from CSV, converting data types at the source.
     Returns list of transactions with parsed dates and numbers.
+
+    The columnar store of PRICE_OUTPUT is used instead when it is fresh, as
+    its dates and numbers are already typed.
     """
+    columns = load_columns(PRICE_OUTPUT)
+    if columns is not None:
+        return [{
+            'date': datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None),
+            'qty': qty,
+            'usd_value': usd_value,
+            'symbol': symbol,
+            'symbol_normalized': symbol.lower(),
+            'txn_type': txn_type,
+            'chain': chain,
+            'id': id,
+            'token_id': token_id
+        } for (timestamp, qty, usd_value, symbol, txn_type, chain, id, token_id) in zip(
+            columns['date'],
+            columns['qty'],
+            columns['usd_value'],
+            columns['symbol'],
+            columns['txn_type'],
+            columns['chain'],
+            columns['id'],
+            columns['token_id'],
+        )]
+
     with open(PRICE_OUTPUT, 'r') as file:
         reader = csv.DictReader(file)
         transactions = []
@@ -65,45 +93,55 @@ def validate_remaining_transactions(buys: List[Dict[str, Any]]) -> None:
             print(f"WARNING: Found remaining transaction with non-positive quantity: {buy}")
 
 
-def calculate_buy_sell_pairs(transactions: List[Dict[str, Any]], target_symbol: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
-    """Calculate buy/sell pairs using HIFO method."""
-    # Debug: Print total quantities
-    total_buy_qty = sum(txn['qty'] for txn in transactions
-                       if txn['txn_type'] in ['buy', 'income']
-                       and txn['symbol_normalized'] == target_symbol.lower())
-    total_sell_qty = sum(txn['qty'] for txn in transactions
-                        if txn['txn_type'] == 'sell'
-                        and txn['symbol_normalized'] == target_symbol.lower())
-    print(f"Debug: {target_symbol} - Total Buy Qty: {total_buy_qty}, Total Sell Qty: {total_sell_qty}")
-
-    # Filter transactions by the target symbol
-    buys = [
-        txn for txn in transactions
-        if txn['txn_type'] in ['buy', 'income']
-        and txn['symbol_normalized'] == target_symbol.lower()
-    ]
-
-    sells = [
-        txn for txn in transactions
-        if txn['txn_type'] == 'sell'
-        and txn['symbol_normalized'] == target_symbol.lower()
-    ]
-
-    # Sort buys/incomes by unit value in descending order (HIFO)
-    buys.sort(key=lambda x: x['usd_value'] / x['qty'], reverse=True)
-
-    buy_sell_pairs = []
-
-    for sell in sells:
+def match_lots(transactions: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Match sells to buy/income lots using the HIFO method for all symbols.
+
+    Transactions are walked once in date order (price.csv is already sorted by
+    date). Open lots of each symbol are kept in a max-heap on unit cost, so a
+    sell consumes the highest cost lots bought on or before its date. At equal
+    dates, buys are added before sells are matched, and lots with equal unit
+    cost are consumed in transaction order. Lots are updated in place as they
+    are partially sold.
+
+    Returns a dict keyed by normalized symbol with the buy/sell pairs, the
+    unsold assets, the total buy and sell quantities and the income
+    transactions of the symbol, in the order of transactions.
+    """
+    results = {}
+    lots = {}
+
+    order = sorted(range(len(transactions)),
+                   key=lambda i: (transactions[i]['date'], transactions[i]['txn_type'] == 'sell'))
+
+    for i in order:
+        txn = transactions[i]
+        if txn['txn_type'] not in ['buy', 'income', 'sell']:
+            continue
+
+        symbol = txn['symbol_normalized']
+        if symbol not in results:
+            results[symbol] = {'pairs': [], 'unsold': [], 'buy_qty': 0,
+                               'sell_qty': 0, 'incomes': []}
+            lots[symbol] = []
+        result = results[symbol]
+        heap = lots[symbol]
+
+        if txn['txn_type'] in ['buy', 'income']:
+            if txn['txn_type'] == 'income':
+                result['incomes'].append(i)
+            result['buy_qty'] += txn['qty']
+            heapq.heappush(heap, (-(txn['usd_value'] / txn['qty']), i, txn))
+            continue
+
+        sell = txn
+        result['sell_qty'] += sell['qty']
         sell_qty = sell['qty']
         sell_unit_price = sell['usd_value'] / sell['qty']
         sell_date = sell['date']
 
-        # Filter out buys/incomes that happened after the sell date
-        valid_buys = [buy for buy in buys if buy['date'] <= sell['date']]
-
-        while sell_qty > 0 and valid_buys:
-            buy = valid_buys[0]
+        while sell_qty > 0 and heap:
+            buy = heap[0][2]
             buy_qty_available = buy['qty']
             buy_unit_price = buy['usd_value'] / buy['qty']
             buy_date = buy['date']
@@ -113,7 +151,7 @@ def calculate_buy_sell_pairs(transactions: List[Dict[str, Any]], target_symbol:
             gain_loss = (sold_qty * sell_unit_price) - (sold_qty * buy_unit_price)
             duration_held = (sell_date - buy_date).days
 
-            buy_sell_pairs.append({
+            result['pairs'].append({
                 'buy_date': buy_date,
                 'sell_date': sell_date,
                 'qty': sold_qty,
@@ -128,29 +166,30 @@ def calculate_buy_sell_pairs(transactions: List[Dict[str, Any]], target_symbol:
             })
 
             if gain_loss > TAX_HIFO_WARN_THRESHOLD:
-                print(f"WARN: Gain/loss of {gain_loss:,.2f} for {sold_qty:.4f} {target_symbol} sold on {sell_date} after {duration_held} days")
+                print(f"WARN: Gain/loss of {gain_loss:,.2f} for {sold_qty:.4f} {sell['symbol']} sold on {sell_date} after {duration_held} days")
 
             if buy_qty_available <= sell_qty:
-                index_to_remove = buys.index(buy)
-                buys.pop(index_to_remove)
-                valid_buys.pop(0)
+                heapq.heappop(heap)
             else:
-                index_to_update = buys.index(buy)
-                buys[index_to_update]['qty'] = buy_qty_available - sold_qty
-                buys[index_to_update]['usd_value'] = (buy_qty_available - sold_qty) * buy_unit_price
+                buy['qty'] = buy_qty_available - sold_qty
+                buy['usd_value'] = (buy_qty_available - sold_qty) * buy_unit_price
 
             sell_qty -= sold_qty
 
-    validate_remaining_transactions(buys)
+    for symbol, result in results.items():
+        buys = [lot[2] for lot in sorted(lots[symbol], key=lambda x: (x[0], x[1]))]
+        validate_remaining_transactions(buys)
+
+        # Remaining unsold assets
+        result['unsold'] = [{
+            'buy_date': buy['date'],
+            'buy_qty': buy['qty'],
+            'usd_value': buy['usd_value']
+        } for buy in buys if buy['qty'] > 0]
 
-    # Remaining unsold assets
-    unsold_assets = [{
-        'buy_date': buy['date'],
-        'buy_qty': buy['qty'],
-        'usd_value': buy['usd_value']
-    } for buy in buys if buy['qty'] > 0]
+        result['incomes'] = [transactions[i] for i in sorted(result['incomes'])]
 
-    return buy_sell_pairs, unsold_assets
+    return results
 
 
 def determine_qty_remaining(transactions: List[Dict[str, Any]], target_symbol: str) -> Tuple[float, float]:
@@ -367,12 +406,22 @@ def main():
     # Create summary report
     summary = [['year', 'symbol', 'total_gain_loss', 'total_income']]
 
+    # Match lots for all symbols in a single pass
+    lots = match_lots(transactions)
+    empty = {'pairs': [], 'unsold': [], 'buy_qty': 0, 'sell_qty': 0,
+             'incomes': []}
+
     # Process each symbol
+    matched = set()
     for symbol in symbols:
-        buy_sell_pairs, unsold = calculate_buy_sell_pairs(transactions, symbol)
-        incomes = [txn for txn in transactions
-                  if txn['symbol_normalized'] == symbol.lower()
-                  and txn['txn_type'] == 'income']
+        # Symbols that differ only by case are matched together and reported
+        # under the first spelling
+        result = lots.get(symbol.lower(), empty) if symbol.lower() not in matched else empty
+        matched.add(symbol.lower())
+        print(f"Debug: {symbol} - Total Buy Qty: {result['buy_qty']}, Total Sell Qty: {result['sell_qty']}")
+        buy_sell_pairs, unsold = result['pairs'], result['unsold']
+        # Every spelling reports the incomes of the symbol
+        incomes = lots.get(symbol.lower(), empty)['incomes']
 
         create_report(symbol, buy_sell_pairs, unsold, incomes)
 
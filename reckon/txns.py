@@ -1,7 +1,11 @@
 import csv
 import datetime
+import hashlib
+import heapq
 import importlib
+import json
 import os.path
+import pickle
 # import sys
 
 # import tomlkit
@@ -15,12 +19,15 @@ from config import (
     STABLECOINS,
     TXNS_OUTPUT,
     TXNS_PRICE_REQ_OUTPUT,
+    TXNS_REPORTS_CACHE_OUTPUT,
     TXNS_TOML,
     TXNS_MANUAL_TOML,
     TXNS_CONFIG,
+    TXNS_EQUIVALENTS,
     TAGS,
 )
 from debank import FLAT_HEADERS
+from utils import file_hash, read_rows
 # from utils import list_to_csv
 
 HEADERS = [
@@ -40,23 +47,94 @@ HEADERS = [
 ]
 
 
-def parse_report(fn, parser):
+def parser_version(module):
+    """
+    Returns a version of a txn_parser module that changes whenever its output
+    could: the hash of its source, of this module's source (parsers share
+    code such as txline()) and of the config the parsers read (STABLECOINS,
+    TXNS_CONFIG and TAGS).
+    """
+    h = hashlib.sha256()
+    for path in [module.__file__, __file__]:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    h.update(repr(sorted(STABLECOINS)).encode())
+    h.update(json.dumps([TXNS_CONFIG, TAGS], sort_keys=True,
+                        default=str).encode())
+    return h.hexdigest()
+
+
+def load_reports_cache():
+    if os.path.isfile(TXNS_REPORTS_CACHE_OUTPUT):
+        try:
+            with open(TXNS_REPORTS_CACHE_OUTPUT, 'rb') as f:
+                return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, TypeError):
+            pass
+    return {}
+
+
+def save_reports_cache(cache):
+    tmp_path = TXNS_REPORTS_CACHE_OUTPUT + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, TXNS_REPORTS_CACHE_OUTPUT)
+
+
+def parse_report(fn, parser, cache=None):
+    """
+    Parses the report fn with txn_parser.<parser>.
+
+    If a cache dict is given, the parsed txns are looked up in it by
+    (fn, parser) and reused while the parser version and the file are
+    unchanged. The file counts as unchanged if its size and mtime match, or
+    else if its content hash does (i.e. it was only touched or copied). The
+    cache entry is replaced whenever the report is parsed again.
+    """
     if not os.path.isfile(fn):
         print(f'WARN: {fn} from {TXNS_TOML} not found')
         return []
 
     module = importlib.import_module(f'txn_parser.{parser}')
     method = getattr(module, "parse")
-    return method(fn)
+    if cache is None:
+        return method(fn)
+
+    stat = os.stat(fn)
+    source = (stat.st_size, stat.st_mtime_ns)
+    version = parser_version(module)
+    entry = cache.get((fn, parser))
+    if entry is not None and entry['version'] == version:
+        if entry['source'] == source:
+            return entry['txns']
+        content_hash = file_hash(fn)
+        if entry['hash'] == content_hash:
+            entry['source'] = source
+            return entry['txns']
+    else:
+        content_hash = file_hash(fn)
+
+    txns = method(fn)
+    cache[(fn, parser)] = {
+        'source': source,
+        'hash': content_hash,
+        'version': version,
+        'txns': txns,
+    }
+    return txns
 
 # TODO Change report processing to use tx_line (and maybe externalize)
 
 
-def sort_except(list, ignore):
-    temp = list.pop(ignore)
-    list.sort(key=lambda x: datetime.datetime.strptime(
-        x[0], '%Y-%m-%d %H:%M:%S'))
-    list.insert(ignore, temp)
+def sort_txns(txns):
+    """
+    Returns txns sorted by date, keeping the order of txns with equal dates.
+    Dates are '%Y-%m-%d %H:%M:%S' strings, which sort chronologically as is,
+    and a list that is already sorted is returned without sorting.
+    """
+    if all(txns[i][0] <= txns[i + 1][0] for i in range(len(txns) - 1)):
+        return txns
+    return sorted(txns, key=lambda x: x[0])
 
 
 def write_csv(list, file_path):
@@ -251,75 +329,71 @@ def consolidated_txns():
     equivalent_txns = []
     empty_txns = []
 
-    with open(FLATTEN_OUTPUT, 'r') as f:
-
-        headers = next(f)
-        headers_list = headers.strip().split(',')
-        approval_txns.append(headers_list)
-        spam_txns.append(headers_list)
-        stablecoin_txns.append(headers_list)
-        equivalent_txns.append(headers_list)
-        empty_txns.append(headers_list)
-
-        lines = 0
-        processed_lines = 0
-        reader = csv.reader(f)
-        txn_batch = []
-        for row in reader:
-            lines += 1
-            txn_dict = dict(zip(FLAT_HEADERS, row))
-
-            # Is it spam?
-            if txn_dict['spam'] == 'True':
-                spam_txns.append(row)
-                continue
-
-            # Is it an approval?
-            elif txn_dict['tx.name'] == 'approve':
-                approval_txns.append(row)
-                continue
-
-            # Is it an empty transaction?
-            if txn_dict['sends.token.symbol'] == '' and \
-                    txn_dict['receives.token.symbol'] == '':
-                empty_txns.append(row)
-                continue
-
-            # Is it a stablecoin swap?
-            if txn_dict['sends.token.symbol'].lower() in STABLECOINS and \
-                    txn_dict['receives.token.symbol'].lower() in STABLECOINS:
-                stablecoin_txns.append(row)
-                continue
-
-            # Is it a swap between equivalent tokens?
-            if sorted([txn_dict['sends.token.symbol'].lower(),
-                       txn_dict['receives.token.symbol'].lower()]) in \
-                    TXNS_CONFIG['consolidated_parser']['equivalents']:
-                equivalent_txns.append(row)
-                continue  # Equivalents swap
-
-            # If none of the above, then it is a transaction to be processed
-            # as part of a batch (even if only a single item in batch).
-
-            # If the sub field is not 0, then it is an ongoing part of a batch
-            if txn_dict['sub'] != '0':
-                txn_batch.append(txn_dict)
-
-            # If the sub field is 0 and there is already a batch, then this
-            # is a new batch and the previous batch should be processed.
-            elif len(txn_batch) > 0:
-                txns.extend(process_batch(txn_batch))
-                txn_batch = [txn_dict]
-
-            # If none of the others apply, then this is the first transaction.
-            else:
-                # First transaction
-                txn_batch = [txn_dict]
+    (headers_list, rows) = read_rows(FLATTEN_OUTPUT)
+    approval_txns.append(headers_list)
+    spam_txns.append(headers_list)
+    stablecoin_txns.append(headers_list)
+    equivalent_txns.append(headers_list)
+    empty_txns.append(headers_list)
+
+    lines = 0
+    processed_lines = 0
+    txn_batch = []
+    for row in rows:
+        lines += 1
+        txn_dict = dict(zip(FLAT_HEADERS, row))
+
+        # Is it spam?
+        if txn_dict['spam'] == 'True':
+            spam_txns.append(row)
+            continue
+
+        # Is it an approval?
+        elif txn_dict['tx.name'] == 'approve':
+            approval_txns.append(row)
+            continue
+
+        # Is it an empty transaction?
+        if txn_dict['sends.token.symbol'] == '' and \
+                txn_dict['receives.token.symbol'] == '':
+            empty_txns.append(row)
+            continue
+
+        # Is it a stablecoin swap?
+        if txn_dict['sends.token.symbol'].lower() in STABLECOINS and \
+                txn_dict['receives.token.symbol'].lower() in STABLECOINS:
+            stablecoin_txns.append(row)
+            continue
+
+        # Is it a swap between equivalent tokens?
+        if frozenset((txn_dict['sends.token.symbol'].lower(),
+                      txn_dict['receives.token.symbol'].lower())) in \
+                TXNS_EQUIVALENTS:
+            equivalent_txns.append(row)
+            continue  # Equivalents swap
+
+        # If none of the above, then it is a transaction to be processed
+        # as part of a batch (even if only a single item in batch).
+
+        # If the sub field is not 0, then it is an ongoing part of a batch
+        if txn_dict['sub'] != '0':
+            txn_batch.append(txn_dict)
+
+        # If the sub field is 0 and there is already a batch, then this
+        # is a new batch and the previous batch should be processed.
+        elif len(txn_batch) > 0:
+            txns.extend(process_batch(txn_batch))
+            txn_batch = [txn_dict]
+
+        # If none of the others apply, then this is the first transaction.
+        else:
+            # First transaction
+            txn_batch = [txn_dict]
 
-            processed_lines += 1
+        processed_lines += 1
 
-        # This handles the last unprocessed batch
-        txns.extend(process_batch(txn_batch))
+    # This handles the last unprocessed batch
+    txns.extend(process_batch(txn_batch))
 
     print(f"- Lines: {lines}")
     print(f"- Processed: {processed_lines}")
@@ -346,24 +420,26 @@ def main():
      equivalent_txns,
      empty_txns) = consolidated_txns()
 
-    # Add to the list of transactions
-    txns.extend(consolidated)
-
-    # Add reports to the list of transactions
+    # Get the transactions from the reports
     print("Processing reports")
+    report_txns = []
     reports = TXNS_CONFIG['reports']
+    reports_cache = load_reports_cache()
     for key in reports.keys():
-        no_lines = len(txns)
-        txns.extend(
-            parse_report(
-                reports[key]['file'],
-                reports[key]['parser'],
-            )
+        parsed = parse_report(
+            reports[key]['file'],
+            reports[key]['parser'],
+            reports_cache,
         )
-        print(f'- {reports[key]["file"]} => Added {len(txns) - no_lines} entries')
-
-    # Sort output data for easier reading
-    sort_except(txns, 0)
+        report_txns.append(sort_txns(parsed))
+        print(f'- {reports[key]["file"]} => Added {len(parsed)} entries')
+    save_reports_cache(reports_cache)
+
+    # Add them all to the list of transactions in date order. The consolidated
+    # txns are already sorted since flatten.csv is merged by time_at, so only
+    # the reports need sorting before they are merged in.
+    txns.extend(heapq.merge(sort_txns(consolidated), *report_txns,
+                            key=lambda x: x[0]))
 
     print(f"Created {len(txns)} transactions")
 
@@ -1 +1,2 @@
-from .utils import list_to_csv
\ No newline at end of file
+from .utils import list_to_csv, compact_csv, file_hash, fingerprint, RateLimiter, get_with_retry
+from .columnar import ColumnWriter, write_columns, load_columns, read_rows
\ No newline at end of file
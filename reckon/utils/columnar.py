@@ -0,0 +1,262 @@
+import csv
+import math
+import os
+from array import array
+from datetime import datetime, timezone
+
+# Bump when the layout of the .npz files changes so old stores are ignored
+COLUMNAR_VERSION = 2
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def columnar_path(csv_path):
+    """Returns the path of the .npz store kept next to csv_path."""
+    return os.path.splitext(csv_path)[0] + '.npz'
+
+
+def _encode_value(value, kind, index):
+    """Returns the stored value of one cell; raises ValueError or TypeError
+       if it does not parse.
+
+       A 'date' column is stored as int64 UTC timestamps and a 'float' or
+       'nullable_float' column as float64. An empty value only parses in a
+       'nullable_float' column, as NaN; readers of a 'float' column from the
+       CSV fail on it rather than read NaN. Any other column is stored as
+       strings, dictionary encoded as int32 codes into index, the unique
+       values, so repeated symbols and chains are only stored once. A
+       'number' column is encoded by _encode_number().
+    """
+    if kind == 'date':
+        return int(datetime.strptime(value, DATE_FORMAT)
+                   .replace(tzinfo=timezone.utc).timestamp())
+    if kind == 'float':
+        return float(value)
+    if kind == 'nullable_float':
+        return float(value) if value is not None and value != '' else math.nan
+    return index.setdefault('' if value is None else str(value), len(index))
+
+
+# How the text of a 'number' cell is rendered back from its float
+NUMBER_FLOAT = 0
+NUMBER_INT = 1
+NUMBER_EMPTY = 2
+
+
+def _encode_number(value):
+    """Returns (number, format) of a cell of a 'number' column, the text of
+       an int, a float or nothing as csv.writer renders them, stored as a
+       float64 and the int8 format _render_numbers() renders it back with;
+       raises ValueError or OverflowError if that would not give back the
+       same text, i.e. for ints too large for a float64.
+    """
+    if value is None or value == '':
+        return (math.nan, NUMBER_EMPTY)
+    text = str(value)
+    number = float(text)
+    if repr(number) == text:
+        return (number, NUMBER_FLOAT)
+    if str(int(number)) == text:
+        return (number, NUMBER_INT)
+    raise ValueError(f'{text} is not rendered back from a float')
+
+
+def _render_numbers(cells, formats):
+    """Returns the texts of the cells of a 'number' column."""
+    return [repr(number) if fmt == NUMBER_FLOAT
+            else str(int(number)) if fmt == NUMBER_INT
+            else ''
+            for (number, fmt) in zip(cells.tolist(), formats.tolist())]
+
+
+# array typecodes of the encoded cells of each kind of column
+TYPECODES = {'date': 'q', 'float': 'd', 'nullable_float': 'd', 'number': 'd'}
+
+
+class ColumnWriter:
+    """Encodes rows into a typed columnar .npz store next to csv_path as they
+       are added, so the rows themselves do not have to be kept.
+
+       types maps column names to 'date', 'float', 'nullable_float' or
+       'number'; all other columns are strings, matching how csv.writer
+       renders them. Only the encoded cells (8 bytes per typed cell, 9 per
+       'number' cell, 4 per string code) and the unique strings are held
+       until close(), which is called after the CSV
+       has been written. The store is replaced atomically, so it is only used
+       while it is newer than the CSV. If a typed column has a value that
+       does not parse (see _encode_value()), no store is written and readers
+       fall back to the CSV, so both give the same results.
+    """
+
+    def __init__(self, csv_path, headers, types=None):
+        types = types or {}
+        self.path = columnar_path(csv_path)
+        self.headers = headers
+        self.kinds = [types.get(name, 'str') for name in headers]
+        self.cells = [array(TYPECODES.get(kind, 'i')) for kind in self.kinds]
+        self.indexes = [{} for _ in headers]
+        self.formats = [array('b') if kind == 'number' else None
+                        for kind in self.kinds]
+        self.failed = None
+
+    def add(self, row):
+        if self.failed is not None:
+            return
+        for i, kind in enumerate(self.kinds):
+            try:
+                if kind == 'number':
+                    (number, fmt) = _encode_number(row[i])
+                    self.cells[i].append(number)
+                    self.formats[i].append(fmt)
+                else:
+                    self.cells[i].append(
+                        _encode_value(row[i], kind, self.indexes[i]))
+            except (TypeError, ValueError, OverflowError):
+                self.failed = i
+                # Nothing more is written, so the cells can go
+                self.cells = self.indexes = self.formats = None
+                return
+
+    def close(self):
+        # Imported here, as in _load_store(), so stages that do not use a
+        # store do not load numpy
+        import numpy as np
+
+        if self.failed is not None:
+            print(f'WARN: Not writing {self.path}, column '
+                  f'{self.headers[self.failed]} is not all '
+                  f'{self.kinds[self.failed]}')
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+
+        arrays = {
+            '__version__': np.array(COLUMNAR_VERSION),
+            '__headers__': np.array(self.headers, dtype=str),
+        }
+        for i, kind in enumerate(self.kinds):
+            # The buffers of the cells are shared, not copied
+            cells = np.frombuffer(self.cells[i], dtype=self.cells[i].typecode)
+            if kind == 'number':
+                arrays[str(i)] = cells
+                arrays[f'{i}.formats'] = np.frombuffer(self.formats[i],
+                                                       dtype='b')
+            elif kind in TYPECODES:
+                arrays[str(i)] = cells
+            else:
+                arrays[f'{i}.codes'] = cells
+                arrays[f'{i}.values'] = np.array(list(self.indexes[i]),
+                                                 dtype=str)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+
+
+def write_columns(csv_path, headers, rows, types=None):
+    """Writes rows as a typed columnar .npz store next to csv_path, after the
+       CSV has been written. See ColumnWriter.
+    """
+    writer = ColumnWriter(csv_path, headers, types)
+    for row in rows:
+        writer.add(row)
+    writer.close()
+
+
+def _load_store(csv_path):
+    """Returns the columns of the columnar store of csv_path as (name, cells,
+       values, formats) tuples, or None if there is no store or it is not
+       newer than the CSV. cells is the column's array; for a string column
+       it holds codes into the list of unique values, otherwise values is
+       None. formats is the array of the formats of a 'number' column, and
+       None for the others.
+    """
+    path = columnar_path(csv_path)
+    try:
+        if os.stat(path).st_mtime_ns <= os.stat(csv_path).st_mtime_ns:
+            return None
+    except FileNotFoundError:
+        return None
+
+    import numpy as np
+
+    with np.load(path, allow_pickle=False) as data:
+        if int(data['__version__']) != COLUMNAR_VERSION:
+            return None
+        columns = []
+        for i, name in enumerate(data['__headers__'].tolist()):
+            if f'{i}.codes' in data:
+                columns.append((name, data[f'{i}.codes'],
+                                data[f'{i}.values'].tolist(), None))
+            else:
+                columns.append((name, data[str(i)], None,
+                                data.get(f'{i}.formats')))
+    return columns
+
+
+def _decode(cells, values):
+    if values is None:
+        return cells.tolist()
+    return [values[c] for c in cells.tolist()]
+
+
+def _decode_text(cells, values, formats):
+    if formats is not None:
+        return _render_numbers(cells, formats)
+    return _decode(cells, values)
+
+
+def load_columns(csv_path):
+    """Loads the columnar store of csv_path without parsing any text.
+
+       Returns a dict of column name to list of values (ints for 'date'
+       columns, floats for 'float', 'nullable_float' and 'number' columns,
+       with NaN for empty cells, str otherwise), or None if there is no
+       store or it is not newer than the CSV.
+    """
+    columns = _load_store(csv_path)
+    if columns is None:
+        return None
+    return {name: _decode(cells, values)
+            for (name, cells, values, _) in columns}
+
+
+# Rows decoded from a columnar store at a time by read_rows()
+READ_CHUNK_ROWS = 4096
+
+
+def _iter_store_rows(columns):
+    count = len(columns[0][1]) if columns else 0
+    for start in range(0, count, READ_CHUNK_ROWS):
+        end = start + READ_CHUNK_ROWS
+        chunk = [_decode_text(cells[start:end], values,
+                              None if formats is None else formats[start:end])
+                 for (_, cells, values, formats) in columns]
+        for row in zip(*chunk):
+            yield list(row)
+
+
+def _iter_csv_rows(f, reader):
+    with f:
+        yield from reader
+
+
+def read_rows(csv_path):
+    """Returns (headers, rows) of a CSV of strings, using its columnar store
+       when it is fresh and parsing the CSV otherwise. The cells of 'number'
+       columns are rendered back to the text of the CSV.
+
+       rows is an iterator, so only a row (or a chunk of READ_CHUNK_ROWS rows
+       of the store, whose compact columns are loaded) is decoded at a time.
+       The CSV stays open until rows is exhausted.
+    """
+    columns = _load_store(csv_path)
+    if columns is not None:
+        headers = [name for (name, _, _, _) in columns]
+        return (headers, _iter_store_rows(columns))
+
+    f = open(csv_path, 'r', newline='')
+    reader = csv.reader(f)
+    headers = next(reader)
+    return (headers, _iter_csv_rows(f, reader))
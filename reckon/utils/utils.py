@@ -1,4 +1,8 @@
 import csv
+import hashlib
+import os
+import threading
+import time
 
 def get_nested_dict(d: dict, key: str, msg='', sep='.'):
     """Safely gets a key from a nest dictionary.
@@ -33,3 +37,127 @@ def list_to_csv(l: list, fn=None):
     else:
         for row in l:
             print(','.join(map(str, row)))
+
+
+def file_hash(fn):
+    """Returns the sha256 hex digest of the contents of fn."""
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    """Returns [size, mtime_ns, sha256] of path, or None if it does not exist.
+
+       The hash of previous is reused while the size and mtime still match,
+       so unchanged files are not read.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if previous is not None and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return previous
+    return [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+
+
+def compact_csv(file_path, key, header=False):
+    """Sorts the rows of a cache CSV by key(row), keeping only the first row
+       of each key, and replaces the file atomically.
+
+       The sort is stable, so of rows with the same key the one kept is the
+       one a first-wins loader already uses. A file that is already sorted
+       with unique keys is left untouched. Returns the number of rows
+       dropped, or None if the file was not rewritten.
+    """
+    if not os.path.isfile(file_path):
+        return None
+
+    with open(file_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        headers = next(reader, None) if header else None
+        rows = list(reader)
+
+    keys = [key(row) for row in rows]
+    if all(keys[i] < keys[i + 1] for i in range(len(keys) - 1)):
+        return None
+
+    compacted = []
+    last_key = None
+    for i in sorted(range(len(rows)), key=keys.__getitem__):
+        if not compacted or keys[i] != last_key:
+            compacted.append(rows[i])
+            last_key = keys[i]
+
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        if headers is not None:
+            writer.writerow(headers)
+        writer.writerows(compacted)
+    os.replace(tmp_path, file_path)
+    return len(rows) - len(compacted)
+
+
+class RateLimiter:
+    """Thread-safe token bucket that allows at most rate calls per second.
+
+       Up to burst calls can go out back to back before the rate applies.
+       Each call to wait() reserves the next free slot and sleeps until it
+       arrives, so it can be shared by a pool of worker threads. A rate of
+       None or 0 disables limiting.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.burst_time = self.interval * (max(burst, 1) - 1)
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            delay = slot - self.burst_time - now
+            self.next_time = slot + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_with_retry(session, url, rate_limiter=None, retries=0, backoff=1.0,
+                   **kwargs):
+    """GETs url, retrying 429 and 5xx responses and connection errors.
+
+       Every attempt waits on rate_limiter first. Retries back off
+       exponentially from backoff seconds, unless a 429 response says how
+       long to wait with Retry-After. Returns the last response, or None if
+       the last attempt failed to connect.
+    """
+    # Imported here so importing utils does not load requests; only the API
+    # clients (debank, defillama, coingecko) import it when they are loaded
+    import requests
+
+    response = None
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            response = session.get(url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR: {e}", end=" => ")
+            response = None
+        else:
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            print(f"{response.status_code}", end=" => ")
+
+        if attempt < retries:
+            delay = backoff * 2 ** attempt
+            if response is not None and \
+                    response.headers.get('Retry-After', '').isdigit():
+                delay = int(response.headers['Retry-After'])
+            print(f"Retrying in {delay} seconds", end=" => ")
+            time.sleep(delay)
+    return response
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""
+Shared test setup.
+
+The reckon modules are scripts that import each other from reckon/ and read
+config/ and write output/ relative to the working directory. The tests run
+from a scratch directory with a copy of config/ (and the sample wallets,
+txns and manual prices), so they never touch the checkout.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'reckon'))
+
+WORKDIR = tempfile.mkdtemp(prefix='reckon-tests-')
+shutil.copytree(os.path.join(ROOT, 'config'), os.path.join(WORKDIR, 'config'))
+shutil.copytree(os.path.join(ROOT, 'data'), os.path.join(WORKDIR, 'data'))
+# config reads the WALLETS key, which sample_wallets.toml does not have
+with open(os.path.join(WORKDIR, 'config', 'wallets.toml'), 'w') as f:
+    f.write('WALLETS = [["0xa", "eth"]]\n')
+for (sample, name) in [('sample_txns_manual.toml', 'txns_manual.toml'),
+                       ('sample_price_manual.csv', 'price_manual.csv')]:
+    if not os.path.exists(os.path.join(WORKDIR, 'config', name)):
+        shutil.copy(os.path.join(WORKDIR, 'config', sample),
+                    os.path.join(WORKDIR, 'config', name))
+os.chdir(WORKDIR)
+
+from utils import RateLimiter  # noqa: E402
+
+
+class StubServer:
+    """
+    Local HTTP server for the API clients. handler(path, query) returns a
+    (status, body, headers) tuple for each GET, where query is a dict of
+    single values. Every request is logged as (time, path, query).
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with stub.lock:
+                    stub.requests.append((time.monotonic(), url.path, query))
+                (status, body, headers) = stub.handler(url.path, query)
+                data = body.encode() if isinstance(body, str) else body
+                self.send_response(status)
+                for (key, value) in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def paths(self):
+        return [path for (_, path, _) in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """Returns a function starting a StubServer, shut down after the test."""
+    servers = []
+
+    def start(handler):
+        server = StubServer(handler)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def stub_api(stub_server, monkeypatch):
+    """
+    Returns a function pointing an API client module at a new StubServer:
+    start(module, url_attr, handler, rate=None, **attrs) sets module.url_attr
+    to the server, gives the module its own RateLimiter(rate) and sets any
+    other module attrs. Returns the server.
+    """
+
+    def start(module, url_attr, handler, rate=None, **attrs):
+        server = stub_server(handler)
+        monkeypatch.setattr(module, url_attr, server.url)
+        monkeypatch.setattr(module, 'RATE_LIMITER', RateLimiter(rate))
+        for (name, value) in attrs.items():
+            monkeypatch.setattr(module, name, value)
+        return server
+
+    return start
+
+
+@pytest.fixture
+def empty_caches(monkeypatch, tmp_path):
+    """
+    Returns a function giving a price source module empty caches:
+    reset(module, prefix, name) points its {prefix}_CACHE_OUTPUT and
+    {prefix}_MISSING_OUTPUT at new files in tmp_path named after name, and
+    unloads its PRICE_CACHE and MISSING_CACHE.
+    """
+
+    def reset(module, prefix, name):
+        monkeypatch.setattr(module, f'{prefix}_CACHE_OUTPUT',
+                            str(tmp_path / f'{name}_cache.csv'))
+        monkeypatch.setattr(module, f'{prefix}_MISSING_OUTPUT',
+                            str(tmp_path / f'{name}_missing.csv'))
+        monkeypatch.setattr(module, 'PRICE_CACHE', None)
+        monkeypatch.setattr(module, 'MISSING_CACHE', None)
+
+    return reset
@@ -0,0 +1,100 @@
+import pytest
+
+import all as pipeline
+
+
+class FakeStage(pipeline.Stage):
+    """A stage over files in a tmp_path whose run() calls on_run()."""
+
+    def __init__(self, tmp_path, on_run=lambda: None, **kwargs):
+        super().__init__('fake',
+                         inputs=lambda: [str(tmp_path / 'in.txt'),
+                                         str(tmp_path / 'cache.txt')],
+                         outputs=lambda: [str(tmp_path / 'out.txt')],
+                         **kwargs)
+        self.tmp_path = tmp_path
+        self.on_run = on_run
+        self.runs = 0
+
+    def run(self):
+        self.runs += 1
+        self.on_run()
+        (self.tmp_path / 'out.txt').write_text(f'run {self.runs}')
+
+
+@pytest.fixture
+def run_stage(monkeypatch, tmp_path):
+    """Returns a function running main() over one stage with its state in
+    tmp_path."""
+    monkeypatch.setattr(pipeline, 'ALL_STATE_OUTPUT', str(tmp_path / 'state.json'))
+    (tmp_path / 'in.txt').write_text('input')
+    (tmp_path / 'cache.txt').write_text('')
+
+    def run(stage):
+        runs = stage.runs
+        pipeline.main([stage])
+        return stage.runs > runs
+
+    return run
+
+
+def test_unchanged_stage_is_skipped(run_stage, tmp_path):
+    stage = FakeStage(tmp_path)
+
+    assert run_stage(stage)
+    assert not run_stage(stage)
+    (tmp_path / 'in.txt').write_text('changed')
+    assert run_stage(stage)
+    assert not run_stage(stage)
+
+
+def test_input_edited_during_run_is_seen_as_changed(run_stage, tmp_path):
+    edits = iter(['edited while running'])
+
+    def edit():
+        for text in edits:
+            (tmp_path / 'in.txt').write_text(text)
+            break
+
+    stage = FakeStage(tmp_path, on_run=edit)
+
+    assert run_stage(stage)
+    assert run_stage(stage)
+    assert not run_stage(stage)
+
+
+def test_files_the_stage_writes_are_recorded_after_it(run_stage, tmp_path):
+    def append():
+        with open(tmp_path / 'cache.txt', 'a') as f:
+            f.write('cached price\n')
+
+    stage = FakeStage(tmp_path, on_run=append,
+                      writes=lambda: [str(tmp_path / 'cache.txt')])
+
+    assert run_stage(stage)
+    assert not run_stage(stage)
+
+
+def test_stage_with_failures_runs_again(run_stage, tmp_path):
+    failures = iter([2, 1])
+    stage = FakeStage(tmp_path)
+    stage.retry = lambda: (f'{n} requests failed'
+                           if (n := next(failures, 0)) else None)
+
+    assert run_stage(stage)
+    assert pipeline.load_state()['fake']['retry'] == '2 requests failed'
+    assert run_stage(stage)
+    assert run_stage(stage)
+    assert pipeline.load_state()['fake']['retry'] is None
+    assert not run_stage(stage)
+
+
+def test_refreshed_stage_runs_even_if_unchanged(run_stage, tmp_path):
+    stage = FakeStage(tmp_path)
+    assert run_stage(stage)
+    assert not run_stage(stage)
+
+    runs = stage.runs
+    pipeline.main([stage], refresh=['fake'])
+    assert stage.runs == runs + 1
+    assert not run_stage(stage)
@@ -0,0 +1,163 @@
+import csv
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import coingecko.coingecko as cg
+
+COIN_ID = 'test-coin'
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+# Days the stub has no price for
+MISSING_DAYS = {datetime(2021, 1, 5, tzinfo=timezone.utc),
+                datetime(2021, 4, 2, tzinfo=timezone.utc)}
+
+
+def nearest_midnight(ts):
+    return round(ts / 86400) * 86400
+
+
+def make_series(days=200):
+    """Hourly (ts, price) points a few minutes off the hour, as CoinGecko
+    has them, without points around the midnights of MISSING_DAYS."""
+    missing = {int(day.timestamp()) for day in MISSING_DAYS}
+    series = []
+    for hour in range(-12, days * 24):
+        ts = int(START.timestamp()) + hour * 3600 + (hour * 397) % 1200 - 600
+        if nearest_midnight(ts) not in missing:
+            series.append((ts, round(700 + hour * 0.37 + (hour % 13) / 10, 4)))
+    return series
+
+
+SERIES = make_series()
+
+
+def daily_point(midnight):
+    """The point of SERIES closest to midnight, or None."""
+    points = [p for p in SERIES if nearest_midnight(p[0]) == midnight]
+    if not points:
+        return None
+    return min(points, key=lambda p: abs(p[0] - midnight))
+
+
+def coingecko_handler(path, query):
+    headers = {'Content-Type': 'application/json'}
+    if path == f'/api/v3/coins/{COIN_ID}/history':
+        date = datetime.strptime(query['date'], '%d-%m-%Y')
+        point = daily_point(int(date.replace(tzinfo=timezone.utc).timestamp()))
+        body = {'id': COIN_ID}
+        if point is not None:
+            body['market_data'] = {'current_price': {'usd': point[1]}}
+        return (200, json.dumps(body), headers)
+    if path == f'/api/v3/coins/{COIN_ID}/market_chart/range':
+        (from_ts, to_ts) = (int(query['from']), int(query['to']))
+        points = [p for p in SERIES if from_ts <= p[0] <= to_ts]
+        # Ranges over 90 days have daily points only
+        if to_ts - from_ts > 90 * 86400:
+            points = sorted(set(filter(None, (daily_point(nearest_midnight(ts))
+                                              for (ts, _) in points))))
+        body = {'prices': [[ts * 1000, price] for (ts, price) in points]}
+        return (200, json.dumps(body), headers)
+    return (404, '{"error": "Not Found"}', headers)
+
+
+@pytest.fixture
+def coingecko(stub_api, empty_caches):
+    """Points coingecko at a stub server with empty caches in tmp_path."""
+    server = stub_api(cg, 'COINGECKO_API_URL', coingecko_handler,
+                      COINGECKO_ID_EXPLICIT={'tst': COIN_ID})
+
+    def reset(name):
+        empty_caches(cg, 'COINGECKO', name)
+        server.requests.clear()
+
+    return (server, reset)
+
+
+def cache_rows(path):
+    with open(path, newline='') as f:
+        return sorted(tuple(row) for row in csv.reader(f))
+
+
+def days(*offsets):
+    return [START + timedelta(days=offset) for offset in offsets]
+
+
+@pytest.mark.parametrize('dates', [
+    days(0, 1, 2, 4, 6, 7, 10),   # hourly points
+    days(3, 20, 60, 91, 120, 150, 180),  # daily points
+])
+def test_range_matches_daily_history(coingecko, dates):
+    (server, reset) = coingecko
+
+    reset('history')
+    expected = {date.strftime('%Y-%m-%d'): cg.get_historical_price('TST', date)
+                for date in dates}
+    expected_prices = cache_rows(cg.COINGECKO_CACHE_OUTPUT)
+    expected_missing = cache_rows(cg.COINGECKO_MISSING_OUTPUT)
+    assert len(server.requests) == len(dates)
+
+    reset('range')
+    (ranges, points) = cg.plan_historical_prices(dates)
+    assert (ranges, points) == ([sorted(dates)], [])
+    prices = cg.get_historical_price_range('TST', dates)
+
+    assert len(server.requests) == 1
+    assert prices == {k: v for (k, v) in expected.items() if v is not None}
+    assert cache_rows(cg.COINGECKO_CACHE_OUTPUT) == expected_prices
+    assert cache_rows(cg.COINGECKO_MISSING_OUTPUT) == expected_missing
+
+
+def test_range_records_dates_without_points_as_missing(coingecko):
+    (server, reset) = coingecko
+    reset('range')
+    dates = days(3, 4, 5, 6)
+
+    prices = cg.get_historical_price_range('TST', dates)
+
+    assert '2021-01-05' not in prices
+    assert len(prices) == 3
+    assert [row[:3] for row in cache_rows(cg.COINGECKO_MISSING_OUTPUT)] == \
+        [('2021-01-05', 'TST', '?')]
+    # Known missing now, so no request for it
+    assert cg.get_historical_price('TST', dates[1]) is None
+    assert len(server.requests) == 1
+
+
+def test_prefetch_leaves_sparse_dates_to_history(coingecko, monkeypatch):
+    (server, reset) = coingecko
+    reset('prefetch')
+    monkeypatch.setattr(cg, 'COINGECKO_RANGE_MAX_DAYS', 30)
+    dense = days(0, 1, 2, 10)
+    sparse = days(40, 100)
+
+    assert cg.plan_historical_prices(dense + sparse) == ([dense], sparse)
+
+    cg.prefetch_historical_prices([('TST', date) for date in dense + sparse])
+    assert len(server.requests) == 1
+
+    for date in dense:
+        assert cg.get_historical_price('TST', date) is not None
+    assert len(server.requests) == 1
+    for date in sparse:
+        assert cg.get_historical_price('TST', date) is not None
+    assert server.paths().count(f'/api/v3/coins/{COIN_ID}/history') == 2
+
+
+@pytest.mark.parametrize('status', [401, 403, 503])
+def test_failed_requests_are_not_saved_as_missing(stub_api, empty_caches,
+                                                  monkeypatch, status):
+    stub_api(cg, 'COINGECKO_API_URL', lambda path, query: (status, '', {}),
+             COINGECKO_ID_EXPLICIT={'tst': COIN_ID},
+             COINGECKO_RETRIES=0)
+    empty_caches(cg, 'COINGECKO', 'failed')
+    monkeypatch.setattr(cg, 'CACHE_STATS', dict.fromkeys(cg.CACHE_STATS, 0))
+
+    assert cg.get_historical_price('TST', START) is None
+
+    assert not os.path.exists(cg.COINGECKO_MISSING_OUTPUT) or \
+        cache_rows(cg.COINGECKO_MISSING_OUTPUT) == []
+    assert not cg.is_known_missing('TST', START)
+    assert cg.get_cache_stats()['gave_up'] == 1
@@ -0,0 +1,202 @@
+import csv
+import os
+import random
+import tracemalloc
+
+import pytest
+
+import debank.debank as d
+import flatten
+import pf
+import price
+import tax_hifo
+import utils
+from utils import columnar
+
+
+def write_price_csv(path, rows, store=True):
+    """Writes a price.csv of rows, and its store after it like price.py."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(price.PRICE_OUTPUT_HEADERS)
+        writer.writerows(rows)
+    if store:
+        columnar.write_columns(path, price.PRICE_OUTPUT_HEADERS, rows,
+                               price.PRICE_OUTPUT_TYPES)
+
+
+def price_rows(count):
+    rng = random.Random(count)
+    rows = []
+    for i in range(count):
+        # Full precision values, which pandas' default parser does not
+        # always round correctly
+        qty = rng.random() * 10 ** rng.randrange(-8, 8)
+        rows.append([
+            f'2021-{i % 12 + 1:02d}-{i % 28 + 1:02d} 10:00:00',
+            rng.choice(['buy', 'sell', 'income']),
+            repr(qty), rng.choice(['ETH', 'CRV', 'CVX']), '0x1',
+            repr(qty * rng.random() * 3000),
+            repr(rng.random() * 100) if i % 3 else '',
+            'USDC' if i % 3 else '', '', 'eth', 'dex', 'swap', '0xa',
+            f'0x{i:x}', 'dlcg',
+        ])
+    return rows
+
+
+def test_pf_is_the_same_from_store_and_csv(monkeypatch, tmp_path):
+    path = str(tmp_path / 'price.csv')
+    monkeypatch.setattr(pf, 'PRICE_OUTPUT', path)
+    rows = price_rows(500)
+    # Symbols and token ids that pandas reads as NA by default
+    for (i, name) in enumerate(['NA', 'None', 'null', 'NaN', 'N/A']):
+        rows[i][3] = name
+        rows[i + 10][4] = name
+
+    outputs = []
+    for store in [True, False]:
+        write_price_csv(path, rows, store=store)
+        assert (columnar.load_columns(path) is not None) == store
+        monkeypatch.setattr(pf, 'PF_OUTPUT', str(tmp_path / f'pf_{store}.csv'))
+        pf.main()
+        with open(pf.PF_OUTPUT) as f:
+            outputs.append(f.read())
+
+    assert outputs[0] == outputs[1]
+    symbols = [line.split(',')[0] for line in outputs[0].splitlines()]
+    assert {'NA', 'None', 'null', 'NaN', 'N/A'} <= set(symbols)
+
+
+def test_store_is_not_written_for_empty_floats(monkeypatch, tmp_path):
+    path = str(tmp_path / 'price.csv')
+    monkeypatch.setattr(tax_hifo, 'PRICE_OUTPUT', path)
+    rows = price_rows(20)
+    write_price_csv(path, rows)
+    store = columnar.load_columns(path)
+    assert store is not None
+    assert [t['qty'] for t in tax_hifo.get_transactions()] == \
+        [float(row[2]) for row in rows]
+
+    # An empty purchase_token_cost is stored as NaN, an empty qty is not
+    # stored at all, so tax_hifo fails on it from either
+    assert [row[6] for row in rows].count('') > 0
+    rows[5][2] = ''
+    write_price_csv(path, rows)
+
+    assert not os.path.exists(columnar.columnar_path(path))
+    with pytest.raises(ValueError):
+        tax_hifo.get_transactions()
+
+
+# Texts of numbers as csv.writer renders the ints and floats of a history
+NUMBER_TEXTS = [
+    lambda rng: '',
+    lambda rng: str(rng.randrange(10 ** 6)),
+    lambda rng: repr(rng.random() * 10 ** rng.randrange(-12, 20)),
+]
+
+
+def write_wallet_csvs(flatten_dir, wallets, count):
+    """Writes the flattened CSV of each wallet, sorted by time_at, with
+    unique ids and 20 values in every other column."""
+    rng = random.Random(count)
+    for (w, (addr, chain)) in enumerate(wallets):
+        times = sorted(rng.randrange(10 ** 6) for _ in range(count))
+        with open(flatten_dir / f'{addr}-{chain}.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(d.FLAT_HEADERS)
+            for (i, time_at) in enumerate(times):
+                row = [f'{k}:{rng.randrange(20)}' for k in range(len(d.FLAT_HEADERS))]
+                for name in flatten.FLATTEN_OUTPUT_TYPES:
+                    row[d.FLAT_HEADERS.index(name)] = \
+                        rng.choice(NUMBER_TEXTS)(rng)
+                row[d.FLAT_HEADERS.index('id')] = f'{addr}-{chain}-{i}'
+                row[d.FLAT_HEADERS.index('time_at')] = str(1_600_000_000 + time_at)
+                row[d.FLAT_HEADERS.index('project.chain')] = chain
+                writer.writerow(row)
+
+
+@pytest.mark.parametrize('store', [True, False])
+def test_consolidate_wallets_streams_rows(monkeypatch, tmp_path, store):
+    wallets = [['0xa', 'eth'], ['0xa', 'arb'], ['0xb', 'eth']]
+    write_wallet_csvs(tmp_path, wallets, 5000)
+    output = str(tmp_path / 'flatten.csv')
+    monkeypatch.setattr(flatten, 'WALLETS', wallets)
+    monkeypatch.setattr(flatten, 'FLATTEN_DIR', str(tmp_path))
+    monkeypatch.setattr(flatten, 'FLATTEN_OUTPUT', output)
+    monkeypatch.setattr(flatten, 'COLUMNAR_STORE', store)
+
+    tracemalloc.start()
+    flatten.consolidate_wallets()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    with open(output, newline='') as f:
+        rows = list(csv.reader(f))[1:]
+    assert len(rows) == 3 * 5000
+    time_at = d.FLAT_HEADERS.index('time_at')
+    assert [row[time_at] for row in rows] == \
+        sorted(row[time_at] for row in rows)
+    # Holding the rows as lists of str would take over 10 times the size of
+    # the file. Without the store only a row per wallet is held; the store
+    # keeps 4 bytes per cell and the unique values.
+    size = os.path.getsize(output)
+    assert peak < (size * 3 if store else size / 10)
+
+    (_, store_rows) = utils.read_rows(output)
+    assert list(store_rows) == rows
+    assert (columnar.load_columns(output) is not None) == store
+
+
+@pytest.mark.parametrize('store', [True, False])
+def test_read_rows_is_lazy(monkeypatch, tmp_path, store):
+    wallets = [['0xa', 'eth'], ['0xb', 'arb']]
+    write_wallet_csvs(tmp_path, wallets, 6000)
+    output = str(tmp_path / 'flatten.csv')
+    monkeypatch.setattr(flatten, 'WALLETS', wallets)
+    monkeypatch.setattr(flatten, 'FLATTEN_DIR', str(tmp_path))
+    monkeypatch.setattr(flatten, 'FLATTEN_OUTPUT', output)
+    monkeypatch.setattr(flatten, 'COLUMNAR_STORE', store)
+    flatten.consolidate_wallets()
+    with open(output, newline='') as f:
+        expected = list(csv.reader(f))
+
+    (headers, rows) = utils.read_rows(output)
+    assert iter(rows) is rows
+    assert [headers] + list(rows) == expected
+
+    reducer = flatten.CountReducer(['project.chain'])
+    tracemalloc.start()
+    flatten.aggregate_flatten([reducer])
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert reducer.result() == {('eth',): 6000, ('arb',): 6000}
+    # Decoding all rows would take over 10 times the size of the file. The
+    # store's codes and unique values are loaded whole, the CSV is not.
+    size = os.path.getsize(output)
+    assert peak < (size * 3 if store else size / 10)
+
+
+def test_numbers_are_rendered_back_to_the_same_text(tmp_path):
+    path = str(tmp_path / 'numbers.csv')
+    texts = ['', '0', '-7', '1630000000', '1630000000.0', '0.1', '1e-05',
+             '1.5e+20', '123456789.12345679', str(2 ** 53)]
+    rows = [[text, 'x'] for text in texts]
+    open(path, 'w').close()
+    columnar.write_columns(path, ['n', 's'], rows, {'n': 'number'})
+
+    (_, store_rows) = utils.read_rows(path)
+    assert list(store_rows) == rows
+    numbers = columnar.load_columns(path)['n']
+    assert numbers[1:] == [float(text) for text in texts[1:]]
+    assert numbers[0] != numbers[0]
+
+
+@pytest.mark.parametrize('text', ['1e3', '00', str(2 ** 60 + 1), 'NaN', 'x'])
+def test_store_is_not_written_for_numbers_with_other_text(tmp_path, text):
+    path = str(tmp_path / 'numbers.csv')
+    open(path, 'w').close()
+    columnar.write_columns(path, ['n'], [['1'], [text]], {'n': 'number'})
+
+    assert not os.path.exists(columnar.columnar_path(path))
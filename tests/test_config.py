@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import config
+
+
+@pytest.mark.parametrize('module', ['tax_hifo', 'pf'])
+def test_import_does_not_load_api_clients(module):
+    # A fresh interpreter, as the modules imported by the other tests stay
+    # in sys.modules
+    code = (f'import sys, {module}; '
+            'print(sorted(n for n in ("debank", "coingecko", "defillama", '
+            '"requests") if n in sys.modules))')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, check=True,
+        env={**os.environ,
+             'PYTHONPATH': os.path.dirname(os.path.dirname(config.__file__))})
+
+    assert result.stdout.strip() == '[]'
+    # -X importtime lists every module imported, with its time in us
+    imported = [line.rsplit('|', 1)[1].strip()
+                for line in result.stderr.splitlines()
+                if line.startswith('import time:') and '|' in line]
+    assert 'config' in imported
+    assert not [name for name in imported
+                if name.split('.')[0] in ('debank', 'coingecko', 'defillama',
+                                          'requests')]
+
+
+@pytest.mark.parametrize('module', ['tax_hifo', 'txns', 'utils'])
+def test_import_does_not_load_numpy(module):
+    # Only the columnar stores need numpy, and they are off by default
+    code = f'import sys, {module}; print("numpy" in sys.modules)'
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output=True, text=True, check=True,
+        env={**os.environ,
+             'PYTHONPATH': os.path.dirname(os.path.dirname(config.__file__))})
+
+    assert result.stdout.strip() == 'False'
@@ -0,0 +1,225 @@
+import csv
+import json
+import time
+
+import pytest
+
+import build
+import debank.debank as d
+
+PAGE_SIZE = 20
+
+
+def make_history(wallet, chain, count, step=60):
+    """count entries of a wallet, newest first, as the API pages them."""
+    return [{'id': f'{wallet}-{chain}-{i}', 'time_at': 1_600_000_000 + i * step}
+            for i in reversed(range(count))]
+
+
+def history_handler(histories):
+    """Serves history_list pages of histories[(id, chain_id)]."""
+
+    def handler(path, query):
+        assert path == '/v1/user/history_list'
+        entries = histories[(query['id'], query['chain_id'])]
+        if 'start_time' in query:
+            entries = [e for e in entries
+                       if e['time_at'] < int(query['start_time'])]
+        body = {
+            'cate_dict': {},
+            'project_dict': {},
+            'token_dict': {},
+            'history_list': entries[:PAGE_SIZE],
+        }
+        return (200, json.dumps(body), {'Content-Type': 'application/json'})
+
+    return handler
+
+
+@pytest.fixture
+def debank_api(stub_api, tmp_path):
+    """Points debank at a stub server with empty stored wallets."""
+
+    def start(histories, rate=None):
+        return stub_api(d, 'DEBANK_API_URL', history_handler(histories),
+                        rate=rate, DEBANK_ACCESSKEY='test',
+                        WALLETS_DIR=str(tmp_path))
+
+    return start
+
+
+WALLETS = [['0xa', 'eth'], ['0xa', 'arb'], ['0xb', 'eth'], ['0xc', 'ftm']]
+
+
+def test_parallel_fetch_matches_sequential(debank_api):
+    histories = {(w, c): make_history(w, c, n)
+                 for ((w, c), n) in zip(map(tuple, WALLETS), [45, 20, 7, 61])}
+    server = debank_api(histories)
+
+    sequential = [d.fetch_all_history(w, c) for (w, c) in WALLETS]
+    sequential_requests = len(server.requests)
+
+    parallel = list(d.fetch_all_histories(WALLETS, max_workers=4))
+
+    assert [hl.raw() for hl in parallel] == [hl.raw() for hl in sequential]
+    for ((w, c), hl) in zip(WALLETS, parallel):
+        assert hl.len() == len(histories[(w, c)])
+    assert len(server.requests) == 2 * sequential_requests
+
+
+def test_parallel_fetch_honours_rate_limiter(debank_api):
+    rate = 40
+    histories = {(w, c): make_history(w, c, 50) for (w, c) in WALLETS}
+    server = debank_api(histories, rate=rate)
+
+    list(d.fetch_all_histories(WALLETS, max_workers=4))
+
+    times = sorted(t for (t, _, _) in server.requests)
+    # 3 pages per wallet; no burst, so the requests are spread at 1 / rate
+    assert len(times) == 3 * len(WALLETS)
+    assert times[-1] - times[0] >= (len(times) - 1) / rate * 0.9
+
+
+def test_full_fetch_stops_without_progress(debank_api, monkeypatch):
+    # 25 entries at one time_at: paging by start_time cannot get past them
+    # if the API returns entries at start_time again
+    histories = {('0xa', 'eth'): [{'id': f'0xa-eth-{i}', 'time_at': 1_600_000_000}
+                                  for i in range(25)]}
+    server = debank_api(histories)
+    monkeypatch.setattr(d, 'create_history_list_url',
+                        lambda id, chain_id, start_time=None: (
+                            f'{server.url}/v1/user/history_list?'
+                            f'id={id}&chain_id={chain_id}'))
+
+    hl = d.fetch_all_history('0xa', 'eth', incremental=False)
+
+    assert hl.len() == PAGE_SIZE
+    assert len(server.requests) == 2
+
+
+def test_incremental_fetch_saves_at_most_one_request(debank_api):
+    history = make_history('0xa', 'eth', 70)
+    histories = {('0xa', 'eth'): history[25:]}
+    server = debank_api(histories)
+    d.fetch_all_history('0xa', 'eth').write()
+    assert len(server.requests) == 3
+
+    # 25 new entries are two pages; the second reaches the stored history
+    histories[('0xa', 'eth')] = history
+    server.requests.clear()
+    hl = d.fetch_all_history('0xa', 'eth')
+
+    assert hl.len() == 70
+    assert len(server.requests) == 2
+    assert hl.requests_saved == 1
+
+    # Nothing new: the first page reaches the stored history, as it would
+    # have stopped before
+    server.requests.clear()
+    hl.write()
+    hl = d.fetch_all_history('0xa', 'eth')
+    assert len(server.requests) == 1
+    assert hl.requests_saved == 0
+
+
+def make_wallet(wallet, chain, count):
+    """A stored wallet of count swap entries over 50 tokens, with every 5th
+    entry an approval without receives or sends."""
+    tokens = [f'0x{i:040x}' for i in range(50)]
+    history = []
+    for i in range(count):
+        entry = {
+            'id': f'{wallet}-{chain}-{i}', 'time_at': 1_600_000_000 + i * 60,
+            'cate_id': 'swap', 'other_addr': '0xrouter', 'project_id': 'dex',
+            'receives': [], 'sends': [], 'token_approve': None,
+            'tx': {'name': 'swap', 'status': 1, 'from_addr': wallet,
+                   'to_addr': '0xrouter', 'eth_gas_fee': 0.01,
+                   'usd_gas_fee': 20.5, 'value': 0, 'params': ['a', 'b']},
+        }
+        if i % 5:
+            entry['receives'] = [{'amount': i / 3, 'from_addr': '0xrouter',
+                                  'token_id': tokens[(i + k) % 50]}
+                                 for k in range(i % 3 + 1)]
+            entry['sends'] = [{'amount': i / 7, 'to_addr': '0xrouter',
+                               'token_id': tokens[i % 50]}]
+        else:
+            entry['token_approve'] = {'spender': '0xrouter',
+                                      'token_id': tokens[i % 50],
+                                      'value': 1e18}
+        history.append(entry)
+    return {
+        'cate_dict': {},
+        'project_dict': {'dex': {'name': 'Dex', 'chain': chain,
+                                 'site_url': 'https://dex'}},
+        'token_dict': {t: {'symbol': f'T{i}', 'is_verified': bool(i % 2)}
+                       for (i, t) in enumerate(tokens)},
+        'history_list': history,
+    }
+
+
+def write_flat_csv_per_entry(hl, path):
+    """The write_flat_csv() that rewrote the file after every entry, kept as
+    the reference for its output."""
+    flat_hl = [d.FLAT_HEADERS]
+    for i in range(hl.get_size()):
+        flat_hl.extend(hl.get_history_entry_flat(i))
+        with open(path, 'w') as f:
+            csv.writer(f).writerows(flat_hl)
+
+
+@pytest.mark.parametrize('count', [300, 20_000])
+def test_write_flat_csv_benchmark(monkeypatch, tmp_path, capsys, count):
+    monkeypatch.setattr(d, 'FLATTEN_DIR', str(tmp_path))
+    hl = d.HistoryList('0xa', 'eth', make_wallet('0xa', 'eth', count))
+
+    start = time.perf_counter()
+    hl.write_flat_csv()
+    elapsed = time.perf_counter() - start
+
+    output = (tmp_path / '0xa-eth.csv').read_bytes()
+    rows = sum(max(len(e['receives']), len(e['sends']), 1)
+               for e in hl.history_list())
+    assert output.count(b'\n') == rows + 1
+    with capsys.disabled():
+        print(f'\nwrite_flat_csv: {count} entries, {rows} rows in {elapsed:.2f}s')
+    assert elapsed < count * 1e-3
+
+    # The old per-entry rewrite is quadratic, so only compared when small
+    if count <= 300:
+        write_flat_csv_per_entry(hl, tmp_path / 'per_entry.csv')
+        assert (tmp_path / 'per_entry.csv').read_bytes() == output
+
+
+def test_failed_wallet_does_not_stop_the_others(debank_api, monkeypatch,
+                                                tmp_path):
+    histories = {(w, c): make_history(w, c, 30) for (w, c) in WALLETS}
+    server = debank_api(histories)
+    handler = server.handler
+    attempts = {}
+
+    def failing_handler(path, query):
+        # 0xa-arb is rate limited once, then answers; 0xb-eth never answers
+        # and 0xc-ftm returns a body that is not JSON
+        key = (query['id'], query['chain_id'])
+        attempts[key] = attempts.get(key, 0) + 1
+        if key == ('0xa', 'arb') and attempts[key] == 1:
+            return (429, '{}', {'Retry-After': '0'})
+        if key == ('0xb', 'eth'):
+            return (503, 'unavailable', {})
+        if key == ('0xc', 'ftm'):
+            return (200, '<html>', {})
+        return handler(path, query)
+
+    server.handler = failing_handler
+    monkeypatch.setattr(d, 'DEBANK_RETRIES', 2)
+    monkeypatch.setattr(d, 'DEBANK_BACKOFF_SECONDS', 0)
+    monkeypatch.setattr(build, 'WALLETS', WALLETS)
+
+    with pytest.raises(Exception, match='Failed to fetch 2 wallets: '
+                                        '0xb-eth, 0xc-ftm'):
+        build.main()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['0xa-arb.json', '0xa-eth.json']
+    assert d.load_history('0xa', 'arb').len() == 30
+    assert attempts[('0xb', 'eth')] == 3
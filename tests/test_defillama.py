@@ -0,0 +1,126 @@
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import defillama.defillama as dl
+
+# Coins the stub knows no price for
+NO_PRICE = {'eth:0xdead', 'arb:0xbeef'}
+
+HEADER_ROW = tuple(dl.HEADERS)
+
+
+def stub_price(timestamp, coin):
+    return round(1 + (int(timestamp) % 997) / 7 + len(coin) / 3, 6)
+
+
+def llama_handler(path, query):
+    (_, _, _, timestamp, coins) = path.split('/', 4)
+    prices = {
+        coin: {'price': stub_price(timestamp, coin), 'symbol': 'X',
+               'timestamp': int(timestamp), 'confidence': 0.99}
+        for coin in coins.split(',') if coin not in NO_PRICE
+    }
+    return (200, json.dumps({'coins': prices}),
+            {'Content-Type': 'application/json'})
+
+
+@pytest.fixture
+def llama(stub_api, empty_caches):
+    """Points defillama at a stub server with empty caches in tmp_path."""
+    server = stub_api(dl, 'DEFILLAMA_API_URL', llama_handler,
+                      DEFILLAMA_BATCH_SIZE=3)
+
+    def reset(name):
+        empty_caches(dl, 'DEFILLAMA', name)
+        server.requests.clear()
+
+    return (server, reset)
+
+
+def cache_rows(path):
+    with open(path, newline='') as f:
+        return sorted(tuple(row) for row in csv.reader(f))
+
+
+PRICE_REQUESTS = [
+    ('2021-01-01 10:00:00', 'eth', 'WETH', '0xc02a'),
+    ('2021-01-01 10:00:00', 'eth', 'DEAD', '0xdead'),
+    ('2021-01-01 10:00:00', 'eth', 'USDC', '0xa0b8'),
+    ('2021-01-01 10:00:00', 'eth', 'CRV', '0xd533'),
+    ('2021-01-01 10:00:00', 'eth', 'CVX', '0x4e3f'),
+    ('2021-01-01 10:00:00', 'arb', 'BEEF', '0xbeef'),
+    ('2021-01-01 10:00:00', 'arb', 'ARB', '0x912c'),
+    ('2021-01-01 10:00:00', 'eth', 'WETH', '0xc02a'),
+    ('2021-06-30 23:59:59', 'eth', 'WETH', '0xc02a'),
+    ('2021-06-30 23:59:59', 'eth', 'DEAD', '0xdead'),
+    ('2022-02-02 02:02:02', 'ftm', 'WFTM', '0x21be'),
+]
+
+
+def per_coin_rows(llama, name):
+    (server, reset) = llama
+    reset(name)
+    for req in PRICE_REQUESTS:
+        dl.get_price(*req)
+    return (cache_rows(dl.DEFILLAMA_CACHE_OUTPUT),
+            cache_rows(dl.DEFILLAMA_MISSING_OUTPUT),
+            len(server.requests))
+
+
+@pytest.mark.parametrize('workers', [None, 4])
+def test_batched_prefetch_matches_per_coin_requests(llama, workers):
+    (server, reset) = llama
+    (expected_prices, expected_missing, per_coin_requests) = \
+        per_coin_rows(llama, 'per_coin')
+
+    reset('batched')
+    if workers is None:
+        dl.prefetch_prices(PRICE_REQUESTS)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            dl.prefetch_prices(PRICE_REQUESTS, executor)
+    batched_requests = len(server.requests)
+
+    assert cache_rows(dl.DEFILLAMA_CACHE_OUTPUT) == expected_prices
+    assert cache_rows(dl.DEFILLAMA_MISSING_OUTPUT) == expected_missing
+    assert ('2021-01-01 10:00:00', 'eth', 'DEAD', '0xdead', '') in \
+        expected_missing
+
+    # 7 unique coins at the first date are 3 chunks, then one per other date
+    assert per_coin_requests == 10
+    assert batched_requests == 3 + 1 + 1
+    for (_, path, _) in server.requests:
+        assert len(path.rsplit('/', 1)[1].split(',')) <= dl.DEFILLAMA_BATCH_SIZE
+
+    # Every request is now answered from the caches without another call
+    for req in PRICE_REQUESTS:
+        dl.get_price(*req)
+    assert len(server.requests) == batched_requests
+
+
+@pytest.mark.parametrize('status', [503, 429, None])
+def test_failed_requests_are_not_saved_as_missing(llama, stub_server,
+                                                  monkeypatch, status):
+    (_, reset) = llama
+    reset('failed')
+    monkeypatch.setattr(dl, 'DEFILLAMA_RETRIES', 1)
+    monkeypatch.setattr(dl, 'DEFILLAMA_BACKOFF_SECONDS', 0)
+    if status is None:
+        # Nothing listens on the port of a closed server
+        server = stub_server(llama_handler)
+        server.close()
+    else:
+        server = stub_server(lambda path, query: (status, '{}', {}))
+    monkeypatch.setattr(dl, 'DEFILLAMA_API_URL', server.url)
+    monkeypatch.setattr(dl, 'FAILED_COUNT', 0)
+
+    assert dl.get_price(*PRICE_REQUESTS[0]) is None
+    assert dl.get_failed_count() == 1
+    dl.prefetch_prices(PRICE_REQUESTS)
+
+    assert cache_rows(dl.DEFILLAMA_CACHE_OUTPUT) == [HEADER_ROW]
+    assert cache_rows(dl.DEFILLAMA_MISSING_OUTPUT) == [HEADER_ROW]
+    assert not dl.is_known_missing(*PRICE_REQUESTS[0])
@@ -0,0 +1,201 @@
+import csv
+import random
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import defillama.defillama as dl
+import price
+import txns as txns_module
+
+
+@pytest.fixture
+def rules_config(monkeypatch, tmp_path):
+    """Returns a function loading a PriceRulesConfig of a rules TOML."""
+
+    def load(toml):
+        path = tmp_path / 'price.toml'
+        path.write_text(toml)
+        monkeypatch.setattr(price, 'PRICE_CONFIG', str(path))
+        return price.PriceRulesConfig()
+
+    return load
+
+
+@pytest.mark.parametrize('symbol', ['USD+', '$X', 'A.B', 'x(y)'])
+def test_plain_pattern_is_literal(symbol):
+    rule = price.PriceRule({'symbol': symbol, 'action': 'ignore'})
+
+    assert rule.symbol_pattern == symbol.lower()
+    assert rule.match('eth', symbol.upper(), '0x1')
+    assert not rule.match('eth', symbol.rstrip('+)') + 'z', '0x1')
+
+
+def test_prefixed_pattern_is_regex():
+    rule = price.PriceRule({'chain': 're:eth|arb', 'symbol': 're:w?eth',
+                            'action': 'ignore'})
+
+    assert rule.match('ETH', 'WETH', '0x1')
+    assert rule.match('arb', 'eth', '0x1')
+    assert not rule.match('ftm', 'weth', '0x1')
+    # Matched against the whole value
+    assert not rule.match('eth', 'wethx', '0x1')
+
+
+def test_find_rule_keeps_config_order(rules_config):
+    config = rules_config('''
+[[rules]]
+symbol = "re:usd.*"
+action = "ignore"
+
+[[rules]]
+symbol = "USD+"
+action = "coingecko"
+
+[[rules]]
+chain = "eth"
+symbol = "$X"
+action = "coingecko"
+''')
+
+    assert config.find_rule('eth', 'USD+', '0x1') is config.rules[0]
+    assert config.find_rule('eth', '$x', '0x1') is config.rules[2]
+    assert config.find_rule('arb', '$X', '0x1') is None
+    assert config.symbol_index == {'usd+': [1], '$x': [2]}
+
+
+def test_defillama_round_date_is_exact_by_default():
+    rule = price.DefiLlamaPriceRule({'symbol': 'weth'})
+
+    assert price.PRICE_DEFILLAMA_BUCKET_SECONDS == 0
+    assert rule.round_date('2021-01-01 10:41:07', 'eth', 'WETH', '0xc02a') == \
+        '2021-01-01 10:41:07'
+
+
+def test_defillama_round_date_prefers_exact_cached_price(monkeypatch):
+    monkeypatch.setattr(price, 'PRICE_DEFILLAMA_BUCKET_SECONDS', 3600)
+    monkeypatch.setattr(dl, 'PRICE_CACHE', {
+        dl.cache_key('2021-01-01 10:41:07', 'ethereum', 'WETH', '0xc02a'): '730.1',
+    })
+    monkeypatch.setattr(dl, 'MISSING_CACHE', set())
+    rule = price.DefiLlamaPriceRule({'symbol': 'weth'})
+
+    assert rule.round_date('2021-01-01 10:41:07', 'eth', 'WETH', '0xc02a') == \
+        '2021-01-01 10:41:07'
+    assert rule.round_date('2021-01-01 10:45:00', 'eth', 'WETH', '0xc02a') == \
+        '2021-01-01 10:00:00'
+    assert rule.round_date('2021-01-01 10:41:07', 'arb', 'WETH', '0xc02a') == \
+        '2021-01-01 10:00:00'
+
+
+def linear_scan_price(date, chain, symbol, token_id):
+    """The per-txn scan of PRICE_MERGED_OUTPUT that get_price() replaced,
+    kept as the reference for its results."""
+    with open(price.PRICE_MERGED_OUTPUT, 'r') as csvfile:
+        next(csvfile)
+        for row in csv.reader(csvfile):
+            if row[0] == date and row[1] == chain and row[2] == symbol and \
+                    row[3] == token_id:
+                return row[4]
+    return None
+
+
+def write_synthetic_txns(tmp_path, count):
+    """Writes count buy and sell txns over 500 tokens and the merged prices
+    of all but every 50th of them. Every 7th token has a mixed case token id
+    and every 11th is priced under a lowercased one, which must not match."""
+    rng = random.Random(count)
+    start = datetime(2021, 1, 1)
+    txns = []
+    prices = {}
+    for i in range(count):
+        n = rng.randrange(500)
+        token_id = f'0x{n:040x}' if n % 7 else f'0xAbC{n:037x}'
+        date = str(start + timedelta(minutes=rng.randrange(count * 10)))
+        txns.append([date, rng.choice(['buy', 'sell']), rng.randrange(1, 1000) / 10,
+                     f'TK{n}', token_id, '', '', '', 'eth', 'proj', 'swap',
+                     '0xwallet', f'id{i}'])
+        if i % 50:
+            if n % 11 == 0:
+                token_id = token_id.lower()
+            prices.setdefault((date, 'eth', f'TK{n}', token_id),
+                              rng.randrange(1, 10 ** 6) / 100)
+
+    with open(tmp_path / 'txns.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(txns_module.HEADERS)
+        writer.writerows(txns)
+    with open(tmp_path / 'price_merged.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(price.PRICE_HEADERS)
+        writer.writerows([*key, p, 'defillama'] for (key, p) in prices.items())
+    (tmp_path / 'price_manual.csv').write_text(
+        'date,symbol,chain,token_id,timestamp,price,txn_type,comment\n')
+
+
+def set_price_files(monkeypatch, tmp_path):
+    for (name, file_name) in [('TXNS_OUTPUT', 'txns.csv'),
+                              ('PRICE_MERGED_OUTPUT', 'price_merged.csv'),
+                              ('PRICE_MANUAL_FILE', 'price_manual.csv'),
+                              ('PRICE_OUTPUT', 'price.csv'),
+                              ('PRICE_MANUAL_USED_OUTPUT', 'used.csv'),
+                              ('PRICE_MANUAL_UNUSED_OUTPUT', 'unused.csv')]:
+        monkeypatch.setattr(price, name, str(tmp_path / file_name))
+    monkeypatch.setattr(price, 'COLUMNAR_STORE', False)
+    monkeypatch.setattr(price, 'MERGED_PRICES', None)
+
+
+def test_manual_prices_match_date_exactly(monkeypatch, tmp_path):
+    write_synthetic_txns(tmp_path, 20)
+    set_price_files(monkeypatch, tmp_path)
+    with open(tmp_path / 'txns.csv', newline='') as f:
+        txns = list(csv.reader(f))[1:]
+    (date, _, _, symbol, token_id) = txns[0][:5]
+    with open(tmp_path / 'price_manual.csv', 'a', newline='') as f:
+        writer = csv.writer(f)
+        # The symbol, chain and token id match in any case, the date only
+        # as it is
+        writer.writerow([date, symbol.lower(), 'ETH', token_id.upper(), '',
+                         '2', '', 'matched'])
+        for (i, txn) in enumerate(txns[1:4]):
+            key = [txn[0], txn[3], 'eth', txn[4]]
+            key[i] = f' {key[i]}' if i else f'{key[i]} '
+            writer.writerow([*key, '', '3', '', 'padded'])
+
+    price.create_priced_txns()
+
+    with open(tmp_path / 'price.csv', newline='') as f:
+        sources = {row['id']: row['source'] for row in csv.DictReader(f)}
+    assert sources[txns[0][12]] == 'manual / matched'
+    assert [sources[txn[12]] for txn in txns[1:4]].count('manual / padded') == 0
+
+
+@pytest.mark.parametrize('count', [10_000, 100_000])
+def test_create_priced_txns_benchmark(monkeypatch, tmp_path, capsys, count):
+    write_synthetic_txns(tmp_path, count)
+    set_price_files(monkeypatch, tmp_path)
+
+    start = time.perf_counter()
+    price.create_priced_txns()
+    elapsed = time.perf_counter() - start
+
+    with open(tmp_path / 'price.csv', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == count
+    with capsys.disabled():
+        print(f'\ncreate_priced_txns: {count} txns in {elapsed:.2f}s')
+    # The scan took time proportional to the merged file for every txn
+    assert elapsed < count * 1e-3
+
+    # A sample checked against the scan, which is too slow for all of them
+    sources = set()
+    for row in random.Random(0).sample(rows, 100):
+        expected = linear_scan_price(row['date'], row['chain'], row['symbol'],
+                                     row['token_id'])
+        if expected is None:
+            assert row['usd_value'] == 'MISSING'
+        else:
+            assert float(row['usd_value']) == float(row['qty']) * float(expected)
+        sources.add(row['source'])
+    assert sources == {'dlcg', 'MISSING'}
@@ -0,0 +1,136 @@
+import copy
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import tax_hifo
+
+
+def calculate_buy_sell_pairs(transactions, target_symbol):
+    """
+    The per-symbol HIFO matching that match_lots() replaced, kept as the
+    reference for its results (less the debug output).
+    """
+    buys = [
+        txn for txn in transactions
+        if txn['txn_type'] in ['buy', 'income']
+        and txn['symbol_normalized'] == target_symbol.lower()
+    ]
+
+    sells = [
+        txn for txn in transactions
+        if txn['txn_type'] == 'sell'
+        and txn['symbol_normalized'] == target_symbol.lower()
+    ]
+
+    buys.sort(key=lambda x: x['usd_value'] / x['qty'], reverse=True)
+
+    buy_sell_pairs = []
+
+    for sell in sells:
+        sell_qty = sell['qty']
+        sell_unit_price = sell['usd_value'] / sell['qty']
+        sell_date = sell['date']
+
+        valid_buys = [buy for buy in buys if buy['date'] <= sell['date']]
+
+        while sell_qty > 0 and valid_buys:
+            buy = valid_buys[0]
+            buy_qty_available = buy['qty']
+            buy_unit_price = buy['usd_value'] / buy['qty']
+            buy_date = buy['date']
+
+            sold_qty = min(buy_qty_available, sell_qty)
+            gain_loss = (sold_qty * sell_unit_price) - (sold_qty * buy_unit_price)
+            duration_held = (sell_date - buy_date).days
+
+            buy_sell_pairs.append({
+                'buy_date': buy_date,
+                'sell_date': sell_date,
+                'qty': sold_qty,
+                'cost_basis': sold_qty * buy_unit_price,
+                'proceeds': sold_qty * sell_unit_price,
+                'gain_loss': gain_loss,
+                'duration_held': duration_held,
+                'buy_chain': buy['chain'],
+                'buy_id': buy['id'],
+                'sell_chain': sell['chain'],
+                'sell_id': sell['id'],
+            })
+
+            if buy_qty_available <= sell_qty:
+                index_to_remove = buys.index(buy)
+                buys.pop(index_to_remove)
+                valid_buys.pop(0)
+            else:
+                index_to_update = buys.index(buy)
+                buys[index_to_update]['qty'] = buy_qty_available - sold_qty
+                buys[index_to_update]['usd_value'] = (buy_qty_available - sold_qty) * buy_unit_price
+
+            sell_qty -= sold_qty
+
+    unsold_assets = [{
+        'buy_date': buy['date'],
+        'buy_qty': buy['qty'],
+        'usd_value': buy['usd_value']
+    } for buy in buys if buy['qty'] > 0]
+
+    return buy_sell_pairs, unsold_assets
+
+
+SYMBOLS = ['ETH', 'eth', 'Eth', 'CRV', 'cvx', 'CVX']
+TXN_TYPES = ['buy', 'buy', 'income', 'sell', 'sell', 'send']
+
+
+def random_transactions(rng, count):
+    """Transactions sorted by date like price.csv, with repeated dates,
+    quantities and unit prices so ties are exercised."""
+    start = datetime(2021, 1, 1)
+    dates = sorted(start + timedelta(hours=rng.randrange(0, 24 * 400, 6))
+                   for _ in range(count))
+    transactions = []
+    for (i, date) in enumerate(dates):
+        symbol = rng.choice(SYMBOLS)
+        qty = rng.choice([0.5, 1.0, 1.25, 2.0, 3.0, rng.uniform(0.01, 5)])
+        unit = rng.choice([10.0, 12.5, 20.0, rng.uniform(1, 50)])
+        transactions.append({
+            'date': date,
+            'qty': qty,
+            'usd_value': qty * unit,
+            'symbol': symbol,
+            'symbol_normalized': symbol.lower(),
+            'txn_type': rng.choice(TXN_TYPES),
+            'chain': rng.choice(['eth', 'arb']),
+            'id': f'0x{i:04x}',
+            'token_id': symbol.lower(),
+        })
+    return transactions
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_match_lots_matches_per_symbol_pairs(seed, monkeypatch):
+    monkeypatch.setattr(tax_hifo, 'TAX_HIFO_WARN_THRESHOLD', float('inf'))
+    rng = random.Random(seed)
+    transactions = random_transactions(rng, rng.randrange(1, 150))
+
+    lots = tax_hifo.match_lots(copy.deepcopy(transactions))
+
+    (symbols, _) = tax_hifo.find_symbols(transactions)
+    matched = set()
+    for symbol in symbols:
+        # Spellings of a symbol are matched together, under the first one
+        if symbol.lower() in matched:
+            continue
+        matched.add(symbol.lower())
+
+        (pairs, unsold) = calculate_buy_sell_pairs(copy.deepcopy(transactions), symbol)
+        result = lots.get(symbol.lower(), {'pairs': [], 'unsold': []})
+        assert result['pairs'] == pairs
+        assert result['unsold'] == unsold
+        assert [txn['id'] for txn in result.get('incomes', [])] == \
+            [txn['id'] for txn in transactions
+             if txn['symbol_normalized'] == symbol.lower()
+             and txn['txn_type'] == 'income']
+
+    assert set(lots) <= matched
@@ -0,0 +1,118 @@
+import csv
+import importlib
+import random
+import shutil
+import time
+
+import pytest
+
+import debank.debank as d
+import txns
+
+SYMBOLS = ['WETH', 'ETH', 'LETH', 'FTM', 'WFTM', 'CRV', 'CVX', 'ARB', 'GMX']
+
+
+def write_synthetic_flatten(path, count):
+    """Writes count single row swaps, mostly between stablecoins and
+    equivalent tokens, so most rows are classified and skipped."""
+    rng = random.Random(count)
+    stables = sorted(txns.STABLECOINS)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(d.FLAT_HEADERS)
+        for i in range(count):
+            kind = rng.randrange(10)
+            if kind < 5:
+                (sends, receives) = (rng.choice(stables).upper(),
+                                     rng.choice(stables))
+            elif kind < 9:
+                (sends, receives) = rng.choice(
+                    [('ETH', 'WETH'), ('weth', 'Eth'), ('LETH', 'eth'),
+                     ('WFTM', 'ftm')])
+            else:
+                (sends, receives) = (rng.choice(SYMBOLS), rng.choice(SYMBOLS))
+            row = dict.fromkeys(d.FLAT_HEADERS, '')
+            row.update({
+                'sub': '0', 'id': f'0x{i:064x}', 'spam': 'False',
+                'tx.name': 'swap', 'project.chain': 'eth',
+                'time_at': str(1_600_000_000 + i * 60),
+                'sends.token.symbol': sends, 'sends.amount': '1.5',
+                'receives.token.symbol': receives, 'receives.amount': '2.5',
+            })
+            writer.writerow(row.values())
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (result, time.perf_counter() - start)
+
+
+def test_classification_benchmark(monkeypatch, tmp_path, capsys):
+    path = tmp_path / 'flatten.csv'
+    write_synthetic_flatten(path, 50_000)
+    monkeypatch.setattr(txns, 'FLATTEN_OUTPUT', str(path))
+
+    (with_sets, sets_time) = timed(txns.consolidated_txns)
+
+    # The lists config held before the lookups became sets
+    monkeypatch.setattr(txns, 'STABLECOINS', sorted(txns.STABLECOINS))
+    monkeypatch.setattr(txns, 'TXNS_EQUIVALENTS', list(txns.TXNS_EQUIVALENTS))
+    (with_lists, lists_time) = timed(txns.consolidated_txns)
+
+    assert with_sets == with_lists
+    (_, _, _, stablecoin_txns, equivalent_txns, _) = with_sets
+    assert len(stablecoin_txns) > 20_000
+    assert len(equivalent_txns) > 15_000
+    with capsys.disabled():
+        print(f'\nconsolidated_txns: {sets_time:.3f}s with sets, '
+              f'{lists_time:.3f}s with lists')
+
+
+def test_spam_check_benchmark(monkeypatch, capsys):
+    rng = random.Random(0)
+    tokens = [f'0x{i:040x}' for i in range(400)]
+    allow = [f'eth:{t}' for t in tokens[:150]]
+    block = [f'eth:{t}' for t in tokens[150:300]]
+    calls = [('eth', 'dex', rng.choice(tokens), 'X', rng.random() < 0.5,
+              None, None, None, 'swap') for _ in range(50_000)]
+
+    def check_all():
+        return [d.is_spam(*call) for call in calls]
+
+    monkeypatch.setattr(d, 'DEBANK_ALLOW_LIST', frozenset(allow))
+    monkeypatch.setattr(d, 'DEBANK_BLOCK_LIST', frozenset(block))
+    (with_sets, sets_time) = timed(check_all)
+    monkeypatch.setattr(d, 'DEBANK_ALLOW_LIST', allow)
+    monkeypatch.setattr(d, 'DEBANK_BLOCK_LIST', block)
+    (with_lists, lists_time) = timed(check_all)
+
+    # Only the results are checked; the timings vary with the machine
+    assert with_sets == with_lists
+    assert 0 < sum(with_sets) < len(calls)
+    with capsys.disabled():
+        print(f'\nis_spam: {sets_time:.3f}s with sets, '
+              f'{lists_time:.3f}s with lists')
+
+
+def test_parser_version_covers_shared_code_and_config(monkeypatch, tmp_path):
+    parser = importlib.import_module('txn_parser.kucoin_us')
+    version = txns.parser_version(parser)
+    assert txns.parser_version(parser) == version
+
+    # kucoin_us uses txns.txline()
+    source = tmp_path / 'txns.py'
+    shutil.copy(txns.__file__, source)
+    monkeypatch.setattr(txns, '__file__', str(source))
+    assert txns.parser_version(parser) == version
+    with open(source, 'a') as f:
+        f.write('\n# changed\n')
+    versions = {version, txns.parser_version(parser)}
+
+    for (name, value) in [('STABLECOINS', txns.STABLECOINS | {'new'}),
+                          ('TXNS_CONFIG', {**txns.TXNS_CONFIG, 'new': 1}),
+                          ('TAGS', {**txns.TAGS, '0xnew': 'New'})]:
+        with monkeypatch.context() as m:
+            m.setattr(txns, name, value)
+            versions.add(txns.parser_version(parser))
+    assert len(versions) == 5
@@ -0,0 +1,161 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import utils.utils as u
+from utils import RateLimiter, get_with_retry
+
+
+class FakeClock:
+    """Stands in for the time module: sleep() advances monotonic()."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(u, 'time', SimpleNamespace(monotonic=clock.monotonic,
+                                                   sleep=clock.sleep))
+    return clock
+
+
+def test_rate_limiter_allows_burst_then_holds_rate(clock):
+    limiter = RateLimiter(rate=10, burst=3)
+
+    for _ in range(3):
+        limiter.wait()
+    assert clock.now == 0.0
+
+    times = []
+    for _ in range(10):
+        limiter.wait()
+        times.append(clock.now)
+    assert times == pytest.approx([0.1 * i for i in range(1, 11)])
+
+
+def test_rate_limiter_refills_burst_after_idle(clock):
+    limiter = RateLimiter(rate=10, burst=3)
+    for _ in range(10):
+        limiter.wait()
+
+    clock.now += 60
+    start = clock.now
+    for _ in range(3):
+        limiter.wait()
+    assert clock.now == start
+    limiter.wait()
+    assert clock.now == pytest.approx(start + 0.1)
+
+
+def test_rate_limiter_disabled_without_rate(clock):
+    limiter = RateLimiter()
+    for _ in range(100):
+        limiter.wait()
+    assert clock.sleeps == []
+
+
+def test_rate_limiter_holds_rate_across_threads():
+    rate = 200
+    limiter = RateLimiter(rate=rate, burst=5)
+    times = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(10):
+            limiter.wait()
+            with lock:
+                times.append(time.monotonic())
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    times.sort()
+    assert times[-1] - times[0] >= (len(times) - 5) / rate * 0.9
+
+
+def responses_handler(responses):
+    """Answers each GET with the next (status, headers) of responses."""
+    responses = iter(responses)
+
+    def handler(path, query):
+        (status, headers) = next(responses)
+        return (status, '{}', headers)
+
+    return handler
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.waits = 0
+
+    def wait(self):
+        self.waits += 1
+
+
+def test_get_with_retry_honours_retry_after(stub_server, clock):
+    server = stub_server(responses_handler([
+        (429, {'Retry-After': '7'}),
+        (200, {}),
+    ]))
+    limiter = CountingLimiter()
+
+    response = get_with_retry(requests.Session(), server.url + '/x',
+                              rate_limiter=limiter, retries=3, backoff=1)
+
+    assert response.status_code == 200
+    assert clock.sleeps == [7]
+    assert limiter.waits == 2
+
+
+def test_get_with_retry_backs_off_429_and_5xx(stub_server, clock):
+    server = stub_server(responses_handler([
+        (429, {}),
+        (503, {}),
+        (500, {}),
+        (200, {}),
+    ]))
+
+    response = get_with_retry(requests.Session(), server.url + '/x',
+                              retries=3, backoff=0.5)
+
+    assert response.status_code == 200
+    assert clock.sleeps == [0.5, 1.0, 2.0]
+    assert len(server.requests) == 4
+
+
+def test_get_with_retry_returns_last_failure(stub_server, clock):
+    server = stub_server(responses_handler([(503, {})] * 3))
+
+    response = get_with_retry(requests.Session(), server.url + '/x',
+                              retries=2, backoff=1)
+
+    assert response.status_code == 503
+    assert clock.sleeps == [1, 2]
+    assert len(server.requests) == 3
+
+
+def test_get_with_retry_does_not_retry_client_errors(stub_server, clock):
+    server = stub_server(responses_handler([(404, {})]))
+
+    response = get_with_retry(requests.Session(), server.url + '/x',
+                              retries=3, backoff=1)
+
+    assert response.status_code == 404
+    assert clock.sleeps == []
+    assert len(server.requests) == 1